@@ -0,0 +1,183 @@
+"""
+@file_name : AsyncMessenger.py
+@author : Srihari Seshadri
+@description : asyncio counterpart of Messenger.py. It does the following
+                operations without blocking the event loop :
+                1. Connects to a data hub
+                2. Sends messages to exchange/queue based on configuration
+@date : 11-14-2018
+"""
+
+import asyncio
+import pika
+import DataFrameCodec
+import Transport
+from Messenger import Messenger
+
+
+class _AsyncClient:
+    """
+    Shared plumbing for the asyncio clients. Turns pika's callback style
+    connection and channel operations into awaitables.
+    """
+
+    def __init__(self, loop=None):
+        self._loop = loop
+        self._connection = None
+        self._channel = None
+        self._pending = set()
+        self._closed = None
+        pass
+
+    async def connect(self, host='localhost', port=5672,
+                      uname="guest", pwd="guest"):
+        """
+        Establishes a connection and opens a channel for communication
+        :param host: IP address of the data hub
+        :param port: Port of communication (AMQP is 5672)
+        :param uname: Username for authentication
+        :param pwd: password for user
+        :return: 1 if success, -1 if failure
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        opened = self._loop.create_future()
+        self._closed = self._loop.create_future()
+
+        def on_open(connection):
+            connection.channel(on_open_callback=on_channel_open)
+
+        def on_channel_open(channel):
+            channel.add_on_close_callback(self._on_channel_closed)
+            if not opened.done():
+                opened.set_result(channel)
+
+        def on_open_error(connection, error):
+            if not opened.done():
+                opened.set_exception(ConnectionError(str(error)))
+
+        def on_close(connection, reply_code, reply_text):
+            self._fail_pending(ConnectionError(reply_text))
+            if not opened.done():
+                opened.set_exception(ConnectionError(reply_text))
+            if not self._closed.done():
+                self._closed.set_result(reply_code)
+
+        try:
+            # Make a credentials object
+            credentials = pika.PlainCredentials(uname, pwd)
+            self._connection = Transport.open_async_connection(
+                pika.ConnectionParameters(
+                    host=host,
+                    port=port,
+                    credentials=credentials
+                ),
+                on_open_callback=on_open,
+                on_open_error_callback=on_open_error,
+                on_close_callback=on_close,
+                loop=self._loop)
+            self._channel = await opened
+        except Exception as e:
+            print("Exception caught while trying to establish connection :")
+            print(e)
+            return -1
+        return 1
+
+    def _on_channel_closed(self, channel, reply_code, reply_text):
+        self._fail_pending(ConnectionError(reply_text))
+        if self._closed is not None and not self._closed.done():
+            self._closed.set_result(reply_code)
+
+    def _fail_pending(self, error):
+        for future in self._pending:
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    def _rpc(self, method, **kwargs):
+        """
+        Calls a pika channel method that reports completion via a callback
+        :param method: Bound channel method, e.g. channel.exchange_declare
+        :param kwargs: Arguments for the method
+        :return: Future resolved with the reply frame
+        """
+        future = self._loop.create_future()
+        self._pending.add(future)
+
+        def on_done(frame):
+            self._pending.discard(future)
+            if not future.done():
+                future.set_result(frame)
+
+        method(callback=on_done, **kwargs)
+        return future
+
+    async def _declare_exchange(self, ex_name, ex_type):
+        await self._rpc(self._channel.exchange_declare,
+                        exchange=ex_name,
+                        exchange_type=ex_type)
+
+    async def disconnect(self):
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+            await self._closed
+
+
+class AsyncMessenger(_AsyncClient):
+
+    def __init__(self, loop=None):
+        super().__init__(loop)
+        self._declared_exchanges = set()
+        pass
+
+    async def connect_to_exchange(self, ex_name, ex_type='topic'):
+        """
+        Checks if there's an exchange, and if not, creates it.
+        :param ex_name: Name of the exachange
+        :param ex_type: Type of the exchange
+        :return: 1 if success, -1 if failure
+        """
+        if (ex_name, ex_type) in self._declared_exchanges:
+            return 1
+        try:
+            await self._declare_exchange(ex_name, ex_type)
+        except Exception as e:
+            print("Exception caught while trying to connect to exchange :")
+            print(e)
+            return -1
+        self._declared_exchanges.add((ex_name, ex_type))
+        return 1
+
+    async def send_message_to_exchange(self, ex_name="", message="",
+                                       topic="",
+                                       df_format=DataFrameCodec.
+                                       FORMAT_COLUMNAR,
+                                       encoding=None, compression=None,
+                                       headers=None):
+        """
+        Sends a message to the exchange with a specific topic. The message
+        is handed to the connection's write buffer, so this never waits on
+        the broker.
+        :param ex_name: Name of the exchange to send to (NOTE: exchange must
+                        already exist for this to be a success)
+        :param message: String object containing the message
+        :param topic: Topic of the message
+        :param df_format: Wire format for dataframe topics
+        :param encoding: Encoding of non-string messages
+        :param compression: Compression of large bodies
+        :param headers: Extra AMQP headers
+        :return: 1 if success, -1 if failure
+        """
+        try:
+            body, properties = Messenger._build_message(message, topic,
+                                                        df_format, encoding,
+                                                        compression, headers)
+            self._channel.basic_publish(exchange=ex_name,
+                                        routing_key=topic,
+                                        body=body,
+                                        properties=properties)
+        except Exception as e:
+            print("Exception caught while trying to send message :")
+            print(e)
+            return -1
+        return 1
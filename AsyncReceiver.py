@@ -0,0 +1,171 @@
+"""
+@file_name : AsyncReceiver.py
+@author : Srihari Seshadri
+@description : asyncio counterpart of Receiver.py. It does the following
+                operations without blocking the event loop :
+                1. Connects to a data hub
+                2. Receives messages from exchange/queue based on config
+                3. Hands them to async callbacks or an async iterator
+@date : 11-14-2018
+"""
+
+import asyncio
+from AsyncMessenger import _AsyncClient
+
+PREFETCH_COUNT = 1000   # unacked messages in flight per consumer
+
+
+class AsyncReceiver(_AsyncClient):
+
+    def __init__(self, loop=None):
+        super().__init__(loop)
+        self._tasks = set()
+        pass
+
+    async def _subscribe(self, queue_name, ex_name, ex_type, topic,
+                         prefetch_count, durable=False, exclusive=True):
+        """
+        Declares the exchange and queue, binds them and sets the prefetch
+        :return: Name of the queue
+        """
+        await self._declare_exchange(ex_name, ex_type)
+        if queue_name == "":
+            result = await self._rpc(self._channel.queue_declare,
+                                     exclusive=True)
+        else:
+            result = await self._rpc(self._channel.queue_declare,
+                                     queue=queue_name,
+                                     durable=durable,
+                                     exclusive=exclusive)
+        queue_name = result.method.queue
+
+        await self._rpc(self._channel.queue_bind,
+                        exchange=ex_name,
+                        queue=queue_name,
+                        routing_key=topic)
+        if prefetch_count:
+            await self._rpc(self._channel.basic_qos,
+                            prefetch_count=prefetch_count)
+        return queue_name
+
+    async def get_data_from_exchange(self,
+                                     queue_name="",
+                                     ex_name="",
+                                     ex_type='topic',
+                                     topic="",
+                                     callback=None,
+                                     prefetch_count=PREFETCH_COUNT,
+                                     durable=False,
+                                     exclusive=True):
+        """
+        Consumes the queue, running the async callback as a task for every
+        message so up to prefetch_count messages are processed at once. A
+        message is acked when its callback returns, and rejected if the
+        callback raised or returned -1.
+        :param queue_name: Name of the queue. Leave empty to auto generate
+        :param ex_name: Name of the exchange to conect to
+        :param ex_type: Exchange Type
+        :param topic: Topic to subscribe to
+        :param callback: async function (ch, method, properties, body)
+        :param prefetch_count: Maximum number of unacked messages in flight
+        :param durable: Declare a named queue as durable
+        :param exclusive: Declare a named queue as exclusive to this
+                          connection. Set to False so that several
+                          consumers share the queue's messages
+        :return: -1 if failure. It should continue running until quit.
+        """
+        try:
+            queue_name = await self._subscribe(queue_name, ex_name, ex_type,
+                                               topic, prefetch_count,
+                                               durable, exclusive)
+
+            def on_message(ch, method, properties, body):
+                task = self._loop.create_task(
+                    self._run_callback(callback, ch, method,
+                                       properties, body))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            self._channel.basic_consume(consumer_callback=on_message,
+                                        queue=queue_name,
+                                        no_ack=False)
+            # Run until the channel or connection goes away
+            await self._closed
+        except Exception as e:
+            print("An error occured while trying to receive data from queue")
+            print(e)
+            return -1
+        return 1
+
+    async def _run_callback(self, callback, ch, method, properties, body):
+        try:
+            ret = await callback(ch, method, properties, body)
+        except Exception as e:
+            print("Exception caught in callback ")
+            print(e)
+            ret = -1
+        if not ch.is_open:
+            return
+        if ret == -1:
+            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        else:
+            ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    async def consume(self,
+                      queue_name="",
+                      ex_name="",
+                      ex_type='topic',
+                      topic="",
+                      auto_ack=True,
+                      prefetch_count=PREFETCH_COUNT,
+                      durable=False,
+                      exclusive=True):
+        """
+        Async iterator over the messages of a topic :
+
+            async for method, properties, body in receiver.consume(...):
+                ...
+
+        :param queue_name: Name of the queue. Leave empty to auto generate
+        :param ex_name: Name of the exchange to conect to
+        :param ex_type: Exchange Type
+        :param topic: Topic to subscribe to
+        :param auto_ack: If False, call ack()/nack() for every message
+        :param prefetch_count: Maximum number of unacked messages in flight
+        :param durable: Declare a named queue as durable
+        :param exclusive: Declare a named queue as exclusive to this
+                          connection
+        :return: yields (method, properties, body) tuples
+        """
+        queue_name = await self._subscribe(queue_name, ex_name, ex_type,
+                                           topic, prefetch_count,
+                                           durable, exclusive)
+        messages = asyncio.Queue()
+
+        def on_message(ch, method, properties, body):
+            messages.put_nowait((method, properties, body))
+
+        self._channel.basic_consume(consumer_callback=on_message,
+                                    queue=queue_name,
+                                    no_ack=auto_ack)
+        while not self._closed.done():
+            getter = self._loop.create_task(messages.get())
+            done, _ = await asyncio.wait(
+                [getter, self._closed],
+                return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                break
+            yield getter.result()
+
+    def ack(self, delivery_tag):
+        self._channel.basic_ack(delivery_tag=delivery_tag)
+
+    def nack(self, delivery_tag, requeue=False):
+        self._channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
+
+    async def disconnect(self):
+        # Let in-flight callbacks finish before closing
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await super().disconnect()
@@ -0,0 +1,184 @@
+"""
+@file_name : AsyncioBridge.py
+@author : Srihari Seshadri
+@description : This file lets the asyncio clients (AsyncMessenger and
+                AsyncReceiver) run over the in-process transports. It wraps
+                a connection with the BlockingConnection interface (FakeBroker
+                or SharedMemoryBroker) in the callback style interface of
+                pika's AsyncioConnection :
+                1. Channel operations complete through their callback on the
+                   next turn of the event loop
+                2. A pump task on the event loop delivers messages and runs
+                   the connection's timers and thread-safe callbacks, so
+                   consumer callbacks run on the loop's thread
+                Transport.open_async_connection() picks it for every
+                transport but AMQP.
+@date : 12-03-2018
+"""
+
+import asyncio
+
+PUMP_INTERVAL = 0.0005      # seconds between two polls of an idle connection
+PUMP_INTERVAL_MAX = 0.005   # idle polls back off up to this
+
+
+class BridgedChannel:
+
+    def __init__(self, bridge, channel):
+        self._bridge = bridge
+        self._channel = channel
+        self._on_close_callbacks = []
+        pass
+
+    @property
+    def is_open(self):
+        return self._channel.is_open
+
+    @property
+    def is_closed(self):
+        return not self._channel.is_open
+
+    def add_on_close_callback(self, callback):
+        self._on_close_callbacks.append(callback)
+
+    def _call(self, method, callback, **kwargs):
+        """
+        Runs a blocking channel method and reports its reply frame through
+        the callback, as AsyncioConnection channels do
+        """
+        frame = method(**kwargs)
+        if callback is not None:
+            self._bridge.loop.call_soon(callback, frame)
+
+    def exchange_declare(self, callback=None, **kwargs):
+        self._call(self._channel.exchange_declare, callback, **kwargs)
+
+    def queue_declare(self, callback=None, **kwargs):
+        self._call(self._channel.queue_declare, callback, **kwargs)
+
+    def queue_bind(self, callback=None, **kwargs):
+        self._call(self._channel.queue_bind, callback, **kwargs)
+
+    def basic_qos(self, callback=None, **kwargs):
+        self._call(self._channel.basic_qos, callback, **kwargs)
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        bridge = self._bridge
+
+        def on_message(ch, method, properties, body):
+            bridge.events += 1
+            consumer_callback(self, method, properties, body)
+
+        return self._channel.basic_consume(on_message, queue=queue,
+                                           no_ack=no_ack,
+                                           exclusive=exclusive,
+                                           consumer_tag=consumer_tag,
+                                           arguments=arguments)
+
+    def basic_cancel(self, consumer_tag=None, callback=None):
+        self._call(self._channel.basic_cancel, callback,
+                   consumer_tag=consumer_tag)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        return self._channel.basic_publish(exchange, routing_key, body,
+                                           properties=properties,
+                                           mandatory=mandatory)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._channel.basic_ack(delivery_tag=delivery_tag, multiple=multiple)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        self._channel.basic_nack(delivery_tag=delivery_tag,
+                                 multiple=multiple, requeue=requeue)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self._channel.basic_reject(delivery_tag=delivery_tag,
+                                   requeue=requeue)
+
+    def close(self, reply_code=200, reply_text="Normal shutdown"):
+        if not self._channel.is_open:
+            return
+        self._channel.close()
+        for callback in self._on_close_callbacks:
+            self._bridge.loop.call_soon(callback, self, reply_code,
+                                        reply_text)
+
+
+class BridgedConnection:
+
+    def __init__(self, connection_factory, parameters=None,
+                 on_open_callback=None, on_open_error_callback=None,
+                 on_close_callback=None, custom_ioloop=None):
+        """
+        Opens a connection with the factory and reports it through the
+        callbacks, like pika.adapters.asyncio_connection.AsyncioConnection
+        :param connection_factory: Callable taking pika.ConnectionParameters
+                                   and returning an object with the
+                                   BlockingConnection interface
+        :param parameters: pika.ConnectionParameters
+        :param on_open_callback: Function (connection)
+        :param on_open_error_callback: Function (connection, error)
+        :param on_close_callback: Function (connection, reply code, text)
+        :param custom_ioloop: asyncio event loop. Defaults to the current one
+        """
+        self.loop = custom_ioloop or asyncio.get_event_loop()
+        self.events = 0
+        self._on_close_callback = on_close_callback
+        self._channels = []
+        self._connection = None
+        self._pump = None
+        try:
+            self._connection = connection_factory(parameters)
+        except Exception as e:
+            if on_open_error_callback is not None:
+                self.loop.call_soon(on_open_error_callback, self, e)
+            return
+        self._pump = self.loop.create_task(self._run_pump())
+        if on_open_callback is not None:
+            self.loop.call_soon(on_open_callback, self)
+        pass
+
+    @property
+    def is_open(self):
+        return self._connection is not None and self._connection.is_open
+
+    @property
+    def is_closed(self):
+        return not self.is_open
+
+    def channel(self, on_open_callback=None, channel_number=None):
+        channel = BridgedChannel(self, self._connection.channel())
+        self._channels.append(channel)
+        if on_open_callback is not None:
+            self.loop.call_soon(on_open_callback, channel)
+        return channel
+
+    async def _run_pump(self):
+        """
+        Processes the connection's events on the loop, polling more slowly
+        while it stays idle
+        """
+        interval = PUMP_INTERVAL
+        while self.is_open:
+            events = self.events
+            self._connection.process_data_events(time_limit=0)
+            if self.events != events:
+                interval = PUMP_INTERVAL
+                await asyncio.sleep(0)
+            else:
+                await asyncio.sleep(interval)
+                interval = min(PUMP_INTERVAL_MAX, interval * 2)
+
+    def close(self, reply_code=200, reply_text="Normal shutdown"):
+        if not self.is_open:
+            return
+        for channel in self._channels:
+            channel.close(reply_code, reply_text)
+        self._connection.close()
+        if self._pump is not None:
+            self._pump.cancel()
+        if self._on_close_callback is not None:
+            self.loop.call_soon(self._on_close_callback, self, reply_code,
+                                reply_text)
@@ -0,0 +1,118 @@
+"""
+@file_name : BatchingConsumer.py
+@author : Srihari Seshadri
+@description : This file defines a consumer callback that hands messages to
+                a handler in batches instead of one at a time :
+                1. Buffers deliveries until N messages or T milliseconds
+                2. Calls the handler with the whole batch, so it can decode,
+                   clean and publish the batch with array operations and
+                   one pipelined publish
+                3. Acks the batch with a single multiple ack when every
+                   message succeeded, otherwise settles each message by its
+                   own result
+                Use it as the callback of Receiver.get_data_from_exchange
+                with auto_ack=False and no workers : it runs on the
+                connection thread
+@date : 12-03-2018
+"""
+
+import time
+import Metrics
+import Middleware
+
+MAX_MESSAGES = 100      # messages per batch
+MAX_DELAY_MS = 50       # milliseconds a message may wait in the buffer
+
+_batch_messages = Metrics.histogram(
+    "rtis_consumer_batch_messages", "Messages handled per batch",
+    ("name",), buckets=(1, 10, 25, 50, 100, 250, 500, 1000))
+_batch_seconds = Metrics.histogram(
+    "rtis_consumer_batch_seconds", "Time taken by the handler per batch",
+    ("name",))
+
+
+class BatchingConsumer:
+
+    def __init__(self, handler, max_messages=MAX_MESSAGES,
+                 max_delay_ms=MAX_DELAY_MS, name="batch"):
+        """
+        :param handler: Function taking a list of (properties, body) and
+                        returning a list with one result per message : 1 to
+                        ack, -1 (Middleware.REJECT) to reject or
+                        Middleware.REQUEUE
+        :param max_messages: Flush once this many messages are buffered
+        :param max_delay_ms: Flush once the oldest message is this old
+        :param name: Label of the batch metrics
+        """
+        self._handler = handler
+        self._max_messages = max_messages
+        self._max_delay = max_delay_ms / 1000.0
+        self._name = name
+        self._messages = []
+        self._tags = []
+        self._channel = None
+        self._timer = None
+        pass
+
+    def __call__(self, ch, method, properties, body):
+        """
+        pika consumer callback. Buffers the delivery; it stays unacked until
+        its batch has been handled
+        :return: 1 if buffered/flushed successfully, -1 if a flush failed
+        """
+        self._channel = ch
+        self._messages.append((properties, body))
+        self._tags.append(method.delivery_tag)
+        if len(self._messages) >= self._max_messages:
+            return self.flush()
+        if self._timer is None:
+            self._timer = ch.connection.add_timeout(self._max_delay,
+                                                    self._on_timer)
+        return 1
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        """
+        Hands the buffered messages to the handler and settles them. Must
+        run on the connection thread, e.g. once consuming has stopped
+        :return: 1 if every message was acked, -1 otherwise
+        """
+        if self._timer is not None:
+            self._channel.connection.remove_timeout(self._timer)
+            self._timer = None
+        if not self._messages:
+            return 1
+
+        messages, self._messages = self._messages, []
+        tags, self._tags = self._tags, []
+        _batch_messages.labels(self._name).observe(len(messages))
+        start = time.perf_counter()
+        try:
+            results = self._handler(messages)
+        except Exception as e:
+            print("Exception caught while handling a batch :")
+            print(e)
+            results = [Middleware.REQUEUE] * len(messages)
+        _batch_seconds.labels(self._name).observe(time.perf_counter() - start)
+
+        failed = [result in (Middleware.REJECT, Middleware.REQUEUE)
+                  for result in results]
+        try:
+            if not any(failed):
+                self._channel.basic_ack(delivery_tag=tags[-1], multiple=True)
+                return 1
+            for tag, result in zip(tags, results):
+                if result == Middleware.REQUEUE:
+                    self._channel.basic_nack(delivery_tag=tag, requeue=True)
+                elif result == Middleware.REJECT:
+                    self._channel.basic_nack(delivery_tag=tag, requeue=False)
+                else:
+                    self._channel.basic_ack(delivery_tag=tag)
+        except Exception as e:
+            # The channel went away, the broker will redeliver
+            print("Could not settle batch :")
+            print(e)
+        return -1
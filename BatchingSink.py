@@ -0,0 +1,215 @@
+"""
+@file_name : BatchingSink.py
+@author : Srihari Seshadri
+@description : This file defines a sink that sits between a Receiver and a
+                database table :
+                1. Buffers decoded rows until N rows or T milliseconds
+                2. Writes the whole batch with one multi-row INSERT, or
+                   an upsert for tables with a declared schema
+                3. Acks every delivery in the batch only after the commit
+                4. Optionally, while the database is failing or slow, acks
+                   once the batch is in a local WriteAheadSpool and
+                   replays the spool from a background thread
+@date : 12-03-2018
+"""
+
+import threading
+import time
+import Metrics
+
+MAX_ROWS = 500          # rows per batch
+MAX_DELAY_MS = 250      # milliseconds a row may wait in the buffer
+
+# With a spool : batches taking longer than SLOW_WRITE_SECONDS, or failing,
+# send the following SPOOL_BACKOFF seconds of batches to the spool
+SLOW_WRITE_SECONDS = 2.0
+SPOOL_BACKOFF = 5.0
+REPLAY_INTERVAL = 1.0   # seconds between replay attempts
+DRAIN_SECONDS = 20.0    # drain_spool gives the database this long
+
+_pending_gauge = Metrics.gauge(
+    "rtis_sink_pending_messages",
+    "Deliveries buffered in a sink waiting for their batch to commit",
+    ("table",))
+_batch_rows = Metrics.histogram(
+    "rtis_sink_batch_rows", "Rows written per batch", ("table",),
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 5000))
+_spool_pending = Metrics.gauge(
+    "rtis_spool_pending_rows", "Rows in the local spool waiting for the "
+    "database", ("table",))
+_spooled_total = Metrics.counter(
+    "rtis_spooled_rows_total", "Rows written to the local spool",
+    ("table",))
+_replayed_total = Metrics.counter(
+    "rtis_replayed_rows_total", "Rows replayed from the local spool",
+    ("table",))
+
+
+class BatchingSink:
+
+    def __init__(self, sqldbm, table_name,
+                 max_rows=MAX_ROWS, max_delay_ms=MAX_DELAY_MS,
+                 on_commit=None, upsert=False, spool=None, key=None):
+        """
+        :param sqldbm: Connected SQLDatabaseManager
+        :param table_name: Table the rows are written to
+        :param max_rows: Flush once this many rows are buffered
+        :param max_delay_ms: Flush once the oldest row is this old
+        :param on_commit: Optional function called with the list of rows
+                          once a batch is committed
+        :param upsert: Write with SQLDatabaseManager.upsert, so a tweet seen
+                       again updates its row. The table must have been
+                       declared with create_table
+        :param spool: Optional WriteAheadSpool. Batches that cannot be
+                      written go there and are acked instead of requeued
+        :param key: Field identifying a row (e.g. 'id_str'), used to merge
+                    rows of the same key when replaying the spool
+        """
+        self._sqldbm = sqldbm
+        self._table_name = table_name
+        self._max_rows = max_rows
+        self._max_delay = max_delay_ms / 1000.0
+        self._rows = []
+        self._channel = None
+        self._last_tag = None
+        self._timer = None
+        self._on_commit = on_commit
+        self._upsert = upsert
+        self._pending = 0
+        self._pending_metric = _pending_gauge.labels(table_name)
+        self._spool = spool
+        self._key = key
+        self._spool_until = 0.0
+        if spool is not None:
+            _spool_pending.labels(table_name).set(spool.pending())
+            threading.Thread(target=self._replay_loop,
+                             name="spool-replay", daemon=True).start()
+        pass
+
+    def add(self, ch, delivery_tag, row):
+        """
+        Buffers a row. The delivery stays unacked until its batch commits.
+        Must be called from the connection thread (i.e. a pika callback).
+        :param ch: channel the message was delivered on
+        :param delivery_tag: Delivery tag of the message
+        :param row: dict holding the row, or None to only ack the delivery
+                    along with the batch (e.g. a duplicate)
+        :return: 1 if buffered/flushed successfully, -1 if a flush failed
+        """
+        self._channel = ch
+        self._last_tag = delivery_tag
+        self._pending += 1
+        self._pending_metric.inc()
+        if row is not None:
+            self._rows.append(row)
+
+        if self._pending >= self._max_rows:
+            return self.flush()
+        if self._timer is None:
+            self._timer = ch.connection.add_timeout(self._max_delay,
+                                                    self._on_timer)
+        return 1
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def _write(self, rows):
+        if self._upsert:
+            return self._sqldbm.upsert(rows=rows,
+                                       table_name=self._table_name)
+        return self._sqldbm.insert_rows(rows=rows,
+                                        table_name=self._table_name)
+
+    def _spool_rows(self, rows):
+        ret = self._spool.append(rows)
+        if ret == 1:
+            _spooled_total.labels(self._table_name).inc(len(rows))
+            _spool_pending.labels(self._table_name).set(self._spool.pending())
+        return ret
+
+    def flush(self):
+        """
+        Writes the buffered rows in one transaction, then acks all of their
+        deliveries at once. If the write fails the deliveries are requeued,
+        unless the rows could be spooled. Rows also go to the spool while it
+        holds older rows, so the database always sees them in order.
+        :return: 1 if success, -1 if failure
+        """
+        if self._timer is not None:
+            self._channel.connection.remove_timeout(self._timer)
+            self._timer = None
+        if not self._pending:
+            return 1
+
+        rows, self._rows = self._rows, []
+        self._pending = 0
+        self._pending_metric.set(0)
+        _batch_rows.labels(self._table_name).observe(len(rows))
+        spooling = self._spool is not None and \
+            (self._spool.pending() or time.time() < self._spool_until)
+        if spooling:
+            ret = self._spool_rows(rows)
+        else:
+            start = time.time()
+            ret = self._write(rows)
+            if self._spool is not None and \
+                    (ret != 1 or time.time() - start > SLOW_WRITE_SECONDS):
+                self._spool_until = time.time() + SPOOL_BACKOFF
+                if ret != 1:
+                    print(" Database write failed. Spooling batches "
+                          "locally ....")
+                    ret = self._spool_rows(rows)
+        if ret == 1:
+            self._channel.basic_ack(delivery_tag=self._last_tag,
+                                    multiple=True)
+            if self._on_commit is not None and rows:
+                self._on_commit(rows)
+        else:
+            print(" Batch of", len(rows), "rows could not be stored. "
+                  "Requeueing ....")
+            self._channel.basic_nack(delivery_tag=self._last_tag,
+                                     multiple=True,
+                                     requeue=True)
+        return ret
+
+    def _replay_loop(self):
+        """
+        Drains the spool into the database whenever it is not backing off
+        """
+        while True:
+            time.sleep(REPLAY_INTERVAL)
+            while self._spool.pending() and time.time() >= self._spool_until:
+                start = time.time()
+                replayed = self._spool.replay(self._write, key=self._key)
+                if replayed < 0 or \
+                        time.time() - start > SLOW_WRITE_SECONDS:
+                    self._spool_until = time.time() + SPOOL_BACKOFF
+                if replayed > 0:
+                    _replayed_total.labels(self._table_name).inc(replayed)
+                _spool_pending.labels(self._table_name).set(
+                    self._spool.pending())
+                if replayed <= 0:
+                    break
+
+    def drain_spool(self, timeout=DRAIN_SECONDS):
+        """
+        Replays the spool into the database until it is empty, e.g. before
+        a worker whose spool no one else reads exits. Gives up when a write
+        fails or the timeout passes; the rows then stay in the spool for
+        the next sink opened on it.
+        :param timeout: Seconds to keep replaying
+        :return: Number of rows left in the spool
+        """
+        if self._spool is None:
+            return 0
+        deadline = time.time() + timeout
+        while self._spool.pending() and time.time() < deadline:
+            replayed = self._spool.replay(self._write, key=self._key)
+            if replayed > 0:
+                _replayed_total.labels(self._table_name).inc(replayed)
+            _spool_pending.labels(self._table_name).set(
+                self._spool.pending())
+            if replayed < 0:
+                break
+        return self._spool.pending()
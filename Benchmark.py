@@ -0,0 +1,345 @@
+"""
+@file_name : Benchmark.py
+@author : Srihari Seshadri
+@description : End to end benchmark of the Scraper -> Cleaner -> Store
+                pipeline. It runs the real Messenger, Receiver,
+                TweetCleaner.callback and TweetStore.callback code against
+                the in-process FakeBroker (or the SharedMemoryBroker rings)
+                and a SQLite database :
+                1. Generates a synthetic tweet corpus
+                2. Publishes it and waits until every tweet is stored
+                3. Reports msgs/s and p50/p99 latency per stage as JSON
+@date : 12-03-2018
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import Transport
+import MessageCodec
+import SharedMemoryBroker
+import TweetCleaner
+import TweetStore
+from FakeBroker import FakeBroker
+from Messenger import Messenger
+from Receiver import Receiver
+from BatchingSink import BatchingSink
+from BatchingConsumer import BatchingConsumer
+from Deduplicator import Deduplicator
+from MessengerPool import get_pool
+from SQLDatabaseManager import SQLDatabaseManager
+
+NUM_TWEETS = 5000
+PAGE_SIZE = 100             # tweets per publish_batch, like a search page
+TEXT_LENGTH = 140
+EXTRA_FIELDS = 20           # padding fields dropped by the projection
+DUPLICATE_RATE = 0.05
+CLEANER_WORKERS = TweetCleaner.WORKERS
+CLEANER_BATCH = TweetCleaner.BATCH_MESSAGES     # 0 cleans one at a time
+TIMEOUT = 300               # seconds
+TRANSPORT = Transport.TRANSPORT_FAKE    # or Transport.TRANSPORT_SHM
+OUTPUT_FILE = "benchmark_results.json"
+
+KEYWORDS = ["university of chicago", "uchicago", "hyde park", "maroons"]
+SCRAPER_FIELDS = ['id_str', 'created_at', 'retweet_count',
+                  'favorite_count', 'keywords']
+
+
+def make_corpus(num_tweets=NUM_TWEETS, text_length=TEXT_LENGTH,
+                extra_fields=EXTRA_FIELDS, duplicate_rate=DUPLICATE_RATE,
+                seed=0):
+    """
+    Builds synthetic tweets shaped like tweet._json
+    :param num_tweets: Number of messages (including duplicates)
+    :param text_length: Length of the text field
+    :param extra_fields: Number of filler fields per tweet
+    :param duplicate_rate: Fraction of messages repeating an earlier tweet
+    :param seed: Random seed
+    :return: list of tweet dicts
+    """
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    tweets = []
+    for i in range(num_tweets):
+        if tweets and rng.random() < duplicate_rate:
+            tweets.append(dict(rng.choice(tweets)))
+            continue
+        created = now - datetime.timedelta(seconds=rng.randint(0, 86400))
+        tweet = {'id_str': str(1000000000000000000 + i),
+                 'created_at': created.strftime(
+                     '%a %b %d %H:%M:%S +0000 %Y'),
+                 'text': ''.join(rng.choice('abcdefgh ')
+                                 for _ in range(text_length)),
+                 'retweet_count': rng.randint(0, 500),
+                 'favorite_count': rng.randint(0, 2000),
+                 'keywords': rng.choice(KEYWORDS)}
+        for f in range(extra_fields):
+            tweet['field_' + str(f)] = 'x' * 32
+        tweets.append(tweet)
+    return tweets
+
+
+class LatencyRecorder:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        pass
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        report = {}
+        with self._lock:
+            for stage, samples in self._samples.items():
+                ms = np.asarray(samples) * 1000.0
+                report[stage] = {"count": len(samples),
+                                 "mean_ms": float(ms.mean()),
+                                 "p50_ms": float(np.percentile(ms, 50)),
+                                 "p99_ms": float(np.percentile(ms, 99)),
+                                 "max_ms": float(ms.max())}
+        return report
+
+
+def _timed(recorder, stage, callback):
+    def wrapper(ch, method, properties, body):
+        start = time.perf_counter()
+        try:
+            return callback(ch, method, properties, body)
+        finally:
+            recorder.add(stage, time.perf_counter() - start)
+    return wrapper
+
+
+def _timed_handler(recorder, stage, handler):
+    def wrapper(messages):
+        start = time.perf_counter()
+        try:
+            return handler(messages)
+        finally:
+            recorder.add(stage, time.perf_counter() - start)
+    return wrapper
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(tweets, page_size=PAGE_SIZE,
+                  cleaner_workers=CLEANER_WORKERS,
+                  cleaner_batch=CLEANER_BATCH, timeout=TIMEOUT,
+                  quiet=True, transport=TRANSPORT):
+    """
+    Pushes a corpus through the pipeline and measures it
+    :param tweets: List of tweet dicts (see make_corpus)
+    :param page_size: Tweets per publish_batch
+    :param cleaner_workers: Concurrent workers of the cleaner, when it
+                            cleans one tweet at a time
+    :param cleaner_batch: Tweets the cleaner cleans and forwards together,
+                          as TweetCleaner.main() does. 0 runs the one tweet
+                          at a time callback on cleaner_workers workers
+    :param timeout: Seconds to wait for the pipeline to drain
+    :param quiet: Silence the per-message prints of the stages
+    :param transport: Transport.TRANSPORT_FAKE to hand messages over in
+                      memory, or Transport.TRANSPORT_SHM to go through the
+                      shared memory rings
+    :return: dict with the results
+    """
+    if transport == Transport.TRANSPORT_SHM:
+        broker = SharedMemoryBroker.SharedMemoryBroker(
+            namespace="rtis_bench_" + str(os.getpid()))
+    else:
+        broker = FakeBroker()
+    Transport.set_connection_factory(broker.connection)
+    recorder = LatencyRecorder()
+    sent_at = {}
+    unique_ids = set(tweet['id_str'] for tweet in tweets)
+    stored = set()
+    done = threading.Event()
+    lock = threading.Lock()
+
+    db_dir = tempfile.mkdtemp(prefix="rtis_bench_")
+    sqldbm = SQLDatabaseManager()
+    sqldbm.connect_url("sqlite:///" + os.path.join(db_dir, "tweets.db"))
+    sqldbm.create_table(TweetStore.TWEET_SCHEMA)
+
+    def on_commit(rows):
+        now = time.perf_counter()
+        TweetStore.mark_stored(rows)
+        with lock:
+            for row in rows:
+                tweet_id = row['id_str']
+                if tweet_id in sent_at and tweet_id not in stored:
+                    recorder.add("end_to_end", now - sent_at[tweet_id])
+                stored.add(tweet_id)
+            if len(stored) >= len(unique_ids):
+                done.set()
+
+    # Wire the stages to the stand-ins instead of the real hosts
+    TweetCleaner.dedup = Deduplicator()
+    TweetStore.dedup = Deduplicator()
+    TweetStore.sink = BatchingSink(sqldbm, TweetStore.TABLE_NAME,
+                                   max_rows=TweetStore.BATCH_ROWS,
+                                   max_delay_ms=TweetStore.BATCH_DELAY_MS,
+                                   on_commit=on_commit,
+                                   upsert=True)
+
+    cleaner = Receiver()
+    store = Receiver()
+    cleaner.connect()
+    store.connect()
+    if cleaner_batch > 0:
+        batcher = BatchingConsumer(
+            _timed_handler(recorder, "clean_batch",
+                           TweetCleaner.forward_batch),
+            max_messages=cleaner_batch,
+            max_delay_ms=TweetCleaner.BATCH_DELAY_MS)
+        cleaner_args = dict(callback=batcher, auto_ack=False,
+                            prefetch_count=2 * cleaner_batch)
+    else:
+        cleaner_args = dict(callback=_timed(recorder, "clean_callback",
+                                            TweetCleaner.callback),
+                            workers=cleaner_workers)
+    threads = [
+        threading.Thread(target=cleaner.get_data_from_exchange, kwargs=dict(
+            ex_name=TweetCleaner.EXCHANGE,
+            topic=TweetCleaner.SUB_TOPIC,
+            **cleaner_args)),
+        threading.Thread(target=store.get_data_from_exchange, kwargs=dict(
+            ex_name=TweetStore.EXCHANGE,
+            topic=TweetStore.SUB_TOPIC,
+            callback=_timed(recorder, "store_callback",
+                            TweetStore.callback),
+            auto_ack=False))]
+
+    stdout = open(os.devnull, "w") if quiet else None
+    with contextlib.redirect_stdout(stdout) if quiet \
+            else contextlib.nullcontext():
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        broker.wait_for_consumers(TweetCleaner.EXCHANGE,
+                                  TweetCleaner.SUB_TOPIC)
+        broker.wait_for_consumers(TweetStore.EXCHANGE, TweetStore.SUB_TOPIC)
+
+        messenger = Messenger()
+        messenger.connect()
+        messenger.connect_to_exchange(ex_name=TweetCleaner.EXCHANGE)
+
+        start = time.perf_counter()
+        for i in range(0, len(tweets), page_size):
+            page = tweets[i:i + page_size]
+            messages = [MessageCodec.project(tweet, SCRAPER_FIELDS)
+                        for tweet in page]
+            batch_start = time.perf_counter()
+            with lock:
+                for tweet in page:
+                    sent_at.setdefault(tweet['id_str'], batch_start)
+            messenger.publish_batch(ex_name=TweetCleaner.EXCHANGE,
+                                    messages=messages,
+                                    topic=TweetCleaner.SUB_TOPIC,
+                                    compression=MessageCodec.
+                                    COMPRESSION_ZLIB)
+            recorder.add("publish_per_msg",
+                         (time.perf_counter() - batch_start) / len(page))
+        published = time.perf_counter()
+
+        completed = done.wait(timeout)
+        elapsed = time.perf_counter() - start
+
+        cleaner.stop()
+        store.stop()
+        for thread in threads:
+            thread.join(5)
+    # Drop the cleaner's pooled connections to this broker
+    get_pool(host=TweetCleaner.DATA_HUB_HOST,
+             uname=TweetCleaner.DATA_HUB_UNAME,
+             pwd=TweetCleaner.DATA_HUB_PWD).close()
+    Transport.set_connection_factory(None)
+    if transport == Transport.TRANSPORT_SHM:
+        broker.close(unlink=True)
+    if stdout is not None:
+        stdout.close()
+
+    return {"timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+            "git_commit": _git_commit(),
+            "config": {"transport": transport,
+                       "messages": len(tweets),
+                       "unique_tweets": len(unique_ids),
+                       "page_size": page_size,
+                       "cleaner_workers": cleaner_workers,
+                       "cleaner_batch": cleaner_batch,
+                       "batch_rows": TweetStore.BATCH_ROWS,
+                       "batch_delay_ms": TweetStore.BATCH_DELAY_MS},
+            "completed": completed,
+            "stored": len(stored),
+            "elapsed_s": elapsed,
+            "publish_s": published - start,
+            "throughput_msgs_per_s": len(tweets) / elapsed,
+            "stages": recorder.summary()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pipeline benchmark")
+    parser.add_argument("--tweets", type=int, default=NUM_TWEETS)
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    parser.add_argument("--text-length", type=int, default=TEXT_LENGTH)
+    parser.add_argument("--extra-fields", type=int, default=EXTRA_FIELDS)
+    parser.add_argument("--duplicate-rate", type=float,
+                        default=DUPLICATE_RATE)
+    parser.add_argument("--cleaner-workers", type=int,
+                        default=CLEANER_WORKERS)
+    parser.add_argument("--cleaner-batch", type=int, default=CLEANER_BATCH)
+    parser.add_argument("--timeout", type=float, default=TIMEOUT)
+    parser.add_argument("--transport", default=TRANSPORT,
+                        choices=[Transport.TRANSPORT_FAKE,
+                                 Transport.TRANSPORT_SHM])
+    parser.add_argument("--output", default=OUTPUT_FILE)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    tweets = make_corpus(num_tweets=args.tweets,
+                         text_length=args.text_length,
+                         extra_fields=args.extra_fields,
+                         duplicate_rate=args.duplicate_rate)
+    results = run_benchmark(tweets,
+                            page_size=args.page_size,
+                            cleaner_workers=args.cleaner_workers,
+                            cleaner_batch=args.cleaner_batch,
+                            timeout=args.timeout,
+                            quiet=not args.verbose,
+                            transport=args.transport)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(" Stored", results["stored"], "of",
+          results["config"]["unique_tweets"], "tweets in",
+          round(results["elapsed_s"], 2), "s :",
+          round(results["throughput_msgs_per_s"], 1), "msgs/s")
+    for stage, stats in sorted(results["stages"].items()):
+        print("  ", stage.ljust(16), "p50", round(stats["p50_ms"], 3),
+              "ms  p99", round(stats["p99_ms"], 3), "ms")
+    print(" Results written to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+"""
+@file_name : DataFrameCodec.py
+@author : Srihari Seshadri
+@description : This file defines the wire format used to move pandas
+                dataframes over the data hub :
+                1. Encodes a dataframe into a binary columnar message body
+                2. Decodes a columnar message body back into a dataframe
+                3. Falls back to the legacy text format for older peers
+                Frames are encoded exactly or not at all : column labels
+                keep their type and position (duplicates included), and
+                anything the format cannot carry raises ValueError
+                4. Splits large dataframes into row batches sent as a
+                   stream of messages (see DataFrameStream.py)
+@date : 11-14-2018
+"""
+
+import io
+import json
+import struct
+
+import numpy as np
+# pandas is imported where it is used : it takes a few hundred milliseconds,
+# and stages that only move JSON messages never need it
+
+# Values carried in the AMQP headers so that receivers know how to decode
+FORMAT_HEADER = "x-df-format"
+VERSION_HEADER = "x-df-version"
+FORMAT_COLUMNAR = "columnar"
+FORMAT_TEXT = "text"
+FORMAT_VERSION = 2      # 2 : columns by position, typed labels
+CONTENT_TYPE = "application/x-rtis-dataframe"
+
+# Chunked streams : every chunk carries the stream id, its sequence number
+# (from 0) and, on the last chunk only, the final marker
+STREAM_ID_HEADER = "x-stream-id"
+STREAM_SEQ_HEADER = "x-stream-seq"
+STREAM_FINAL_HEADER = "x-stream-final"
+CHUNK_ROWS = 50000      # rows per chunk
+
+# Layout : MAGIC | version (u16) | schema length (u32) | schema | buffers
+# Every buffer starts on an 8 byte boundary so numeric columns can be
+# viewed in place with numpy.frombuffer
+MAGIC = b"RTDF"
+_PREAMBLE = struct.Struct("<4sHI")
+_ALIGN = 8
+_NUMERIC_KINDS = "biufc"
+_INDEX_NAME = "__index__"       # index column of version 1 bodies
+
+
+def _padding(size):
+    return (-size) % _ALIGN
+
+
+def _string_buffers(values, missing):
+    """
+    Packs a sequence of python objects as utf-8 strings
+    :param values: Iterable of str values
+    :param missing: Boolean array, True where the value is missing
+    :return: (offsets array, validity array, data bytes)
+    """
+    encoded = []
+    valid = np.ascontiguousarray(~missing, dtype=np.uint8)
+    for i, value in enumerate(values):
+        if missing[i]:
+            encoded.append(b"")
+        else:
+            encoded.append(str(value).encode("utf-8"))
+    offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    return offsets, valid, b"".join(encoded)
+
+
+def _is_masked(dtype):
+    """
+    :return: True for the nullable numeric and boolean extension dtypes
+             (Int64, Float32, boolean...), held as values plus a mask
+    """
+    import pandas as pd
+    numpy_dtype = getattr(dtype, "numpy_dtype", None)
+    return isinstance(dtype, pd.api.extensions.ExtensionDtype) and \
+        numpy_dtype is not None and numpy_dtype.kind in "biuf"
+
+
+def _encode_label(label):
+    """
+    Turns a column label or index name into JSON that keeps its type
+    :param label: str, int, float, bool, None or a tuple of those
+    :return: [type tag, value]
+    """
+    if label is None:
+        return ["n", None]
+    if isinstance(label, (bool, np.bool_)):
+        return ["b", bool(label)]
+    if isinstance(label, str):
+        return ["s", label]
+    if isinstance(label, (int, np.integer)):
+        return ["i", int(label)]
+    if isinstance(label, (float, np.floating)):
+        return ["f", float(label)]
+    if isinstance(label, tuple):
+        return ["t", [_encode_label(part) for part in label]]
+    raise ValueError("Label " + repr(label) + " of type " +
+                     type(label).__name__ + " cannot be encoded")
+
+
+def _decode_label(encoded):
+    tag, value = encoded
+    if tag == "t":
+        return tuple(_decode_label(part) for part in value)
+    return value
+
+
+def _column_entry(series, place):
+    """
+    Works out the schema entry of a single column and places its raw buffers
+    :param series: pandas Series
+    :param place: Function taking a buffer and returning its [offset, size]
+    :return: schema dict
+    """
+    import pandas as pd
+    dtype = series.dtype
+    if isinstance(dtype, np.dtype) and dtype.kind in _NUMERIC_KINDS:
+        values = np.ascontiguousarray(series.to_numpy())
+        return {"kind": "numeric", "dtype": values.dtype.str,
+                "buffers": [place(values)]}
+
+    if isinstance(dtype, np.dtype) and dtype.kind in "mM":
+        values = np.ascontiguousarray(series.to_numpy())
+        return {"kind": "datetime", "dtype": values.dtype.str,
+                "buffers": [place(values.view("<i8"))]}
+
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        values = np.ascontiguousarray(
+            series.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy())
+        return {"kind": "datetime", "dtype": values.dtype.str,
+                "tz": str(dtype.tz), "buffers": [place(values.view("<i8"))]}
+
+    if _is_masked(dtype):
+        # Missing slots hold a zero in the values buffer
+        missing = series.isna().to_numpy()
+        values = np.ascontiguousarray(
+            series.to_numpy(dtype=dtype.numpy_dtype, na_value=0))
+        valid = np.ascontiguousarray(~missing, dtype=np.uint8)
+        return {"kind": "masked", "dtype": dtype.name,
+                "values_dtype": values.dtype.str,
+                "buffers": [place(values), place(valid)]}
+
+    if isinstance(dtype, pd.CategoricalDtype):
+        codes = np.ascontiguousarray(series.cat.codes.to_numpy())
+        categories = _column_entry(pd.Series(dtype.categories), place)
+        categories["length"] = len(dtype.categories)
+        return {"kind": "categorical", "dtype": codes.dtype.str,
+                "ordered": bool(dtype.ordered), "categories": categories,
+                "buffers": [place(codes)]}
+
+    # Text (object columns holding only str, and string columns) travels
+    # as utf-8. Anything else would not come back as it was sent
+    if not isinstance(dtype, pd.StringDtype) and not (
+            dtype == object and pd.api.types.infer_dtype(
+                series, skipna=True) in ("string", "empty")):
+        raise ValueError("Column " + repr(series.name) + " of dtype " +
+                         str(dtype) + " cannot be encoded")
+    offsets, valid, data = _string_buffers(series.astype(object).tolist(),
+                                           series.isna().to_numpy())
+    entry = {"kind": "string",
+             "buffers": [place(offsets), place(valid), place(data)]}
+    if isinstance(dtype, pd.StringDtype):
+        entry["dtype"] = str(dtype)
+    return entry
+
+
+def encode_dataframe(dframe):
+    """
+    Encodes a dataframe into the binary columnar format
+    :param dframe: Dataframe to encode
+    :return: bytes object holding the message body
+    :raises ValueError: if the frame holds a label or a column the format
+                        cannot round-trip
+    """
+    import pandas as pd
+    buffers = []
+    offset = [0]
+
+    def place(buf):
+        view = memoryview(buf).cast("B")
+        location = [offset[0], view.nbytes]
+        buffers.append(view)
+        pad = _padding(view.nbytes)
+        if pad:
+            buffers.append(b"\0" * pad)
+        offset[0] += view.nbytes + pad
+        return location
+
+    index = dframe.index
+    index_schema = {"names": [_encode_label(name) for name in index.names]}
+    index_columns = []
+    if isinstance(index, pd.RangeIndex):
+        index_schema["range"] = [index.start, index.stop, index.step]
+    else:
+        for level in range(index.nlevels):
+            values = index.get_level_values(level)
+            index_columns.append(_column_entry(
+                pd.Series(values, name=values.name), place))
+
+    labels = dframe.columns
+    columns_schema = {"names": [_encode_label(name) for name in labels.names],
+                      "multi": isinstance(labels, pd.MultiIndex),
+                      "labels": [_encode_label(label) for label in labels]}
+    if isinstance(labels, pd.RangeIndex):
+        columns_schema["range"] = [labels.start, labels.stop, labels.step]
+    elif not columns_schema["multi"]:
+        columns_schema["dtype"] = str(labels.dtype)
+
+    columns = [_column_entry(dframe.iloc[:, i], place)
+               for i in range(dframe.shape[1])]
+
+    schema = json.dumps({"nrows": len(dframe),
+                         "index_schema": index_schema,
+                         "index_columns": index_columns,
+                         "columns_schema": columns_schema,
+                         "columns": columns}).encode("utf-8")
+    schema += b" " * _padding(_PREAMBLE.size + len(schema))
+    preamble = _PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(schema))
+    return b"".join([preamble, schema] + buffers)
+
+
+def _column_values(body, start, entry, nrows):
+    """
+    Rebuilds the values of a single column from its schema entry
+    :return: numpy or pandas array
+    """
+    import pandas as pd
+    bufs = [start + off for off, _ in entry["buffers"]]
+    kind = entry["kind"]
+    if kind in ("numeric", "datetime"):
+        values = np.frombuffer(body, dtype=entry["dtype"], count=nrows,
+                               offset=bufs[0])
+        if "tz" in entry:
+            values = pd.DatetimeIndex(values).tz_localize(
+                "UTC").tz_convert(entry["tz"])
+        return values
+
+    if kind == "masked":
+        values = np.frombuffer(body, dtype=entry["values_dtype"],
+                               count=nrows, offset=bufs[0])
+        valid = np.frombuffer(body, dtype=np.uint8, count=nrows,
+                              offset=bufs[1])
+        array_type = pd.api.types.pandas_dtype(
+            entry["dtype"]).construct_array_type()
+        # The arrays can be written to, so they get their own copy
+        return array_type(values.copy(), valid == 0)
+
+    if kind == "categorical":
+        codes = np.frombuffer(body, dtype=entry["dtype"], count=nrows,
+                              offset=bufs[0])
+        categories = entry["categories"]
+        return pd.Categorical.from_codes(
+            codes,
+            categories=_column_values(body, start, categories,
+                                      categories["length"]),
+            ordered=entry["ordered"])
+
+    view = memoryview(body)
+    offsets = np.frombuffer(body, dtype="<i8", count=nrows + 1,
+                            offset=bufs[0])
+    valid = np.frombuffer(body, dtype=np.uint8, count=nrows, offset=bufs[1])
+    base = bufs[2]
+    values = np.empty(nrows, dtype=object)
+    for i in range(nrows):
+        if valid[i]:
+            values[i] = str(view[base + offsets[i]:base + offsets[i + 1]],
+                            "utf-8")
+        else:
+            values[i] = None
+    if "dtype" in entry:
+        return pd.array(values, dtype=entry["dtype"])
+    return values
+
+
+def decode_dataframe(body):
+    """
+    Rebuilds a dataframe from a binary columnar body. Numeric and datetime
+    columns are read-only views on the body and are not copied.
+    :param body: bytes object holding the message body
+    :return: Dataframe
+    """
+    import pandas as pd
+    magic, version, schema_len = _PREAMBLE.unpack_from(body, 0)
+    if magic != MAGIC:
+        raise ValueError("Message body is not a columnar dataframe")
+    if version > FORMAT_VERSION:
+        raise ValueError("Unsupported dataframe format version : " +
+                         str(version))
+
+    start = _PREAMBLE.size + schema_len
+    schema = json.loads(bytes(body[_PREAMBLE.size:start]).decode("utf-8"))
+    nrows = schema["nrows"]
+    if version < 2:
+        return _decode_v1(body, start, schema, nrows)
+
+    data = {i: _column_values(body, start, entry, nrows)
+            for i, entry in enumerate(schema["columns"])}
+
+    index_schema = schema["index_schema"]
+    names = [_decode_label(name) for name in index_schema["names"]]
+    if "range" in index_schema:
+        index = pd.RangeIndex(*index_schema["range"], name=names[0])
+    else:
+        levels = [_column_values(body, start, entry, nrows)
+                  for entry in schema["index_columns"]]
+        if len(levels) == 1:
+            index = pd.Index(levels[0], name=names[0])
+        else:
+            index = pd.MultiIndex.from_arrays(levels, names=names)
+
+    columns_schema = schema["columns_schema"]
+    names = [_decode_label(name) for name in columns_schema["names"]]
+    labels = [_decode_label(label) for label in columns_schema["labels"]]
+    if "range" in columns_schema:
+        columns = pd.RangeIndex(*columns_schema["range"], name=names[0])
+    elif columns_schema["multi"]:
+        columns = pd.MultiIndex.from_tuples(labels, names=names)
+    else:
+        columns = pd.Index(labels, name=names[0],
+                           dtype=columns_schema["dtype"])
+
+    dframe = pd.DataFrame(data, index=index, copy=False)
+    dframe.columns = columns
+    return dframe
+
+
+def _decode_v1(body, start, schema, nrows):
+    """
+    Rebuilds a dataframe from a version 1 body, whose columns are keyed by
+    their name
+    """
+    import pandas as pd
+    data = {}
+    for entry in schema["columns"]:
+        data[entry["name"]] = _column_values(body, start, entry, nrows)
+
+    # Bodies from before the index schema only flag a non-range index
+    index_schema = schema.get("index_schema", {})
+    if schema["index"]:
+        index = pd.Index(data.pop(_INDEX_NAME), name=index_schema.get("name"))
+    elif "range" in index_schema:
+        index = pd.RangeIndex(*index_schema["range"],
+                              name=index_schema.get("name"))
+    else:
+        index = None
+    return pd.DataFrame(data, index=index, copy=False)
+
+
+def encode_dataframe_text(dframe):
+    """
+    Encodes a dataframe in the legacy whitespace separated text format
+    :param dframe: Dataframe to encode
+    :return: String object holding the message body
+    """
+    return dframe.to_string()
+
+
+def decode_dataframe_text(body):
+    """
+    Decodes a dataframe sent in the legacy text format
+    :param body: Byte stream of the content in
+    :return: Dataframe
+    """
+    import pandas as pd
+    content_str = body.decode("utf-8")
+    return pd.read_csv(io.StringIO(content_str), sep=r'\s+')
+
+
+def build_headers(df_format=FORMAT_COLUMNAR):
+    """
+    Headers that describe the wire format of a dataframe message
+    :param df_format: FORMAT_COLUMNAR or FORMAT_TEXT
+    :return: dict of AMQP headers
+    """
+    return {FORMAT_HEADER: df_format, VERSION_HEADER: FORMAT_VERSION}
+
+
+def dumps(dframe, df_format=FORMAT_COLUMNAR):
+    """
+    Encodes a dataframe in the requested format
+    :param dframe: Dataframe to encode
+    :param df_format: FORMAT_COLUMNAR or FORMAT_TEXT
+    :return: (body, headers)
+    """
+    if df_format == FORMAT_TEXT:
+        return encode_dataframe_text(dframe), build_headers(FORMAT_TEXT)
+    return encode_dataframe(dframe), build_headers(FORMAT_COLUMNAR)
+
+
+def split(dframe, chunk_rows=CHUNK_ROWS):
+    """
+    Splits a dataframe into row batches. An empty dataframe gives one empty
+    batch, so that its columns still reach the receiver
+    :param dframe: Dataframe
+    :param chunk_rows: Rows per batch
+    :return: yields dataframes
+    """
+    chunk_rows = max(1, int(chunk_rows))
+    if len(dframe) == 0:
+        yield dframe
+        return
+    for start in range(0, len(dframe), chunk_rows):
+        yield dframe.iloc[start:start + chunk_rows]
+
+
+def stream_headers(stream_id, seq, final):
+    """
+    Headers of one chunk of a stream
+    :return: dict of AMQP headers
+    """
+    headers = {STREAM_ID_HEADER: stream_id, STREAM_SEQ_HEADER: seq}
+    if final:
+        headers[STREAM_FINAL_HEADER] = True
+    return headers
+
+
+def loads(body, properties=None):
+    """
+    Decodes a dataframe message. Messages without format headers are
+    assumed to come from a text-mode peer.
+    :param body: Byte stream of the content in
+    :param properties: pika BasicProperties of the message
+    :return: Dataframe
+    """
+    headers = getattr(properties, "headers", None) or {}
+    df_format = headers.get(FORMAT_HEADER, FORMAT_TEXT)
+    if isinstance(df_format, bytes):
+        df_format = df_format.decode("utf-8")
+    if df_format == FORMAT_COLUMNAR:
+        return decode_dataframe(body)
+    return decode_dataframe_text(body)
@@ -0,0 +1,236 @@
+"""
+@file_name : DataFrameStream.py
+@author : Srihari Seshadri
+@description : This file puts chunked dataframe streams (see
+                Messenger.send_dataframe_stream) back together on the
+                receiving side :
+                1. Hands out the chunks of every stream in sequence order as
+                   soon as they can be, or the whole frame once the final
+                   chunk arrived
+                2. Holds chunks that arrive early (e.g. after a redelivery)
+                   until the gap is filled
+                3. Bounds the memory held for incomplete streams, dropping
+                   the least recently active stream first
+                4. Drops streams that stop receiving chunks for too long
+                5. Remembers recently completed streams, so a redelivered
+                   chunk of one is not handed out again
+                Messages without stream headers are passed through as a
+                stream of one chunk.
+@date : 12-03-2018
+"""
+
+import collections
+import threading
+import time
+import DataFrameCodec
+import MessageCodec
+import Metrics
+
+STREAM_TIMEOUT = 60                     # seconds without a chunk
+MAX_BUFFERED_BYTES = 256 * 1024 * 1024  # wire bytes held for all streams
+DROPPED_KEPT = 1024                     # dropped stream ids remembered
+COMPLETED_KEPT = 1024                   # completed stream ids remembered
+
+StreamChunk = collections.namedtuple("StreamChunk",
+                                     ["stream_id", "seq", "dataframe",
+                                      "final"])
+
+_chunks_total = Metrics.counter(
+    "rtis_stream_chunks_total", "Dataframe stream chunks received")
+_redelivered_total = Metrics.counter(
+    "rtis_stream_redelivered_chunks_total",
+    "Dataframe stream chunks received again after they were taken")
+_completed_total = Metrics.counter(
+    "rtis_streams_completed_total", "Dataframe streams received in full")
+_dropped_total = Metrics.counter(
+    "rtis_streams_dropped_total", "Incomplete dataframe streams dropped",
+    ("reason",))
+_buffered_bytes = Metrics.gauge(
+    "rtis_stream_buffered_bytes",
+    "Wire bytes held for incomplete dataframe streams")
+
+
+class _Stream:
+
+    def __init__(self, now):
+        self.next_seq = 0
+        self.pending = {}       # seq -> (properties, body, final)
+        self.frames = []        # decoded chunks, when reassembling
+        self.bytes = 0
+        self.last_seen = now
+        pass
+
+
+def stream_position(properties):
+    """
+    :param properties: pika BasicProperties of a message
+    :return: (stream id, sequence number, final flag) of a stream chunk, or
+             (None, 0, True) for a message without stream headers
+    """
+    headers = getattr(properties, "headers", None) or {}
+    stream_id = headers.get(DataFrameCodec.STREAM_ID_HEADER)
+    if stream_id is None:
+        return None, 0, True
+    if isinstance(stream_id, bytes):
+        stream_id = stream_id.decode("utf-8")
+    seq = int(headers.get(DataFrameCodec.STREAM_SEQ_HEADER, 0))
+    final = bool(headers.get(DataFrameCodec.STREAM_FINAL_HEADER, False))
+    return stream_id, seq, final
+
+
+def _decode(properties, body):
+    return DataFrameCodec.loads(
+        MessageCodec.decompress(body, properties.content_encoding),
+        properties)
+
+
+class StreamAssembler:
+
+    def __init__(self, reassemble=False, timeout=STREAM_TIMEOUT,
+                 max_bytes=MAX_BUFFERED_BYTES):
+        """
+        :param reassemble: Return whole frames instead of chunks
+        :param timeout: Seconds an incomplete stream is kept without
+                        receiving a chunk
+        :param max_bytes: Wire bytes held for incomplete streams at most.
+                          Chunks handed out right away are not held
+        """
+        self.reassemble = reassemble
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self._streams = collections.OrderedDict()   # least recent first
+        self._dropped = collections.OrderedDict()
+        self._completed = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        pass
+
+    def add(self, properties, body, now=None):
+        """
+        Takes one message of a stream
+        :param properties: pika BasicProperties of the message
+        :param body: Raw body
+        :param now: Current time (time.monotonic). Defaults to now
+        :return: List of StreamChunk ready to be processed, in order. When
+                 reassembling, a single StreamChunk with the whole frame
+                 once the stream is complete
+        """
+        now = time.monotonic() if now is None else now
+        stream_id, seq, final = stream_position(properties)
+        _chunks_total.labels().inc()
+        if stream_id is None:
+            return [StreamChunk(None, 0, _decode(properties, body), True)]
+
+        with self._lock:
+            self._expire(now)
+            if stream_id in self._dropped:
+                return []
+            if stream_id in self._completed:
+                # Redelivered chunk of a stream already handed out
+                _redelivered_total.labels().inc()
+                return []
+            stream = self._streams.pop(stream_id, None) or _Stream(now)
+            self._streams[stream_id] = stream
+            stream.last_seen = now
+            if seq < stream.next_seq or seq in stream.pending:
+                # Redelivered chunk that was already taken
+                _redelivered_total.labels().inc()
+                return []
+            stream.pending[seq] = (properties, body, final)
+            self._hold(stream, len(body))
+
+            ready = []
+            while stream.next_seq in stream.pending:
+                chunk_props, chunk_body, chunk_final = \
+                    stream.pending.pop(stream.next_seq)
+                self._hold(stream, -len(chunk_body))
+                dataframe = _decode(chunk_props, chunk_body)
+                if self.reassemble:
+                    stream.frames.append(dataframe)
+                    self._hold(stream, len(chunk_body))
+                else:
+                    ready.append(StreamChunk(stream_id, stream.next_seq,
+                                             dataframe, chunk_final))
+                stream.next_seq += 1
+                if chunk_final:
+                    ready.extend(self._complete(stream_id, stream))
+                    break
+            self._enforce_limit(stream_id)
+            _buffered_bytes.labels().set(self._bytes)
+            return ready
+
+    def _hold(self, stream, size):
+        stream.bytes += size
+        self._bytes += size
+
+    def _complete(self, stream_id, stream):
+        del self._streams[stream_id]
+        self._bytes -= stream.bytes
+        self._completed[stream_id] = None
+        while len(self._completed) > COMPLETED_KEPT:
+            self._completed.popitem(last=False)
+        _completed_total.labels().inc()
+        if not self.reassemble:
+            return []
+        import pandas as pd
+        frames = stream.frames
+        dataframe = frames[0] if len(frames) == 1 else \
+            pd.concat(frames, ignore_index=True)
+        return [StreamChunk(stream_id, stream.next_seq - 1, dataframe, True)]
+
+    def _drop(self, stream_id, reason):
+        stream = self._streams.pop(stream_id)
+        self._bytes -= stream.bytes
+        self._dropped[stream_id] = reason
+        while len(self._dropped) > DROPPED_KEPT:
+            self._dropped.popitem(last=False)
+        _dropped_total.labels(reason).inc()
+        print("Dropping dataframe stream", stream_id, "(" + reason + ") after",
+              stream.next_seq, "chunks")
+
+    def _enforce_limit(self, current):
+        # The stream being added to goes last, unless it is the only one
+        while self._bytes > self.max_bytes and self._streams:
+            candidates = [s for s in self._streams if s != current]
+            self._drop(candidates[0] if candidates else current, "memory")
+
+    def _expire(self, now):
+        expired = [stream_id for stream_id, stream in self._streams.items()
+                   if now - stream.last_seen > self.timeout]
+        for stream_id in expired:
+            self._drop(stream_id, "timeout")
+        return expired
+
+    def expire(self, now=None):
+        """
+        Drops the streams that received no chunk within the timeout
+        :param now: Current time (time.monotonic). Defaults to now
+        :return: List of the dropped stream ids
+        """
+        with self._lock:
+            expired = self._expire(time.monotonic() if now is None else now)
+            _buffered_bytes.labels().set(self._bytes)
+            return expired
+
+    def next_seq(self, stream_id):
+        """
+        :return: Sequence number of the next chunk a stream waits for, or
+                 None if the stream is not in progress
+        """
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            return None if stream is None else stream.next_seq
+
+    def was_dropped(self, stream_id):
+        """
+        :return: True if the stream was recently dropped before completing
+        """
+        with self._lock:
+            return stream_id in self._dropped
+
+    def incomplete(self):
+        """
+        :return: Number of streams waiting for chunks
+        """
+        with self._lock:
+            return len(self._streams)
@@ -0,0 +1,262 @@
+"""
+@file_name : Deduplicator.py
+@author : Srihari Seshadri
+@description : This file defines a memory bounded index of recently seen
+                keys (e.g. tweet_key) used to drop duplicate messages :
+                1. An exact LRU set of the most recent keys. Only a hit
+                   there makes a message a duplicate
+                2. A rotating Bloom filter covering a much longer history.
+                   It can report new keys as seen, so its hits are only
+                   counted (or used by callers that can afford to drop)
+                3. An optional on-disk snapshot so it survives restarts
+                4. Hit rate statistics
+@date : 12-03-2018
+"""
+
+import hashlib
+import math
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+LRU_SIZE = 100000           # keys remembered exactly
+BLOOM_CAPACITY = 1000000    # keys per Bloom filter generation
+BLOOM_ERROR_RATE = 0.001    # false positive rate of each generation
+SNAPSHOT_EVERY = 10000      # additions between snapshots
+
+# Tweet fields that change when a tweet is seen again. They are part of the
+# key, so a tweet whose counts moved is not a duplicate
+TWEET_MUTABLE_FIELDS = ('retweet_count', 'favorite_count')
+
+_SNAPSHOT_MAGIC = b"RTDD"
+_SNAPSHOT_HEADER = struct.Struct("<4sQQQQ")
+
+
+def tweet_key(tweet, fields=TWEET_MUTABLE_FIELDS):
+    """
+    Dedup key of a tweet : its id_str and the fields that can change
+    :param tweet: Tweet dict
+    :param fields: Mutable fields made part of the key
+    :return: String key, or None if the tweet has no id_str
+    """
+    tweet_id = tweet.get('id_str')
+    if not tweet_id:
+        return None
+    return ":".join([str(tweet_id)] + [str(tweet.get(f)) for f in fields])
+
+
+class RotatingBloomFilter:
+    """
+    Two generations of Bloom filter. New keys go into the current one; once
+    it holds `capacity` keys it becomes the previous one and the old previous
+    one is dropped, so memory stays fixed while the last `capacity` to
+    2 x `capacity` keys are remembered.
+    """
+
+    def __init__(self, capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+                                      (math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity *
+                                           math.log(2))))
+        self.count = 0
+        self.current = bytearray((self.num_bits + 7) // 8)
+        self.previous = bytearray((self.num_bits + 7) // 8)
+        pass
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [(h1 + i * h2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    @staticmethod
+    def _has_all(bits, positions):
+        for pos in positions:
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        return (self._has_all(self.current, positions) or
+                self._has_all(self.previous, positions))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.current[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        if self.count >= self.capacity:
+            self.previous = self.current
+            self.current = bytearray(len(self.previous))
+            self.count = 0
+
+
+class Deduplicator:
+
+    def __init__(self, lru_size=LRU_SIZE,
+                 bloom_capacity=BLOOM_CAPACITY,
+                 error_rate=BLOOM_ERROR_RATE,
+                 snapshot_path=None,
+                 snapshot_every=SNAPSHOT_EVERY):
+        """
+        :param lru_size: Number of recent keys remembered exactly
+        :param bloom_capacity: Keys per Bloom filter generation
+        :param error_rate: False positive rate of the Bloom filter. New keys
+                           hit it with this probability, which is why its
+                           hits do not count as duplicates by default
+        :param snapshot_path: File to restore from and snapshot to. None
+                              keeps the index in memory only
+        :param snapshot_every: Additions between automatic snapshots
+        """
+        self._lock = threading.Lock()
+        self._lru_size = lru_size
+        self._lru = OrderedDict()
+        self._bloom = RotatingBloomFilter(bloom_capacity, error_rate)
+        self._snapshot_path = snapshot_path
+        self._snapshot_every = snapshot_every
+        self._adds_since_snapshot = 0
+
+        self.lookups = 0
+        self.exact_hits = 0
+        self.bloom_hits = 0
+
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            self.load(snapshot_path)
+        pass
+
+    def contains(self, key, probable=False):
+        """
+        Checks whether a key was seen before. A key only the Bloom filter
+        knows is not reported as seen unless `probable` is set : it may be
+        a false positive, and a new message dropped for it is lost. Callers
+        that drop duplicates should let those through to an idempotent
+        write (e.g. an upsert by id)
+        :param key: String key
+        :param probable: Also report keys only the Bloom filter knows
+        :return: True if the key is a duplicate
+        """
+        with self._lock:
+            self.lookups += 1
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.exact_hits += 1
+                return True
+            if key in self._bloom:
+                self.bloom_hits += 1
+                return probable
+            return False
+
+    def add(self, key):
+        """
+        Records a key as seen. Call it once the message has been handled so
+        that a failed message is not suppressed when it is redelivered.
+        :param key: String key
+        :return: None
+        """
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                return
+            self._lru[key] = None
+            if len(self._lru) > self._lru_size:
+                self._lru.popitem(last=False)
+            self._bloom.add(key)
+            self._adds_since_snapshot += 1
+            snapshot_due = (self._snapshot_path is not None and
+                            self._adds_since_snapshot >= self._snapshot_every)
+        if snapshot_due:
+            self.save()
+
+    def check_and_add(self, key):
+        """
+        Checks a key and records it in one step
+        :param key: String key
+        :return: True if the key was already seen
+        """
+        if self.contains(key):
+            return True
+        self.add(key)
+        return False
+
+    def stats(self):
+        """
+        :return: dict with lookups, hits and the hit rate. Hits are the
+                 exact ones; bloom_hits are the probable duplicates that
+                 were let through
+        """
+        hits = self.exact_hits
+        return {"lookups": self.lookups,
+                "hits": hits,
+                "exact_hits": self.exact_hits,
+                "bloom_hits": self.bloom_hits,
+                "hit_rate": hits / self.lookups if self.lookups else 0.0}
+
+    def save(self, path=None):
+        """
+        Writes a snapshot of the index atomically
+        :param path: File to write. Defaults to the snapshot path
+        :return: 1 if success, -1 if failure
+        """
+        path = path or self._snapshot_path
+        try:
+            with self._lock:
+                bloom = self._bloom
+                header = _SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC,
+                                               bloom.capacity,
+                                               bloom.num_bits,
+                                               bloom.num_hashes,
+                                               bloom.count)
+                keys = "\n".join(self._lru).encode("utf-8")
+                parts = [header, bytes(bloom.current), bytes(bloom.previous),
+                         keys]
+                self._adds_since_snapshot = 0
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for part in parts:
+                    f.write(part)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print("Exception caught while saving dedup snapshot :")
+            print(e)
+            return -1
+        stats = self.stats()
+        print("Dedup snapshot saved. Hit rate :",
+              round(100 * stats["hit_rate"], 2), "% of",
+              stats["lookups"], "lookups")
+        return 1
+
+    def load(self, path):
+        """
+        Restores the index from a snapshot written with the same Bloom filter
+        settings
+        :param path: Snapshot file
+        :return: 1 if success, -1 if failure
+        """
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            magic, capacity, num_bits, num_hashes, count = \
+                _SNAPSHOT_HEADER.unpack_from(data, 0)
+            bloom = self._bloom
+            if (magic != _SNAPSHOT_MAGIC or capacity != bloom.capacity or
+                    num_bits != bloom.num_bits or
+                    num_hashes != bloom.num_hashes):
+                print("Dedup snapshot does not match the settings. Ignoring")
+                return -1
+            size = len(bloom.current)
+            start = _SNAPSHOT_HEADER.size
+            with self._lock:
+                bloom.count = count
+                bloom.current = bytearray(data[start:start + size])
+                bloom.previous = bytearray(data[start + size:
+                                                start + 2 * size])
+                keys = data[start + 2 * size:].decode("utf-8")
+                self._lru = OrderedDict.fromkeys(
+                    keys.split("\n")[-self._lru_size:] if keys else [])
+        except Exception as e:
+            print("Exception caught while loading dedup snapshot :")
+            print(e)
+            return -1
+        return 1
@@ -0,0 +1,482 @@
+"""
+@file_name : FakeBroker.py
+@author : Srihari Seshadri
+@description : This file defines an in-process stand-in for the AMQP data
+                hub. It implements the parts of pika's BlockingConnection
+                and BlockingChannel that Messenger and Receiver use, so the
+                real pipeline code can run without a broker :
+                1. Topic, direct and fanout exchanges with queue bindings
+                2. Competing consumers, prefetch, acks/nacks and requeueing
+                3. Publisher confirms, timers and thread-safe callbacks
+                Install it with Transport.set_connection_factory(
+                broker.connection)
+@date : 11-14-2018
+"""
+
+import itertools
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+
+import pika
+from pika import spec
+
+DISPATCH_BATCH = 64     # deliveries per consumer before timers get a turn
+
+_default_broker = None
+_default_broker_lock = threading.Lock()
+
+
+def topic_matches(pattern, routing_key):
+    """
+    AMQP topic matching. '*' matches one word and '#' zero or more words
+    :param pattern: Binding key
+    :param routing_key: Routing key of the message
+    :return: True if the routing key matches the pattern
+    """
+    return _match(pattern.split("."), routing_key.split("."))
+
+
+def _match(words, keys):
+    if not words:
+        return not keys
+    if words[0] == "#":
+        return any(_match(words[1:], keys[i:]) for i in range(len(keys) + 1))
+    if not keys:
+        return False
+    if words[0] == "*" or words[0] == keys[0]:
+        return _match(words[1:], keys[1:])
+    return False
+
+
+class _Queue:
+
+    def __init__(self, name, durable, exclusive_owner):
+        self.name = name
+        self.durable = durable
+        self.exclusive_owner = exclusive_owner
+        self.messages = deque()
+        self.consumers = []
+        pass
+
+
+class FakeBroker:
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.RLock())
+        self._exchanges = {"": "direct"}
+        self._bindings = []         # (exchange, binding key, queue name)
+        self._queues = {}
+        self._names = itertools.count(1)
+        self.published = 0
+        pass
+
+    def connection(self, parameters=None):
+        """
+        Connection factory with the signature of pika.BlockingConnection
+        :param parameters: pika.ConnectionParameters (ignored)
+        :return: FakeConnection
+        """
+        return FakeConnection(self)
+
+    # Broker side operations. All of them run under the broker lock.
+
+    def declare_exchange(self, name, ex_type):
+        with self._cond:
+            self._exchanges.setdefault(name, ex_type)
+
+    def declare_queue(self, name, passive, durable, exclusive, owner):
+        with self._cond:
+            if passive:
+                if name not in self._queues:
+                    raise pika.exceptions.ChannelClosed(
+                        404, "NOT_FOUND - no queue '" + name + "'")
+                return self._queues[name]
+            if name == "":
+                name = "amq.gen-" + str(next(self._names))
+            queue = self._queues.get(name)
+            if queue is None:
+                queue = _Queue(name, durable, owner if exclusive else None)
+                self._queues[name] = queue
+            return queue
+
+    def bind(self, exchange, queue, routing_key):
+        with self._cond:
+            binding = (exchange, routing_key, queue)
+            if binding not in self._bindings:
+                self._bindings.append(binding)
+
+    def bound_queues(self, exchange, routing_key):
+        with self._cond:
+            return [name for ex, key, name in self._bindings
+                    if ex == exchange and name in self._queues and
+                    topic_matches(key, routing_key)]
+
+    def route(self, exchange, routing_key, body, properties):
+        """
+        Puts a message on every queue bound to the exchange that matches
+        :return: Number of queues the message was routed to
+        """
+        with self._cond:
+            self.published += 1
+            ex_type = self._exchanges.get(exchange)
+            if exchange == "":
+                targets = [routing_key] if routing_key in self._queues else []
+            elif ex_type == "fanout":
+                targets = [name for ex, _, name in self._bindings
+                           if ex == exchange]
+            elif ex_type == "direct":
+                targets = [name for ex, key, name in self._bindings
+                           if ex == exchange and key == routing_key]
+            else:
+                targets = [name for ex, key, name in self._bindings
+                           if ex == exchange and
+                           topic_matches(key, routing_key)]
+            for name in set(targets):
+                queue = self._queues.get(name)
+                if queue is not None:
+                    queue.messages.append((exchange, routing_key, body,
+                                           properties, False))
+            self._cond.notify_all()
+            return len(targets)
+
+    def requeue(self, queue_name, message):
+        with self._cond:
+            queue = self._queues.get(queue_name)
+            if queue is not None:
+                exchange, routing_key, body, properties, _ = message
+                queue.messages.appendleft((exchange, routing_key, body,
+                                           properties, True))
+            self._cond.notify_all()
+
+    def drop_owned_queues(self, owner):
+        with self._cond:
+            names = [name for name, queue in self._queues.items()
+                     if queue.exclusive_owner is owner]
+            for name in names:
+                del self._queues[name]
+            self._bindings = [b for b in self._bindings if b[2] not in names]
+
+    def queue_depth(self, queue_name):
+        with self._cond:
+            queue = self._queues.get(queue_name)
+            return len(queue.messages) if queue is not None else 0
+
+    def wait_for_consumers(self, exchange, routing_key, count=1, timeout=10):
+        """
+        Blocks until `count` consumers are listening for a routing key.
+        Useful to avoid publishing before the pipeline has subscribed.
+        :return: True if the consumers showed up in time
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            while True:
+                consumers = sum(len(self._queues[name].consumers)
+                                for name in self.bound_queues(exchange,
+                                                              routing_key))
+                if consumers >= count:
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+
+
+class FakeConnection:
+
+    def __init__(self, broker):
+        self._broker = broker
+        self._channels = []
+        self._callbacks = deque()
+        self._timers = {}
+        self._timer_ids = itertools.count(1)
+        self.is_open = True
+        self.is_closed = False
+        pass
+
+    def channel(self, channel_number=None):
+        channel = FakeChannel(self._broker, self)
+        self._channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback):
+        with self._broker._cond:
+            self._callbacks.append(callback)
+            self._broker._cond.notify_all()
+
+    def add_timeout(self, deadline, callback_method):
+        timer_id = next(self._timer_ids)
+        self._timers[timer_id] = (time.time() + deadline, callback_method)
+        return timer_id
+
+    call_later = add_timeout
+
+    def remove_timeout(self, timeout_id):
+        self._timers.pop(timeout_id, None)
+
+    def _run_ready(self):
+        """
+        Runs due timers, thread-safe callbacks and pending deliveries
+        :return: Number of events processed
+        """
+        events = 0
+        now = time.time()
+        for timer_id, (due, callback) in sorted(self._timers.items(),
+                                                key=lambda t: t[1][0]):
+            if due <= now:
+                del self._timers[timer_id]
+                callback()
+                events += 1
+
+        while True:
+            with self._broker._cond:
+                if not self._callbacks:
+                    break
+                callback = self._callbacks.popleft()
+            callback()
+            events += 1
+
+        for channel in list(self._channels):
+            events += channel._dispatch()
+        return events
+
+    def _next_wait(self, deadline):
+        waits = [due - time.time() for due, _ in self._timers.values()]
+        if deadline is not None:
+            waits.append(deadline - time.time())
+        return max(0.0, min(waits)) if waits else None
+
+    def process_data_events(self, time_limit=0):
+        """
+        Processes ready events. With time_limit=None this blocks until at
+        least one event was processed, otherwise it returns after processing
+        events or once time_limit seconds have passed.
+        """
+        deadline = None if time_limit is None else time.time() + time_limit
+        while self.is_open:
+            if self._run_ready():
+                return
+            if deadline is not None and time.time() >= deadline:
+                return
+            with self._broker._cond:
+                if not self._callbacks and not self._has_deliveries():
+                    self._broker._cond.wait(self._next_wait(deadline))
+
+    def _has_deliveries(self):
+        return any(channel._can_deliver() for channel in self._channels)
+
+    def sleep(self, duration):
+        self.process_data_events(time_limit=duration)
+
+    def close(self):
+        if not self.is_open:
+            return
+        for channel in self._channels:
+            channel.close()
+        self._broker.drop_owned_queues(self)
+        self.is_open = False
+        self.is_closed = True
+
+
+class FakeChannel:
+
+    def __init__(self, broker, connection):
+        self._broker = broker
+        self._connection = connection
+        self._consumers = {}    # tag -> (queue name, callback, no_ack)
+        self._consumer_tags = itertools.count(1)
+        self._delivery_tags = itertools.count(1)
+        self._unacked = {}      # delivery tag -> (queue name, message)
+        self._prefetch = 0
+        self._confirm_callback = None
+        self._publish_tags = itertools.count(1)
+        self._consuming = False
+        self.is_open = True
+        self.is_closed = False
+        # Messenger pipelines confirms on the underlying pika channel; the
+        # fake channel plays both roles
+        self._impl = self
+        pass
+
+    @property
+    def connection(self):
+        return self._connection
+
+    def exchange_declare(self, exchange=None, exchange_type='direct',
+                         passive=False, durable=False, auto_delete=False,
+                         internal=False, arguments=None, callback=None):
+        self._broker.declare_exchange(exchange, exchange_type)
+        return SimpleNamespace(method=spec.Exchange.DeclareOk())
+
+    def queue_declare(self, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None,
+                      callback=None):
+        declared = self._broker.declare_queue(queue, passive, durable,
+                                              exclusive, self._connection)
+        return SimpleNamespace(method=spec.Queue.DeclareOk(
+            queue=declared.name,
+            message_count=len(declared.messages),
+            consumer_count=len(declared.consumers)))
+
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None,
+                   callback=None):
+        self._broker.bind(exchange, queue, routing_key or queue)
+        return SimpleNamespace(method=spec.Queue.BindOk())
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0,
+                  all_channels=False, callback=None):
+        self._prefetch = prefetch_count
+
+    def basic_consume(self, consumer_callback, queue, no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        consumer_tag = consumer_tag or "ctag-" + str(next(
+            self._consumer_tags))
+        with self._broker._cond:
+            self._consumers[consumer_tag] = (queue, consumer_callback,
+                                             no_ack)
+            self._broker._queues[queue].consumers.append(consumer_tag)
+            self._broker._cond.notify_all()
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag=None):
+        with self._broker._cond:
+            queue_name, _, _ = self._consumers.pop(consumer_tag)
+            queue = self._broker._queues.get(queue_name)
+            if queue is not None and consumer_tag in queue.consumers:
+                queue.consumers.remove(consumer_tag)
+
+    def confirm_delivery(self, callback=None, nowait=False):
+        self._confirm_callback = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self._broker.route(exchange, routing_key, body,
+                           properties or pika.BasicProperties())
+        if self._confirm_callback is not None:
+            frame = SimpleNamespace(method=spec.Basic.Ack(
+                delivery_tag=next(self._publish_tags), multiple=False))
+            callback = self._confirm_callback
+            self._connection.add_callback_threadsafe(lambda: callback(frame))
+        return True
+
+    def _settle(self, delivery_tag, multiple, requeue=None):
+        with self._broker._cond:
+            if multiple:
+                tags = [t for t in self._unacked if t <= delivery_tag]
+            else:
+                tags = [delivery_tag] if delivery_tag in self._unacked else []
+            for tag in tags:
+                queue_name, message = self._unacked.pop(tag)
+                if requeue:
+                    self._broker.requeue(queue_name, message)
+            self._broker._cond.notify_all()
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        self._settle(delivery_tag, multiple, requeue)
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self._settle(delivery_tag, False, requeue)
+
+    def _can_deliver(self):
+        if self._prefetch and len(self._unacked) >= self._prefetch:
+            return False
+        for queue_name, _, _ in self._consumers.values():
+            queue = self._broker._queues.get(queue_name)
+            if queue is not None and queue.messages:
+                return True
+        return False
+
+    def _dispatch(self):
+        """
+        Delivers queued messages to this channel's consumers, respecting the
+        prefetch window. Runs on the thread that owns the connection.
+        :return: Number of messages delivered
+        """
+        delivered = 0
+        for consumer_tag, (queue_name, callback, no_ack) in \
+                list(self._consumers.items()):
+            for _ in range(DISPATCH_BATCH):
+                with self._broker._cond:
+                    if (self._prefetch and
+                            len(self._unacked) >= self._prefetch):
+                        return delivered
+                    queue = self._broker._queues.get(queue_name)
+                    if queue is None or not queue.messages:
+                        break
+                    message = queue.messages.popleft()
+                    delivery_tag = next(self._delivery_tags)
+                    if not no_ack:
+                        self._unacked[delivery_tag] = (queue_name, message)
+                exchange, routing_key, body, properties, redelivered = message
+                method = spec.Basic.Deliver(consumer_tag=consumer_tag,
+                                            delivery_tag=delivery_tag,
+                                            redelivered=redelivered,
+                                            exchange=exchange,
+                                            routing_key=routing_key)
+                callback(self, method, properties, body)
+                delivered += 1
+        return delivered
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and self._consumers and self.is_open:
+            self._connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self, consumer_tag=None):
+        self._consuming = False
+        for tag in list(self._consumers):
+            self.basic_cancel(tag)
+
+    def consume(self, queue, no_ack=False, exclusive=False, arguments=None,
+                inactivity_timeout=None):
+        """
+        Generator interface of BlockingChannel.consume. Yields
+        (method, properties, body), or (None, None, None) after
+        inactivity_timeout seconds without a message.
+        """
+        received = deque()
+        self.basic_consume(lambda ch, m, p, b: received.append((m, p, b)),
+                           queue=queue, no_ack=no_ack)
+        self._consuming = True
+        while self._consuming and self.is_open:
+            if not received:
+                self._connection.process_data_events(
+                    time_limit=inactivity_timeout)
+            if received:
+                yield received.popleft()
+            elif inactivity_timeout is not None:
+                yield None, None, None
+
+    def cancel(self):
+        self.stop_consuming()
+        return 0
+
+    def close(self):
+        if not self.is_open:
+            return
+        with self._broker._cond:
+            for tag in list(self._consumers):
+                self.basic_cancel(tag)
+            for tag in sorted(self._unacked, reverse=True):
+                queue_name, message = self._unacked.pop(tag)
+                self._broker.requeue(queue_name, message)
+        self.is_open = False
+        self.is_closed = True
+
+
+def get_broker():
+    """
+    Returns the process wide broker used by the "fake" transport
+    :return: FakeBroker object
+    """
+    global _default_broker
+    with _default_broker_lock:
+        if _default_broker is None:
+            _default_broker = FakeBroker()
+    return _default_broker
@@ -0,0 +1,141 @@
+"""
+@file_name : MessageCodec.py
+@author : Srihari Seshadri
+@description : This file defines how non-dataframe messages travel on the
+                data hub :
+                1. Projects messages onto the fields a topic declares
+                2. Encodes them as JSON or msgpack
+                3. Compresses large bodies with zlib or zstd
+                4. Decodes all of the above based on the message properties
+@date : 11-14-2018
+"""
+
+import json
+import time
+import zlib
+
+import Metrics
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ENCODING_JSON = "json"
+ENCODING_MSGPACK = "msgpack"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_ZSTD = "zstd"
+
+CONTENT_TYPES = {ENCODING_JSON: "application/json",
+                 ENCODING_MSGPACK: "application/msgpack"}
+COMPRESS_THRESHOLD = 1024   # bytes. Smaller bodies are sent as they are
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+_decode_seconds = Metrics.histogram(
+    "rtis_decode_seconds", "Time taken to decompress and decode a message",
+    ("content_type",))
+
+
+def project(message, fields):
+    """
+    Keeps only the declared fields of a message
+    :param message: dict
+    :param fields: List of field names, or None to keep everything
+    :return: dict
+    """
+    if fields is None:
+        return message
+    return {field: message.get(field) for field in fields}
+
+
+def compress(body, compression):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(body, ZLIB_LEVEL)
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard "
+                              "package")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    raise ValueError("Unknown compression : " + str(compression))
+
+
+def decompress(body, content_encoding):
+    """
+    Reverses compress() based on the content_encoding property
+    :param body: Byte stream of the content in
+    :param content_encoding: content_encoding of the message (or None)
+    :return: bytes
+    """
+    if not content_encoding:
+        return body
+    if content_encoding == COMPRESSION_ZLIB:
+        return zlib.decompress(body)
+    if content_encoding == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard "
+                              "package")
+        return zstandard.ZstdDecompressor().decompress(body)
+    raise ValueError("Unknown content encoding : " + str(content_encoding))
+
+
+def encode(message, encoding=None, compression=None,
+           threshold=COMPRESS_THRESHOLD):
+    """
+    Turns a message into a body
+    :param message: str/bytes (sent as is) or a JSON-able object
+    :param encoding: ENCODING_JSON or ENCODING_MSGPACK for objects.
+                     Defaults to JSON
+    :param compression: None, COMPRESSION_ZLIB or COMPRESSION_ZSTD
+    :param threshold: Only compress bodies of at least this many bytes
+    :return: (body, content_type, content_encoding)
+    """
+    content_type = None
+    if isinstance(message, str):
+        body = message.encode("utf-8")
+    elif isinstance(message, bytes):
+        body = message
+    else:
+        encoding = encoding or ENCODING_JSON
+        if encoding == ENCODING_MSGPACK:
+            if msgpack is None:
+                raise ImportError("msgpack encoding requires the msgpack "
+                                  "package")
+            body = msgpack.packb(message, use_bin_type=True)
+        else:
+            body = json.dumps(message).encode("utf-8")
+        content_type = CONTENT_TYPES[encoding]
+
+    content_encoding = None
+    if compression and len(body) >= threshold:
+        body = compress(body, compression)
+        content_encoding = compression
+    return body, content_type, content_encoding
+
+
+def loads(body, properties=None):
+    """
+    Decodes a message body into a python object, whatever its encoding or
+    compression. Bodies without a content type are read as JSON text.
+    :param body: Byte stream of the content in
+    :param properties: pika BasicProperties of the message
+    :return: Decoded object
+    """
+    start = time.perf_counter()
+    content_type = getattr(properties, "content_type", None)
+    body = decompress(body, getattr(properties, "content_encoding", None))
+    if content_type == CONTENT_TYPES[ENCODING_MSGPACK]:
+        if msgpack is None:
+            raise ImportError("msgpack encoding requires the msgpack "
+                              "package")
+        message = msgpack.unpackb(body, raw=False)
+    else:
+        message = json.loads(body.decode("utf-8"))
+    _decode_seconds.labels(content_type or ENCODING_JSON).observe(
+        time.perf_counter() - start)
+    return message
@@ -7,8 +7,30 @@
 @date : 11-14-2018
 """
 
+import time
+import uuid
 import pika
-import pandas as pd
+import DataFrameCodec
+import MessageCodec
+import Metrics
+import Transport
+
+MAX_IN_FLIGHT = 256         # unconfirmed messages allowed per batch
+CONFIRM_TIMEOUT = 30        # seconds to wait for the broker to confirm
+CONFIRM_POLL_INTERVAL = 0.001   # seconds
+
+_publish_seconds = Metrics.histogram(
+    "rtis_publish_seconds",
+    "Time taken to serialise and publish one message", ("topic",))
+_publish_batch_seconds = Metrics.histogram(
+    "rtis_publish_batch_seconds",
+    "Time taken by publish_batch to publish and confirm a batch")
+_published_total = Metrics.counter(
+    "rtis_messages_published_total", "Messages published", ("topic",))
+_publish_failures_total = Metrics.counter(
+    "rtis_publish_failures_total",
+    "Messages that failed to publish or were not acked by the broker",
+    ("topic",))
 
 
 class Messenger:
@@ -16,6 +38,12 @@ class Messenger:
     def __init__(self):
         self._connection = None
         self._channel = None
+        self._confirm_channel = None
+        self._blocking_confirm_channel = None
+        self._publish_seq = 0
+        self._unconfirmed = {}
+        self._conn_params = None
+        self._declared_exchanges = set()
         pass
 
     def connect(self, host='localhost', port=5672,
@@ -28,11 +56,17 @@ class Messenger:
         :param pwd: password for user
         :return: 1 if success, -1 if failure
         """
+        self._conn_params = dict(host=host, port=port, uname=uname, pwd=pwd)
+        # Declarations and confirm state belong to the old connection
+        self._declared_exchanges = set()
+        self._confirm_channel = None
+        self._blocking_confirm_channel = None
+        self._unconfirmed = {}
         try:
             # Make a credentials object
             credentials = pika.PlainCredentials(uname, pwd)
             # First establish the connection
-            self._connection = pika.BlockingConnection(
+            self._connection = Transport.open_connection(
                 pika.ConnectionParameters(
                     host=host,
                     port=port,
@@ -52,6 +86,9 @@ class Messenger:
         :param ex_type: Type of the exchange
         :return: 1 if success, -1 if failure
         """
+        # Only declare each exchange once per connection
+        if (ex_name, ex_type) in self._declared_exchanges:
+            return 1
         try:
             self._channel.exchange_declare(exchange=ex_name,
                                            exchange_type=ex_type)
@@ -59,39 +96,392 @@ class Messenger:
             print("Exception caught while trying to connect to exchange :")
             print(e)
             return -1
+        self._declared_exchanges.add((ex_name, ex_type))
         return 1
 
-    def send_message_to_exchange(self, ex_name="", message="", topic=""):
+    def is_connected(self):
+        """
+        Checks the health of the connection and the channel
+        :return: True if both are open
+        """
+        return (self._connection is not None and
+                self._connection.is_open and
+                self._channel is not None and
+                self._channel.is_open)
+
+    def reconnect(self):
+        """
+        Re-establishes the connection with the parameters last passed to
+        connect(). Exchanges have to be declared again afterwards.
+        :return: 1 if success, -1 if failure
+        """
+        if self._conn_params is None:
+            return -1
+        self.disconnect()
+        return self.connect(**self._conn_params)
+
+    def ensure_connected(self):
+        """
+        Reconnects if the connection or channel has gone away
+        :return: 1 if connected, -1 if failure
+        """
+        if self.is_connected():
+            return 1
+        return self.reconnect()
+
+    def send_message_to_exchange(self, ex_name="", message="", topic="",
+                                 df_format=DataFrameCodec.FORMAT_COLUMNAR,
+                                 encoding=None, compression=None,
+                                 headers=None):
         """
         Sends a message to the exchange with a specific topic
         :param ex_name: Name of the exchange to send to (NOTE: exchange must
                         already exist for this to be a success)
-        :param message: String object containing the message
+        :param message: String object containing the message, or an object
+                        to encode (dict, dataframe)
         :param topic: Topic of the message
+        :param df_format: Wire format for dataframe topics. Use
+                          DataFrameCodec.FORMAT_TEXT to talk to text-mode peers
+        :param encoding: MessageCodec.ENCODING_JSON (default) or
+                         ENCODING_MSGPACK for non-string messages
+        :param compression: None, MessageCodec.COMPRESSION_ZLIB or
+                            COMPRESSION_ZSTD. Bodies smaller than
+                            MessageCodec.COMPRESS_THRESHOLD are not compressed
+        :param headers: Extra AMQP headers. Pass on the x-origin-at header of
+                        a consumed message to keep its end-to-end age
         :return: 1 if success, -1 if failure
         """
+        start = time.perf_counter()
+        try:
+            body, properties = self._build_message(message, topic, df_format,
+                                                   encoding, compression,
+                                                   headers)
+            self._channel.basic_publish(exchange=ex_name,
+                                        routing_key=topic,
+                                        body=body,
+                                        properties=properties)
+        except Exception as e:
+            print("Exception caught while trying to send message :")
+            print(e)
+            _publish_failures_total.labels(topic).inc()
+            return -1
+        _publish_seconds.labels(topic).observe(time.perf_counter() - start)
+        _published_total.labels(topic).inc()
+        return 1
 
-        # Use the topic to see if we are sending a dataframe
+    def publish_raw(self, ex_name, body, topic, properties=None):
+        """
+        Sends an already encoded body with its properties, e.g. recorded
+        traffic. The publish and origin times are stamped anew, so latency
+        metrics downstream measure this run
+        :param ex_name: Name of the exchange to send to
+        :param body: Bytes as received from the data hub
+        :param topic: Routing key
+        :param properties: pika BasicProperties of the original message
+        :return: 1 if success, -1 if failure
+        """
+        start = time.perf_counter()
         try:
-            if "__df" in topic:
-                self._channel.basic_publish(exchange=ex_name,
-                                            routing_key=topic,
-                                            body=message.to_string())
-            else:
-                self._channel.basic_publish(exchange=ex_name,
-                                            routing_key=topic,
-                                            body=message)
+            now = time.time()
+            headers = dict(getattr(properties, "headers", None) or {})
+            headers[Metrics.SENT_AT_HEADER] = now
+            headers[Metrics.ORIGIN_AT_HEADER] = now
+            self._channel.basic_publish(
+                exchange=ex_name,
+                routing_key=topic,
+                body=body,
+                properties=pika.BasicProperties(
+                    content_type=getattr(properties, "content_type", None),
+                    content_encoding=getattr(properties, "content_encoding",
+                                             None),
+                    headers=headers))
         except Exception as e:
             print("Exception caught while trying to send message :")
             print(e)
+            _publish_failures_total.labels(topic).inc()
+            return -1
+        _publish_seconds.labels(topic).observe(time.perf_counter() - start)
+        _published_total.labels(topic).inc()
+        return 1
+
+    def publish_batch(self, ex_name, messages, topic="",
+                      max_in_flight=MAX_IN_FLIGHT, timeout=CONFIRM_TIMEOUT,
+                      df_format=DataFrameCodec.FORMAT_COLUMNAR,
+                      encoding=None, compression=None, headers=None):
+        """
+        Publishes many messages on one channel with publisher confirms. Up to
+        max_in_flight messages are left unconfirmed before the publisher
+        waits on the broker, so throughput is bound by the broker and not by
+        a fixed delay between messages.
+        :param ex_name: Name of the exchange to send to (NOTE: exchange must
+                        already exist for this to be a success)
+        :param messages: List of messages (strings or dataframes)
+        :param topic: Topic of the messages, or a list with one topic per
+                      message
+        :param max_in_flight: Maximum number of unconfirmed messages. With 1,
+                              every publish waits for its confirm on a
+                              plain blocking channel
+        :param timeout: Seconds to wait for all confirms to arrive
+        :param df_format: Wire format for dataframe topics
+        :param encoding: Encoding of non-string messages
+        :param compression: Compression of large bodies
+        :param headers: Extra AMQP headers added to every message, or a
+                        list with one dict per message
+        :return: List with one entry per message : True if the broker acked
+                 it, False if it was nacked, None if it was never confirmed
+        """
+        results = [None] * len(messages)
+        start = time.perf_counter()
+        deadline = time.time() + timeout
+        if isinstance(topic, str):
+            topics = [topic] * len(messages)
+        else:
+            topics = list(topic)
+        if headers is None or isinstance(headers, dict):
+            headers = [headers] * len(messages)
+        if max_in_flight <= 1:
+            self._publish_one_by_one(ex_name, messages, topics, headers,
+                                     results, df_format, encoding,
+                                     compression)
+        else:
+            self._publish_pipelined(ex_name, messages, topics, headers,
+                                    results, max_in_flight, deadline,
+                                    df_format, encoding, compression)
+
+        _publish_batch_seconds.labels().observe(time.perf_counter() - start)
+        for topic_name, result in zip(topics, results):
+            if result is True:
+                _published_total.labels(topic_name).inc()
+            else:
+                _publish_failures_total.labels(topic_name).inc()
+        return results
+
+    def send_dataframe_stream(self, ex_name, dframe, topic,
+                              chunk_rows=DataFrameCodec.CHUNK_ROWS,
+                              compression=None, headers=None,
+                              stream_id=None):
+        """
+        Sends a large dataframe as a stream of row batch messages, each
+        within the broker's frame limits. The receiver can process the
+        chunks as they arrive or reassemble the frame (see
+        Receiver.get_dataframe_stream). Chunks are published with confirms.
+        :param ex_name: Name of the exchange to send to
+        :param dframe: Dataframe to send
+        :param topic: Topic of the chunks. Must contain "__df"
+        :param chunk_rows: Rows per chunk
+        :param compression: Compression of large chunks
+        :param headers: Extra AMQP headers added to every chunk
+        :param stream_id: Id of the stream. Generated if None
+        :return: 1 if every chunk was confirmed, -1 otherwise
+        """
+        if "__df" not in topic:
+            raise ValueError("Dataframe streams need a __df topic, got " +
+                             topic)
+        stream_id = stream_id or uuid.uuid4().hex
+        chunks = list(DataFrameCodec.split(dframe, chunk_rows))
+        chunk_headers = []
+        for seq in range(len(chunks)):
+            chunk_header = dict(headers) if headers else {}
+            chunk_header.update(DataFrameCodec.stream_headers(
+                stream_id, seq, seq == len(chunks) - 1))
+            chunk_headers.append(chunk_header)
+        # Chunks are encoded one at a time as the confirm window allows, so
+        # only the slices (views of the frame) are held up front
+        results = self.publish_batch(ex_name=ex_name,
+                                     messages=chunks,
+                                     topic=topic,
+                                     compression=compression,
+                                     headers=chunk_headers)
+        if not all(result is True for result in results):
+            print("Dataframe stream", stream_id, ":",
+                  sum(1 for result in results if result is not True),
+                  "of", len(results), "chunks were not confirmed")
             return -1
         return 1
 
+    def _publish_pipelined(self, ex_name, messages, topics, headers,
+                           results, max_in_flight, deadline, df_format,
+                           encoding, compression):
+        """
+        Publishes on the confirm channel with up to max_in_flight messages
+        waiting for their confirms
+        :return: None. Fills results in place
+        """
+        try:
+            channel = self._get_confirm_channel()
+            for i, message in enumerate(messages):
+                # Wait for the window to open up before publishing more
+                while len(self._unconfirmed) >= max_in_flight:
+                    if time.time() > deadline:
+                        raise TimeoutError("Timed out waiting for confirms")
+                    self._connection.process_data_events(
+                        time_limit=CONFIRM_POLL_INTERVAL)
+
+                body, properties = self._build_message(message, topics[i],
+                                                       df_format, encoding,
+                                                       compression,
+                                                       headers[i])
+                self._publish_seq += 1
+                self._unconfirmed[self._publish_seq] = (results, i)
+                channel.basic_publish(exchange=ex_name,
+                                      routing_key=topics[i],
+                                      body=body,
+                                      properties=properties)
+
+            # Drain the remaining confirms
+            while self._unconfirmed and time.time() < deadline:
+                self._connection.process_data_events(
+                    time_limit=CONFIRM_POLL_INTERVAL)
+        except Exception as e:
+            print("Exception caught while trying to send batch :")
+            print(e)
+            # The channel may be closed or left waiting for confirms that
+            # will never come : the next batch opens a fresh one
+            self._drop_confirm_channel()
+        # Anything left over is reported as unconfirmed
+        self._unconfirmed.clear()
+
+    def _publish_one_by_one(self, ex_name, messages, topics, headers,
+                            results, df_format, encoding, compression):
+        """
+        Publishes with BlockingChannel confirms, waiting for the broker after
+        every message
+        :return: None. Fills results in place
+        """
+        try:
+            channel = self._blocking_confirm_channel
+            if channel is None or not channel.is_open:
+                channel = self._connection.channel()
+                channel.confirm_delivery()
+                self._blocking_confirm_channel = channel
+            for i, message in enumerate(messages):
+                body, properties = self._build_message(message, topics[i],
+                                                       df_format, encoding,
+                                                       compression,
+                                                       headers[i])
+                # False if the broker nacked the message
+                results[i] = channel.basic_publish(exchange=ex_name,
+                                                   routing_key=topics[i],
+                                                   body=body,
+                                                   properties=properties)
+        except Exception as e:
+            print("Exception caught while trying to send batch :")
+            print(e)
+            self._blocking_confirm_channel = None
+
+    def _get_confirm_channel(self):
+        """
+        Opens a dedicated channel in confirm mode, again if the last one was
+        closed. BlockingChannel in pika 0.13 waits for the confirm of every
+        publish, so the underlying asynchronous channel is used to pipeline
+        publishes and count the confirms as they come back.
+        :return: pika channel
+        """
+        if self._confirm_channel is not None and \
+                not self._confirm_channel.is_open:
+            self._drop_confirm_channel()
+        if self._confirm_channel is None:
+            blocking_channel = self._connection.channel()
+            channel = blocking_channel._impl
+            channel.confirm_delivery(
+                callback=self._on_delivery_confirmation)
+            self._confirm_channel = channel
+            self._publish_seq = 0
+        return self._confirm_channel
+
+    def _drop_confirm_channel(self):
+        """
+        Forgets the confirm channel, closing it if it is still open, so that
+        the next batch starts over on a new one
+        :return: None
+        """
+        channel, self._confirm_channel = self._confirm_channel, None
+        self._unconfirmed.clear()
+        try:
+            if channel is not None and channel.is_open:
+                channel.close()
+        except Exception as e:
+            print("Exception caught while closing the confirm channel :")
+            print(e)
+
+    def _on_delivery_confirmation(self, frame):
+        """
+        Called by pika when the broker acks or nacks published messages
+        :param frame: pika method frame holding a Basic.Ack or Basic.Nack
+        :return: None
+        """
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed
+                    if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            entry = self._unconfirmed.pop(tag, None)
+            if entry is not None:
+                results, index = entry
+                results[index] = acked
+
+    @staticmethod
+    def _build_message(message, topic,
+                       df_format=DataFrameCodec.FORMAT_COLUMNAR,
+                       encoding=None, compression=None, headers=None):
+        """
+        Serialises the message into a body and its properties. Every message
+        is stamped with its publish time, and with an origin time unless the
+        caller passes one on.
+        :param message: String object, JSON-able object or dataframe
+        :param topic: Topic of the message
+        :param df_format: Wire format for dataframe topics
+        :param encoding: MessageCodec.ENCODING_JSON or ENCODING_MSGPACK for
+                         non-string messages
+        :param compression: None, MessageCodec.COMPRESSION_ZLIB or
+                            COMPRESSION_ZSTD. Applied above a size threshold
+        :param headers: Extra AMQP headers
+        :return: (body, pika.BasicProperties)
+        """
+        now = time.time()
+        headers = dict(headers) if headers else {}
+        headers[Metrics.SENT_AT_HEADER] = now
+        if headers.get(Metrics.ORIGIN_AT_HEADER) is None:
+            headers[Metrics.ORIGIN_AT_HEADER] = now
+
+        # Use the topic to see if we are sending a dataframe
+        if "__df" in topic:
+            body, df_headers = DataFrameCodec.dumps(message, df_format)
+            headers.update(df_headers)
+            content_type = None
+            if df_format == DataFrameCodec.FORMAT_COLUMNAR:
+                content_type = DataFrameCodec.CONTENT_TYPE
+            content_encoding = None
+            if (compression and
+                    len(body) >= MessageCodec.COMPRESS_THRESHOLD):
+                if isinstance(body, str):
+                    body = body.encode("utf-8")
+                body = MessageCodec.compress(body, compression)
+                content_encoding = compression
+            return body, pika.BasicProperties(
+                content_type=content_type,
+                content_encoding=content_encoding,
+                headers=headers)
+
+        body, content_type, content_encoding = MessageCodec.encode(
+            message, encoding=encoding, compression=compression)
+        return body, pika.BasicProperties(content_type=content_type,
+                                          content_encoding=content_encoding,
+                                          headers=headers)
+
     def disconnect(self):
-        self._connection.close()
+        try:
+            if self._connection is not None and self._connection.is_open:
+                self._connection.close()
+        except Exception as e:
+            print("Exception caught while closing connection :")
+            print(e)
 
     def __del__(self):
-        self._connection.close()
+        self.disconnect()
 
 
 
@@ -0,0 +1,160 @@
+"""
+@file_name : MessengerPool.py
+@author : Srihari Seshadri
+@description : This file defines a process wide pool of Messengers so that
+                consumers which republish (e.g. the cleaner) can reuse
+                long lived connections :
+                1. Hands out connected Messengers, one thread at a time
+                2. Checks channel health and reconnects transparently
+                3. Keeps idle Messengers (and their declared exchanges) alive
+@date : 12-03-2018
+"""
+
+import threading
+from contextlib import contextmanager
+from Messenger import Messenger
+
+MAX_IDLE = 8    # idle messengers kept per pool
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class MessengerPool:
+
+    def __init__(self, host='localhost', port=5672,
+                 uname="guest", pwd="guest", max_idle=MAX_IDLE):
+        self._conn_params = dict(host=host, port=port, uname=uname, pwd=pwd)
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        pass
+
+    def _checkout(self):
+        """
+        Takes an idle messenger, or makes a new one, and makes sure it is
+        connected
+        :return: Messenger object
+        """
+        with self._lock:
+            messenger = self._idle.pop() if self._idle else None
+
+        if messenger is None:
+            messenger = Messenger()
+            ret = messenger.connect(**self._conn_params)
+        else:
+            ret = messenger.ensure_connected()
+
+        if ret != 1:
+            raise ConnectionError("Could not connect to the data hub at " +
+                                  str(self._conn_params["host"]))
+        return messenger
+
+    def _checkin(self, messenger):
+        """
+        Returns a messenger to the pool
+        :param messenger: Messenger object
+        :return: None
+        """
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(messenger)
+                return
+        messenger.disconnect()
+
+    @contextmanager
+    def acquire(self):
+        """
+        Lends a connected messenger to the calling thread. Messengers that
+        raise while in use are dropped instead of being returned.
+        :return: Messenger object
+        """
+        messenger = self._checkout()
+        try:
+            yield messenger
+        except Exception:
+            messenger.disconnect()
+            raise
+        self._checkin(messenger)
+
+    def publish(self, ex_name, message, topic, ex_type='topic', **options):
+        """
+        Sends one message through a pooled messenger. The exchange is only
+        declared the first time a connection sees it, and a failed send is
+        retried once on a fresh connection.
+        :param ex_name: Name of the exchange to send to
+        :param message: String object containing the message
+        :param topic: Topic of the message
+        :param ex_type: Type of the exchange
+        :param options: Passed on to Messenger.send_message_to_exchange
+                        (e.g. encoding, compression)
+        :return: 1 if success, -1 if failure
+        """
+        with self.acquire() as messenger:
+            for attempt in range(2):
+                if attempt > 0 and messenger.reconnect() != 1:
+                    break
+                if messenger.connect_to_exchange(ex_name=ex_name,
+                                                 ex_type=ex_type) != 1:
+                    continue
+                if messenger.send_message_to_exchange(ex_name=ex_name,
+                                                      message=message,
+                                                      topic=topic,
+                                                      **options) == 1:
+                    return 1
+        return -1
+
+    def publish_batch(self, ex_name, messages, topic, ex_type='topic',
+                      **options):
+        """
+        Sends many messages with pipelined confirms through a pooled
+        messenger. If the exchange cannot be declared, it is tried once more
+        on a fresh connection.
+        :param ex_name: Name of the exchange to send to
+        :param messages: List of messages
+        :param topic: Topic of the messages, or a list with one per message
+        :param ex_type: Type of the exchange
+        :param options: Passed on to Messenger.publish_batch (e.g. headers,
+                        encoding, compression)
+        :return: List with one entry per message : True if the broker acked
+                 it, False or None otherwise
+        """
+        with self.acquire() as messenger:
+            for attempt in range(2):
+                if attempt > 0 and messenger.reconnect() != 1:
+                    break
+                if messenger.connect_to_exchange(ex_name=ex_name,
+                                                 ex_type=ex_type) == 1:
+                    return messenger.publish_batch(ex_name=ex_name,
+                                                   messages=messages,
+                                                   topic=topic,
+                                                   **options)
+        return [None] * len(messages)
+
+    def close(self):
+        """
+        Disconnects every idle messenger
+        :return: None
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for messenger in idle:
+            messenger.disconnect()
+
+
+def get_pool(host='localhost', port=5672, uname="guest", pwd="guest"):
+    """
+    Returns the process wide pool for a data hub, creating it on first use
+    :param host: IP address of the data hub
+    :param port: Port of communication (AMQP is 5672)
+    :param uname: Username for authentication
+    :param pwd: password for user
+    :return: MessengerPool object
+    """
+    key = (host, port, uname, pwd)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = MessengerPool(host=host, port=port, uname=uname, pwd=pwd)
+            _pools[key] = pool
+    return pool
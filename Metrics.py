@@ -0,0 +1,265 @@
+"""
+@file_name : Metrics.py
+@author : Srihari Seshadri
+@description : This file defines the metrics every pipeline stage reports :
+                1. Counters, gauges and fixed-bucket histograms
+                2. Prometheus text rendering of everything registered
+                3. An HTTP endpoint and/or a periodic dump file to read them
+                4. Header names used to stamp messages at each hop
+@date : 12-03-2018
+"""
+
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# Stamped by Messenger on every publish. x-origin-at is carried unchanged
+# from the first hop so that consumers can measure end-to-end age
+SENT_AT_HEADER = "x-sent-at"
+ORIGIN_AT_HEADER = "x-origin-at"
+
+# Seconds. 10us to ~80s, doubling
+DEFAULT_BUCKETS = tuple(0.00001 * 2 ** i for i in range(24))
+DUMP_INTERVAL = 15  # seconds
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(k + '="' + str(v).replace('"', '\\"') + '"'
+                          for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._children = {}
+        self._lock = threading.Lock()
+        pass
+
+    def labels(self, *values):
+        """
+        Returns the child metric for a set of label values
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP " + self.name + " " + self.description,
+                 "# TYPE " + self.name + " " + self.kind]
+        for values, child in sorted(self._children.items()):
+            lines.extend(child.render(self.name, self.label_names, values))
+        return lines
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+        pass
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self, name, label_names, values):
+        return [name + _format_labels(label_names, values) + " " +
+                repr(float(self.value))]
+
+
+class _GaugeChild(_CounterChild):
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        pass
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def render(self, name, label_names, values):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets, self._counts):
+            cumulative += count
+            lines.append(name + "_bucket" +
+                         _format_labels(label_names, values,
+                                        ("le", repr(bound))) +
+                         " " + str(cumulative))
+        lines.append(name + "_bucket" +
+                     _format_labels(label_names, values, ("le", "+Inf")) +
+                     " " + str(self._count))
+        labels = _format_labels(label_names, values)
+        lines.append(name + "_sum" + labels + " " + repr(self._sum))
+        lines.append(name + "_count" + labels + " " + str(self._count))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+def _register(cls, name, description, label_names, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = cls(name, description, label_names, **kwargs)
+            _registry[name] = metric
+        return metric
+
+
+def counter(name, description, label_names=()):
+    """
+    Returns the counter registered under a name, creating it on first use
+    """
+    return _register(Counter, name, description, label_names)
+
+
+def gauge(name, description, label_names=()):
+    """
+    Returns the gauge registered under a name, creating it on first use
+    """
+    return _register(Gauge, name, description, label_names)
+
+
+def histogram(name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+    """
+    Returns the histogram registered under a name, creating it on first use
+    """
+    return _register(Histogram, name, description, label_names,
+                     buckets=buckets)
+
+
+def render():
+    """
+    :return: Every registered metric in the Prometheus text format
+    """
+    with _registry_lock:
+        metrics = sorted(_registry.values(), key=lambda m: m.name)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host=""):
+    """
+    Serves the metrics at http://host:port/ from a daemon thread
+    :param port: Port to listen on
+    :param host: Interface to bind to
+    :return: HTTPServer object, or None if it could not be started
+    """
+    try:
+        server = HTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print("Could not start the metrics endpoint :")
+        print(e)
+        return None
+    thread = threading.Thread(target=server.serve_forever,
+                              name="metrics-http", daemon=True)
+    thread.start()
+    return server
+
+
+def dump(path):
+    """
+    Writes the metrics to a file atomically
+    :param path: File to write
+    :return: None
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+def start_dump_thread(path, interval=DUMP_INTERVAL):
+    """
+    Dumps the metrics to a file every `interval` seconds from a daemon
+    thread
+    :param path: File to write
+    :param interval: Seconds between dumps
+    :return: Thread object
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                dump(path)
+            except OSError as e:
+                print("Could not dump metrics : ", e)
+
+    thread = threading.Thread(target=run, name="metrics-dump", daemon=True)
+    thread.start()
+    return thread
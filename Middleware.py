@@ -0,0 +1,411 @@
+"""
+@file_name : Middleware.py
+@author : Srihari Seshadri
+@description : This file defines middleware for consumer callbacks, so that
+                decoding, timing, error handling and acking are written once
+                instead of in every callback :
+                1. chain() wraps a callback with a list of middlewares. The
+                   first one in the list runs outermost
+                2. Decode, Timing, HandleErrors and AckPolicy
+                3. Reassemble hands the callback whole dataframes out of
+                   chunked streams
+                4. SampledProfiler runs 1 in N messages under cProfile or a
+                   wall-clock stack sampler, and dumps the aggregated profile
+                   on a signal or at an interval. It can be switched on and
+                   off with a signal, so a running consumer pays nothing
+                   until it is asked to
+                A middleware is called with the next step of the chain and
+                the delivery (ch, method, properties, body) and returns the
+                callback's result. Middlewares other than SampledProfiler
+                and Reassemble can be pickled, for process pool consumers.
+@date : 11-14-2018
+"""
+
+import collections
+import cProfile
+import functools
+import io
+import itertools
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import DataFrameCodec
+import DataFrameStream
+import MessageCodec
+import Metrics
+
+# Results a callback (or AckPolicy) can return. Anything else but -1 acks
+ACK = 1
+REJECT = -1
+REQUEUE = "requeue"
+
+PROFILE_EVERY = 100             # profile 1 in N messages
+PROFILE_CPROFILE = "cprofile"   # deterministic, per function call
+PROFILE_STACKS = "stacks"       # wall-clock stack samples, lower overhead
+STACK_SAMPLE_INTERVAL = 0.001   # seconds between two stack samples
+DUMP_SIGNAL = signal.SIGUSR1
+TOGGLE_SIGNAL = signal.SIGUSR2
+PRINT_TOP = 20                  # rows printed with every dump
+
+_middleware_seconds = Metrics.histogram(
+    "rtis_middleware_seconds",
+    "Time spent in the part of a callback chain wrapped by Timing",
+    ("name",))
+_errors_total = Metrics.counter(
+    "rtis_callback_errors_total", "Exceptions raised by callbacks",
+    ("error",))
+_profiled_total = Metrics.counter(
+    "rtis_profiled_messages_total", "Messages run under the profiler",
+    ("mode",))
+
+
+class _Chain:
+    """
+    Callable with the pika callback signature running the middlewares and
+    then the callback. A class rather than a closure so that it pickles.
+    """
+
+    def __init__(self, callback, middlewares):
+        self.callback = callback
+        self.middlewares = tuple(middlewares)
+        pass
+
+    def _call(self, index, ch, method, properties, body):
+        if index == len(self.middlewares):
+            return self.callback(ch, method, properties, body)
+        return self.middlewares[index](
+            functools.partial(self._call, index + 1),
+            ch, method, properties, body)
+
+    def __call__(self, ch, method, properties, body):
+        return self._call(0, ch, method, properties, body)
+
+
+def chain(callback, middlewares):
+    """
+    Wraps a callback with middlewares
+    :param callback: Function (ch, method, properties, body)
+    :param middlewares: List of middlewares, outermost first
+    :return: Function (ch, method, properties, body)
+    """
+    if not middlewares:
+        return callback
+    return _Chain(callback, middlewares)
+
+
+def uses_ack_policy(middlewares):
+    """
+    :return: True if one of the middlewares decides how messages are acked
+    """
+    return any(isinstance(m, AckPolicy) for m in middlewares or ())
+
+
+class Decode:
+
+    def __init__(self, dataframe=None):
+        """
+        Hands the callback the decoded message instead of the raw body
+        :param dataframe: True to decode dataframes, False for JSON/msgpack
+                          messages. None decides by the routing key (topics
+                          containing "__df" carry dataframes)
+        """
+        self.dataframe = dataframe
+        pass
+
+    def __call__(self, call_next, ch, method, properties, body):
+        dataframe = self.dataframe
+        if dataframe is None:
+            dataframe = "__df" in getattr(method, "routing_key", "")
+        if dataframe:
+            body = DataFrameCodec.loads(
+                MessageCodec.decompress(body, properties.content_encoding),
+                properties)
+        else:
+            body = MessageCodec.loads(body, properties)
+        return call_next(ch, method, properties, body)
+
+
+class Reassemble:
+
+    def __init__(self, timeout=DataFrameStream.STREAM_TIMEOUT,
+                 max_bytes=DataFrameStream.MAX_BUFFERED_BYTES):
+        """
+        Collects the chunks of dataframe streams (see
+        Messenger.send_dataframe_stream) and calls the rest of the chain
+        once per complete stream, with the whole dataframe as the body.
+        Chunks are acked as they are buffered. Use it instead of Decode
+        :param timeout: Seconds an incomplete stream is kept without
+                        receiving a chunk
+        :param max_bytes: Bytes held for incomplete streams at most
+        """
+        self._assembler = DataFrameStream.StreamAssembler(
+            reassemble=True, timeout=timeout, max_bytes=max_bytes)
+        pass
+
+    def __call__(self, call_next, ch, method, properties, body):
+        result = ACK
+        for chunk in self._assembler.add(properties, body):
+            result = call_next(ch, method, properties, chunk.dataframe)
+        return result
+
+
+class Timing:
+
+    def __init__(self, name="callback"):
+        """
+        Records the time spent in the rest of the chain
+        :param name: Label of the rtis_middleware_seconds metric
+        """
+        self.name = name
+        pass
+
+    def __call__(self, call_next, ch, method, properties, body):
+        start = time.perf_counter()
+        try:
+            return call_next(ch, method, properties, body)
+        finally:
+            _middleware_seconds.labels(self.name).observe(
+                time.perf_counter() - start)
+
+
+class HandleErrors:
+
+    def __init__(self, result=REJECT):
+        """
+        Turns exceptions from the rest of the chain into a result
+        :param result: Returned when an exception was caught, REJECT or
+                       REQUEUE
+        """
+        self.result = result
+        pass
+
+    def __call__(self, call_next, ch, method, properties, body):
+        try:
+            return call_next(ch, method, properties, body)
+        except Exception as e:
+            _errors_total.labels(type(e).__name__).inc()
+            print("Exception caught in callback ")
+            print(e)
+            return self.result
+
+
+class AckPolicy:
+
+    def __init__(self, requeue_on_error=False, requeue_redelivered=False):
+        """
+        Decides how each message is settled : acked if the callback
+        succeeded, rejected (or requeued) if it raised or returned REJECT.
+        The Receiver settles the message by the result, so with this
+        middleware callbacks must not ack themselves.
+        :param requeue_on_error: Requeue messages whose callback failed
+                                 instead of dropping them (or dead
+                                 lettering them, if the queue has a dead
+                                 letter exchange)
+        :param requeue_redelivered: Also requeue messages that already
+                                    failed once. Off by default, so a
+                                    message that always fails does not
+                                    loop forever
+        """
+        self.requeue_on_error = requeue_on_error
+        self.requeue_redelivered = requeue_redelivered
+        pass
+
+    def __call__(self, call_next, ch, method, properties, body):
+        try:
+            result = call_next(ch, method, properties, body)
+        except Exception as e:
+            _errors_total.labels(type(e).__name__).inc()
+            print("Exception caught in callback ")
+            print(e)
+            result = REJECT
+        if result == REJECT and self._requeue(method):
+            return REQUEUE
+        if result in (REJECT, REQUEUE):
+            return result
+        return ACK
+
+    def _requeue(self, method):
+        if not self.requeue_on_error:
+            return False
+        return self.requeue_redelivered or \
+            not getattr(method, "redelivered", False)
+
+
+class SampledProfiler:
+
+    def __init__(self, every=PROFILE_EVERY, mode=PROFILE_CPROFILE,
+                 dump_path=None, dump_interval=None, dump_signal=DUMP_SIGNAL,
+                 toggle_signal=TOGGLE_SIGNAL, enabled=True):
+        """
+        Profiles 1 in `every` messages and aggregates the results. Must be
+        created in the main thread if signals are used.
+        :param every: Sampling rate
+        :param mode: PROFILE_CPROFILE or PROFILE_STACKS
+        :param dump_path: File the profile is written to : pstats format
+                          for cProfile, folded stacks (flamegraph.pl input)
+                          for stacks. Defaults to profile_<pid>.prof or
+                          .folded in the working directory
+        :param dump_interval: Seconds between two automatic dumps. None to
+                              only dump on the signal
+        :param dump_signal: Signal that dumps the profile, or None
+        :param toggle_signal: Signal that switches sampling on and off, or
+                              None
+        :param enabled: Start sampling right away
+        """
+        if mode not in (PROFILE_CPROFILE, PROFILE_STACKS):
+            raise ValueError("Unknown profiler mode : " + str(mode))
+        self.every = max(1, int(every))
+        self.mode = mode
+        self.enabled = enabled
+        if dump_path is None:
+            dump_path = "profile_" + str(os.getpid()) + \
+                (".prof" if mode == PROFILE_CPROFILE else ".folded")
+        self.dump_path = dump_path
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # Only one cProfile can be active at a time, other messages pass
+        self._profiling = threading.Lock()
+        self._stats = None
+        self._stacks = collections.Counter()
+        self._sampled = set()       # threads running a sampled message
+        self._sampler = None
+        self._sampler_cond = threading.Condition(self._lock)
+        self.messages = 0
+
+        if dump_signal is not None:
+            signal.signal(dump_signal, lambda signum, frame: threading.Thread(
+                target=self.dump, daemon=True).start())
+        if toggle_signal is not None:
+            signal.signal(toggle_signal, lambda signum, frame: self.toggle())
+        if dump_interval:
+            threading.Thread(target=self._dump_every, args=(dump_interval,),
+                             name="profile-dump", daemon=True).start()
+        pass
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        print("Profiler", "enabled" if self.enabled else "disabled",
+              "(1 in", self.every, "messages)")
+
+    def __call__(self, call_next, ch, method, properties, body):
+        if not self.enabled or next(self._counter) % self.every:
+            return call_next(ch, method, properties, body)
+        if self.mode == PROFILE_CPROFILE:
+            return self._run_cprofile(call_next, ch, method, properties, body)
+        return self._run_sampled(call_next, ch, method, properties, body)
+
+    def _run_cprofile(self, call_next, ch, method, properties, body):
+        if not self._profiling.acquire(blocking=False):
+            return call_next(ch, method, properties, body)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                return call_next(ch, method, properties, body)
+            finally:
+                profile.disable()
+        finally:
+            self._profiling.release()
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self.messages += 1
+            _profiled_total.labels(self.mode).inc()
+
+    def _run_sampled(self, call_next, ch, method, properties, body):
+        ident = threading.get_ident()
+        with self._lock:
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_stacks,
+                                                 name="profile-sampler",
+                                                 daemon=True)
+                self._sampler.start()
+            self._sampled.add(ident)
+            self._sampler_cond.notify()
+        try:
+            return call_next(ch, method, properties, body)
+        finally:
+            with self._lock:
+                self._sampled.discard(ident)
+                self.messages += 1
+            _profiled_total.labels(self.mode).inc()
+
+    def _sample_stacks(self):
+        """
+        Records the stacks of the threads running a sampled message
+        """
+        while True:
+            with self._lock:
+                while not self._sampled:
+                    self._sampler_cond.wait()
+                idents = set(self._sampled)
+            frames = sys._current_frames()
+            samples = [_fold(frames[ident]) for ident in idents
+                       if ident in frames]
+            with self._lock:
+                self._stacks.update(samples)
+            time.sleep(STACK_SAMPLE_INTERVAL)
+
+    def _dump_every(self, interval):
+        while True:
+            time.sleep(interval)
+            self.dump()
+
+    def dump(self, path=None, reset=False):
+        """
+        Writes the aggregated profile and prints its top entries
+        :param path: File to write. Defaults to dump_path
+        :param reset: Start a new aggregate afterwards
+        :return: 1 if success, -1 if failure
+        """
+        path = path or self.dump_path
+        try:
+            with self._lock:
+                stats, stacks = self._stats, dict(self._stacks)
+                messages = self.messages
+                if reset:
+                    self._stats = None
+                    self._stacks.clear()
+                    self.messages = 0
+            if self.mode == PROFILE_CPROFILE:
+                if stats is None:
+                    print("Profiler : no message sampled yet")
+                    return 1
+                stats.dump_stats(path)
+                out = io.StringIO()
+                stats.stream = out
+                stats.sort_stats("cumulative").print_stats(PRINT_TOP)
+                report = out.getvalue()
+            else:
+                with open(path, "w") as f:
+                    for stack, count in sorted(stacks.items()):
+                        f.write(stack + " " + str(count) + "\n")
+                top = sorted(stacks.items(), key=lambda kv: -kv[1])
+                report = "\n".join(str(count) + "  " + stack.split(";")[-1]
+                                   for stack, count in top[:PRINT_TOP])
+            print("Profile of", messages, "messages written to", path)
+            print(report)
+        except Exception as e:
+            print("Exception caught while dumping the profile :")
+            print(e)
+            return -1
+        return 1
+
+
+def _fold(frame):
+    """
+    :return: The stack of a frame as "file:function;..." from the outermost
+             call, the folded format flamegraph tools read
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(os.path.basename(code.co_filename) + ":" +
+                     code.co_name)
+        frame = frame.f_back
+    return ";".join(reversed(names))
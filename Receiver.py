@@ -8,9 +8,39 @@
 @date : 11-14-2018
 """
 
+import functools
+import signal
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import pika
-import pandas as pd
-from pandas.compat import StringIO
+import DataFrameCodec
+import DataFrameStream
+import MessageCodec
+import Metrics
+import Middleware
+import Transport
+
+PREFETCH_PER_WORKER = 4     # default prefetch in concurrent mode
+
+_received_total = Metrics.counter(
+    "rtis_messages_received_total", "Messages delivered to a consumer",
+    ("topic",))
+_failures_total = Metrics.counter(
+    "rtis_callback_failures_total",
+    "Messages whose callback raised or returned -1", ("topic",))
+_callback_seconds = Metrics.histogram(
+    "rtis_callback_seconds",
+    "Time from delivery until the callback is done with a message",
+    ("topic",))
+_hop_latency_seconds = Metrics.histogram(
+    "rtis_hop_latency_seconds",
+    "Time between the publish of a message and its delivery", ("topic",))
+_message_age_seconds = Metrics.histogram(
+    "rtis_message_age_seconds",
+    "Time between the first publish in the pipeline and this delivery",
+    ("topic",))
 
 
 class Receiver:
@@ -18,6 +48,7 @@ class Receiver:
     def __init__(self):
         self._connection = None
         self._channel = None
+        self._executors = []
         pass
 
     def connect(self, host='localhost', port=5672,
@@ -34,7 +65,7 @@ class Receiver:
             # Make a credentials object
             credentials = pika.PlainCredentials(uname, pwd)
             # First establish the connection
-            self._connection = pika.BlockingConnection(
+            self._connection = Transport.open_connection(
                 pika.ConnectionParameters(
                     host=host,
                     port=port,
@@ -52,7 +83,16 @@ class Receiver:
                                ex_name="",
                                ex_type='topic',
                                topic="",
-                               callback=None):
+                               callback=None,
+                               auto_ack=True,
+                               prefetch_count=None,
+                               workers=0,
+                               use_processes=False,
+                               ordered=False,
+                               durable=False,
+                               exclusive=True,
+                               decode=False,
+                               middleware=None):
         """
         Starts the process for listening in and consuming the queue. The
         callback function acts as the handler for deciding pipelines
@@ -61,41 +101,296 @@ class Receiver:
         :param ex_type: Exchange Type
         :param topic: Topic to subscribe to
         :param callback: Callback function to call
+        :param auto_ack: If False, the callback is responsible for acking
+                         (ch.basic_ack) each delivery once it is safely
+                         processed
+        :param prefetch_count: Maximum number of unacked messages the broker
+                               pushes to this consumer (basic_qos). Defaults
+                               to PREFETCH_PER_WORKER per worker in
+                               concurrent mode and to unlimited otherwise
+        :param workers: If > 0, run the callback on a pool of this many
+                        workers. The Receiver acks each message once its
+                        callback returns, or rejects it if the callback
+                        raised or returned -1. Callbacks must not use the
+                        channel in this mode.
+        :param use_processes: Use a process pool instead of a thread pool.
+                              The callback must then be a module level
+                              function and it is passed ch=None
+        :param ordered: Keep messages with the same routing key in order by
+                        running each routing key on a single worker
+        :param durable: Declare a named queue as durable
+        :param exclusive: Declare a named queue as exclusive to this
+                          connection. Set to False for a queue shared by
+                          several workers
+        :param decode: If True the callback receives the decoded message
+                       (decompressed, JSON/msgpack parsed) instead of the
+                       raw body
+        :param middleware: List of middlewares wrapped around the callback,
+                           outermost first (see Middleware.py). With an
+                           AckPolicy the Receiver acks or rejects each
+                           message by the result of the chain
         :return: -1 if failure. It should continue running until quit.
         """
         try:
-            self._channel.exchange_declare(exchange=ex_name,
-                                           exchange_type=ex_type)
-            if queue_name == "":
-                result = self._channel.queue_declare(exclusive=True)
-            else:
-                result = self._channel.queue_declare(queue=queue_name,
-                                                     exclusive=True)
-            queue_name = result.method.queue
-
-            self._channel.queue_bind(exchange=ex_name,
-                                     queue=queue_name,
-                                     routing_key=topic)
+            queue_name = self._declare_queue(queue_name, ex_name, ex_type,
+                                             topic, durable, exclusive)
 
             # Based on topic, we decide what callback has to be used
-            if callback is not None:
-                self._channel.basic_consume(callback,
-                                            queue=queue_name)
-            else:
+            middleware = list(middleware or [])
+            if callback is None:
+                auto_ack = True
                 if "__df" in topic:
-                    self._channel.basic_consume(self._dataframe_callback,
-                                                queue=queue_name)
+                    callback = self._dataframe_callback
                 else:
-                    self._channel.basic_consume(self._callback,
-                                                queue=queue_name)
+                    callback = self._callback
+            elif decode:
+                middleware.append(Middleware.Decode(dataframe=False))
+            callback = Middleware.chain(callback, middleware)
+            settle = Middleware.uses_ack_policy(middleware)
+            if settle:
+                auto_ack = False
+
+            if workers > 0:
+                if prefetch_count is None:
+                    prefetch_count = workers * PREFETCH_PER_WORKER
+                callback = self._concurrent_callback(callback, workers,
+                                                     use_processes, ordered,
+                                                     topic)
+                auto_ack = False
+            else:
+                callback = functools.partial(_instrumented_call, callback,
+                                             topic, settle)
+
+            if prefetch_count:
+                self._channel.basic_qos(prefetch_count=prefetch_count)
+            self._channel.basic_consume(callback,
+                                        queue=queue_name,
+                                        no_ack=auto_ack)
 
             self._channel.start_consuming()
         except Exception as e:
             print("An error occured while trying to receive data from queue")
             print(e)
             return -1
+        finally:
+            self._shutdown_workers()
+            self._send_pending_acks()
         return 1
 
+    def _declare_queue(self, queue_name, ex_name, ex_type, topic, durable,
+                       exclusive):
+        """
+        Declares the exchange and the queue and binds them
+        :return: Name of the queue
+        """
+        self._channel.exchange_declare(exchange=ex_name,
+                                       exchange_type=ex_type)
+        if queue_name == "":
+            result = self._channel.queue_declare(exclusive=True)
+        else:
+            result = self._channel.queue_declare(queue=queue_name,
+                                                 durable=durable,
+                                                 exclusive=exclusive)
+        queue_name = result.method.queue
+
+        self._channel.queue_bind(exchange=ex_name,
+                                 queue=queue_name,
+                                 routing_key=topic)
+        return queue_name
+
+    def get_dataframe_stream(self,
+                             queue_name="",
+                             ex_name="",
+                             ex_type='topic',
+                             topic="",
+                             reassemble=False,
+                             timeout=DataFrameStream.STREAM_TIMEOUT,
+                             max_bytes=DataFrameStream.MAX_BUFFERED_BYTES,
+                             prefetch_count=None,
+                             durable=False,
+                             exclusive=True,
+                             poll_interval=1.0):
+        """
+        Consumes chunked dataframe streams (see
+        Messenger.send_dataframe_stream) as a generator. Ends when the
+        caller stops iterating or stop() is called.
+        :param queue_name: Name of the queue. Leave empty to auto generate
+        :param ex_name: Name of the exchange to connect to
+        :param ex_type: Exchange Type
+        :param topic: Topic to subscribe to (a "__df" topic)
+        :param reassemble: Yield whole dataframes instead of chunks
+        :param timeout: Seconds an incomplete stream is kept without
+                        receiving a chunk
+        :param max_bytes: Bytes held for incomplete streams at most. The
+                          least recently active stream is dropped beyond it
+        :param prefetch_count: Maximum number of unacked chunks. When
+                               reassembling it must leave room for every
+                               chunk of the streams in flight
+        :param durable: Declare a named queue as durable
+        :param exclusive: Declare a named queue as exclusive
+        :param poll_interval: Seconds between two checks for timed out
+                              streams while no chunk arrives
+        :return: yields DataFrameStream.StreamChunk (stream_id, seq,
+                 dataframe, final). A chunk is acked once the caller asks
+                 for the next one, and a chunk held back (for reassembly,
+                 or until a gap before it is filled) once what it is part
+                 of has been yielded. Chunks of dropped streams are
+                 rejected
+        """
+        queue_name = self._declare_queue(queue_name, ex_name, ex_type,
+                                         topic, durable, exclusive)
+        if prefetch_count:
+            self._channel.basic_qos(prefetch_count=prefetch_count)
+        assembler = DataFrameStream.StreamAssembler(reassemble=reassemble,
+                                                    timeout=timeout,
+                                                    max_bytes=max_bytes)
+        held = {}   # stream id -> {seq: delivery tag} of unacked chunks
+        try:
+            for method, properties, body in self._channel.consume(
+                    queue_name, inactivity_timeout=poll_interval):
+                if method is None:
+                    assembler.expire()
+                    self._settle_stream_chunks(assembler, held, reassemble)
+                    continue
+                _observe_delivery(topic, properties)
+                try:
+                    chunks = assembler.add(properties, body)
+                except Exception as e:
+                    print("Exception caught while decoding a dataframe "
+                          "chunk :")
+                    print(e)
+                    _failures_total.labels(topic).inc()
+                    self._channel.basic_nack(
+                        delivery_tag=method.delivery_tag, requeue=False)
+                    continue
+                stream_id, seq, _ = \
+                    DataFrameStream.stream_position(properties)
+                tags = held.setdefault(stream_id, {})
+                if seq in tags:
+                    # Redelivered while the first copy is still held
+                    self._channel.basic_ack(delivery_tag=method.delivery_tag)
+                else:
+                    tags[seq] = method.delivery_tag
+                for chunk in chunks:
+                    yield chunk
+                self._settle_stream_chunks(assembler, held, reassemble)
+        finally:
+            if self._channel.is_open:
+                self._channel.cancel()
+
+    def _settle_stream_chunks(self, assembler, held, reassemble):
+        """
+        Acks the held chunks whose data has been yielded, and rejects the
+        ones of dropped streams
+        :param assembler: DataFrameStream.StreamAssembler
+        :param held: dict stream id -> {seq: delivery tag}, updated in place
+        :param reassemble: Chunks stay held until their whole frame is out
+        :return: None
+        """
+        for stream_id in list(held):
+            tags = held[stream_id]
+            next_seq = None if stream_id is None else \
+                assembler.next_seq(stream_id)
+            if next_seq is None:
+                del held[stream_id]
+                done = list(tags)
+            elif reassemble:
+                continue
+            else:
+                done = [seq for seq in tags if seq < next_seq]
+            dropped = next_seq is None and stream_id is not None and \
+                assembler.was_dropped(stream_id)
+            for seq in done:
+                tag = tags.pop(seq)
+                if dropped:
+                    self._channel.basic_nack(delivery_tag=tag,
+                                             requeue=False)
+                else:
+                    self._channel.basic_ack(delivery_tag=tag)
+
+    def _concurrent_callback(self, callback, workers, use_processes, ordered,
+                             topic=""):
+        """
+        Wraps a callback so that it runs on a worker pool. Acks are sent
+        back on the connection thread with add_callback_threadsafe.
+        :param callback: Callback function to call
+        :param workers: Number of workers
+        :param use_processes: Use processes instead of threads
+        :param ordered: Pin every routing key to a single worker
+        :param topic: Subscribed topic, used to label the metrics
+        :return: pika consumer callback
+        """
+        executor_class = (ProcessPoolExecutor if use_processes
+                          else ThreadPoolExecutor)
+        if ordered:
+            # One single worker lane per worker, keyed on the routing key
+            self._executors = [executor_class(max_workers=1)
+                               for _ in range(workers)]
+        else:
+            self._executors = [executor_class(max_workers=workers)]
+        executors = self._executors
+        connection = self._connection
+
+        def dispatch(ch, method, properties, body):
+            # Measured here rather than in the worker so that process pool
+            # consumers report to this process
+            _observe_delivery(topic, properties)
+            start = time.perf_counter()
+            lane = 0
+            if len(executors) > 1:
+                lane = (zlib.crc32(method.routing_key.encode("utf-8")) %
+                        len(executors))
+            future = executors[lane].submit(
+                callback, None if use_processes else ch,
+                method, properties, body)
+            settle = functools.partial(self._settle, ch, method.delivery_tag,
+                                       topic, start)
+            future.add_done_callback(
+                lambda f: connection.add_callback_threadsafe(
+                    functools.partial(settle, f)))
+
+        return dispatch
+
+    @staticmethod
+    def _settle(ch, delivery_tag, topic, start, future):
+        """
+        Acks or rejects a message once its worker is done. Runs on the
+        connection thread.
+        :param ch: channel
+        :param delivery_tag: Delivery tag of the message
+        :param topic: Subscribed topic, used to label the metrics
+        :param start: perf_counter value when the message was delivered
+        :param future: Future of the callback
+        :return: None
+        """
+        _callback_seconds.labels(topic).observe(time.perf_counter() - start)
+        result = Middleware.REJECT
+        if future.exception() is None:
+            result = future.result()
+        else:
+            print("Exception caught in worker ")
+            print(future.exception())
+        if result in (Middleware.REJECT, Middleware.REQUEUE):
+            _failures_total.labels(topic).inc()
+        _settle_result(ch, delivery_tag, result)
+
+    def _shutdown_workers(self):
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        self._executors = []
+
+    def _send_pending_acks(self):
+        """
+        Runs the acks queued by workers that finished after consuming
+        stopped, so their messages are not redelivered
+        """
+        try:
+            if self._connection is not None and self._connection.is_open:
+                self._connection.process_data_events(time_limit=0)
+        except Exception as e:
+            print("Could not send the last acks :")
+            print(e)
+
     @staticmethod
     def _callback(ch, method, properties, body):
         """
@@ -107,9 +402,12 @@ class Receiver:
         :return: None
         """
         try:
-            content_str = body.decode("utf-8")
+            if properties.content_type or properties.content_encoding:
+                content = MessageCodec.loads(body, properties)
+            else:
+                content = body.decode("utf-8")
 
-            print("Received : ", content_str)
+            print("Received : ", content)
 
         except Exception as e:
             print("Exception caught in callback ")
@@ -128,9 +426,10 @@ class Receiver:
         :return: None
         """
         try:
-            content_str = body.decode("utf-8")
-
-            dataframe = pd.read_csv(StringIO(content_str), sep='\s+')
+            # Columnar frames are tagged in the headers, anything else is
+            # treated as the legacy text format
+            body = MessageCodec.decompress(body, properties.content_encoding)
+            dataframe = DataFrameCodec.loads(body, properties)
 
             print("Received Dataframe : ")
             print(dataframe.head())
@@ -141,11 +440,91 @@ class Receiver:
             return -1
         return 1
 
+    def stop(self):
+        """
+        Stops consuming. Safe to call from any thread; get_data_from_exchange
+        returns once the current callback is done.
+        :return: None
+        """
+        self._connection.add_callback_threadsafe(self._channel.stop_consuming)
+
+    def stop_on_signal(self, signals=(signal.SIGTERM, signal.SIGINT)):
+        """
+        Stops consuming gracefully when the process receives one of the
+        signals : the callbacks in progress finish and are acked, and
+        get_data_from_exchange returns. Must be called from the main thread.
+        :param signals: Signals to handle
+        :return: None
+        """
+        def handler(signum, frame):
+            # The handler interrupts the connection's own thread, so the
+            # stop request is made from another one
+            threading.Thread(target=self.stop, daemon=True).start()
+
+        for signum in signals:
+            signal.signal(signum, handler)
+
     def disconnect(self):
-        self._connection.close()
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
 
     def __del__(self):
-        self._connection.close()
+        self.disconnect()
+
+
+def _observe_delivery(topic, properties):
+    """
+    Counts a delivery and records how long it spent on the last hop and in
+    the pipeline as a whole, from the headers stamped by Messenger
+    """
+    _received_total.labels(topic).inc()
+    headers = getattr(properties, "headers", None)
+    if not headers:
+        return
+    now = time.time()
+    sent_at = headers.get(Metrics.SENT_AT_HEADER)
+    if sent_at is not None:
+        _hop_latency_seconds.labels(topic).observe(max(now - sent_at, 0.0))
+    origin_at = headers.get(Metrics.ORIGIN_AT_HEADER)
+    if origin_at is not None:
+        _message_age_seconds.labels(topic).observe(max(now - origin_at, 0.0))
+
+
+def _instrumented_call(callback, topic, settle, ch, method, properties,
+                       body):
+    """
+    Runs a consumer callback and records its metrics
+    :param settle: Ack or reject the message by the callback's result
+    """
+    _observe_delivery(topic, properties)
+    start = time.perf_counter()
+    result = Middleware.REJECT
+    try:
+        result = callback(ch, method, properties, body)
+    finally:
+        _callback_seconds.labels(topic).observe(time.perf_counter() - start)
+        if result in (Middleware.REJECT, Middleware.REQUEUE):
+            _failures_total.labels(topic).inc()
+        if settle:
+            _settle_result(ch, method.delivery_tag, result)
+    return result
+
+
+def _settle_result(ch, delivery_tag, result):
+    """
+    Acks a message, or rejects it if the result is -1 (REJECT) or REQUEUE
+    """
+    try:
+        if result == Middleware.REQUEUE:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        elif result == Middleware.REJECT:
+            ch.basic_nack(delivery_tag=delivery_tag, requeue=False)
+        else:
+            ch.basic_ack(delivery_tag=delivery_tag)
+    except Exception as e:
+        # The channel went away, the broker will redeliver
+        print("Could not settle message :")
+        print(e)
 
 
 def main():
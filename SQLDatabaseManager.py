@@ -3,28 +3,261 @@
 @author : Srihari Seshadri
 @description : This file defines the class that connects to the database. It
                 contains methods that allow CRUD operations.
-                Requires interface with pandas library.
+                Requires interface with pandas library (imported on
+                first use, the row based paths do not need it).
                 Database connections are made by using the sqlalchemy library
                 in tandem with the pymysql library
 @date : 11-13-2018
 """
 
-from sqlalchemy import create_engine, exc
-import pandas as pd
+import calendar
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from sqlalchemy import (create_engine, exc, table, column, select,
+                        literal_column, text, MetaData, Table, Column, Index,
+                        and_, or_, tuple_)
+import Metrics
+
+# Connection pool defaults. Engines are shared by every manager that
+# connects to the same DSN, so these size the pool for the whole process.
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+POOL_PRE_PING = True
+POOL_RECYCLE = 3600     # seconds
+
+# Rows per DataFrame yielded by the streaming queries
+CHUNK_SIZE = 10000
+# Rows per INSERT ... ON DUPLICATE KEY UPDATE statement
+UPSERT_CHUNK = 1000
+
+# Bulk loading. insert(bulk=True) hands frames of BULK_THRESHOLD rows or
+# more to bulk_insert(), which uses LOAD DATA LOCAL INFILE on MySQL from
+# LOAD_DATA_THRESHOLD rows, and chunked executemany otherwise
+BULK_THRESHOLD = 10000
+LOAD_DATA_THRESHOLD = 50000
+BULK_CHUNK = 5000           # rows per executemany / per write to the file
+LOCAL_INFILE = True         # let pymysql send local files to the server
+# MySQL errors meaning the server or client refuses LOAD DATA LOCAL INFILE
+LOCAL_INFILE_REFUSED = (1148, 2068, 3948)
+
+BULK_AUTO = "auto"
+BULK_LOAD_DATA = "load_data"
+BULK_EXECUTEMANY = "executemany"
+
+_engines = {}
+_engine_stats = {}
+_engines_lock = threading.Lock()
+
+_query_seconds = Metrics.histogram(
+    "rtis_db_seconds", "Time taken by database statements", ("operation",))
+_rows_written_total = Metrics.counter(
+    "rtis_db_rows_written_total", "Rows written to the database",
+    ("table",))
+_bulk_rows_per_second = Metrics.gauge(
+    "rtis_db_bulk_rows_per_second", "Rate of the last bulk load",
+    ("table", "method"))
+
+
+class _PoolWaitStats:
+    """
+    Tracks how long callers waited to check a connection out of a pool
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+
+class TableSchema:
+    """
+    Declared layout of a table : typed columns, primary key, secondary
+    indexes and optional range partitioning. Tables created from a schema
+    never need to be reflected, and upserts know their key.
+    """
+
+    def __init__(self, name, columns, primary_key, indexes=(),
+                 partition_column=None, partitions=()):
+        """
+        :param name: Table name
+        :param columns: List of (column name, SQLAlchemy type)
+        :param primary_key: List of column names
+        :param indexes: List of column names, or tuples of names for
+                        composite indexes
+        :param partition_column: Integer column to range partition on
+                                 (MySQL only). It is added to the primary
+                                 key, as MySQL requires of every unique key
+        :param partitions: List of (partition name, exclusive upper bound),
+                           in increasing order. A catch-all partition is
+                           added after the last one (see month_partitions)
+        """
+        self.name = name
+        self.columns = list(columns)
+        self.primary_key = list(primary_key)
+        self.indexes = [(index,) if isinstance(index, str) else tuple(index)
+                        for index in indexes]
+        self.partition_column = partition_column
+        self.partitions = list(partitions)
+        if partition_column and partition_column not in self.primary_key:
+            self.primary_key.append(partition_column)
+        pass
+
+    @property
+    def column_names(self):
+        return [name for name, _ in self.columns]
+
+    def table(self, metadata=None):
+        """
+        :return: SQLAlchemy Table for this schema
+        """
+        columns = [Column(name, col_type,
+                          primary_key=name in self.primary_key,
+                          autoincrement=False)
+                   for name, col_type in self.columns]
+        indexes = [Index("ix_" + self.name + "_" + "_".join(names),
+                         *names) for names in self.indexes]
+        return Table(self.name, metadata or MetaData(), *(columns + indexes))
+
+    def partition_ddl(self):
+        """
+        :return: ALTER TABLE statement adding the range partitions, or None
+        """
+        if not self.partition_column or not self.partitions:
+            return None
+        parts = ["PARTITION " + name + " VALUES LESS THAN (" +
+                 str(int(bound)) + ")" for name, bound in self.partitions]
+        parts.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+        return ("ALTER TABLE `" + self.name + "` PARTITION BY RANGE (`" +
+                self.partition_column + "`) (" + ", ".join(parts) + ")")
+
+
+def _tsv_column(series):
+    """
+    Formats a column for LOAD DATA : NULLs as \\N, booleans as 1/0, and
+    backslashes, tabs and newlines escaped in anything that is not a
+    number or a timestamp (object, string and categorical columns alike)
+    """
+    nulls = series.isna()
+    if series.dtype.kind == "b":
+        text_values = series.map({True: "1", False: "0"})
+    elif series.dtype.kind in "iufM":
+        text_values = series.astype(str)
+    else:
+        text_values = series.astype(object).astype(str)
+        for raw, escaped in (("\\", "\\\\"), ("\t", "\\t"),
+                             ("\n", "\\n"), ("\r", "\\r")):
+            text_values = text_values.str.replace(raw, escaped, regex=False)
+    return text_values.where(~nulls, "\\N")
+
+
+def write_tsv(dframe, path, chunk_size=BULK_CHUNK):
+    """
+    Writes a dataframe as tab separated lines in the default LOAD DATA
+    format, a chunk at a time
+    :param dframe: Dataframe
+    :param path: File to write
+    :param chunk_size: Rows formatted at once
+    :return: None
+    """
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for i in range(0, len(dframe), chunk_size):
+            chunk = dframe.iloc[i:i + chunk_size]
+            columns = [_tsv_column(chunk[name]) for name in chunk.columns]
+            lines = columns[0].str.cat(columns[1:], sep="\t")
+            f.write("\n".join(lines.tolist()))
+            f.write("\n")
+
+
+def month_partitions(year, month, count):
+    """
+    Monthly range partitions on an epoch seconds column
+    :param year: Year of the first partition
+    :param month: Month of the first partition
+    :param count: Number of months
+    :return: List of (name, upper bound) for TableSchema
+    """
+    partitions = []
+    for _ in range(count):
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+        bound = calendar.timegm((year, month, 1, 0, 0, 0))
+        last_year, last_month = (year, month - 1) if month > 1 \
+            else (year - 1, 12)
+        partitions.append(("p%04d%02d" % (last_year, last_month), bound))
+    return partitions
+
+
+def get_engine(dsn, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+               pool_pre_ping=POOL_PRE_PING, pool_recycle=POOL_RECYCLE):
+    """
+    Returns the process wide engine for a DSN, creating it on first use.
+    Pool options only apply when the engine is first created.
+    :param dsn: SQLAlchemy database URL
+    :param pool_size: Connections kept open in the pool
+    :param max_overflow: Extra connections allowed above pool_size
+    :param pool_pre_ping: Test connections for liveness on checkout
+    :param pool_recycle: Seconds after which connections are replaced
+    :return: SQLAlchemy engine
+    """
+    with _engines_lock:
+        engine = _engines.get(dsn)
+        if engine is None:
+            options = dict(pool_pre_ping=pool_pre_ping,
+                           pool_recycle=pool_recycle)
+            # SQLite does not use a sized queue pool
+            if not dsn.startswith("sqlite"):
+                options.update(pool_size=pool_size,
+                               max_overflow=max_overflow)
+            if dsn.startswith("mysql+pymysql") and LOCAL_INFILE:
+                options.update(connect_args={"local_infile": True})
+            engine = create_engine(dsn, **options)
+            _engines[dsn] = engine
+            _engine_stats[dsn] = _PoolWaitStats()
+    return engine
+
+
+def dispose_engines():
+    """
+    Closes every pooled connection of every registered engine
+    :return: None
+    """
+    with _engines_lock:
+        engines = list(_engines.values())
+        _engines.clear()
+        _engine_stats.clear()
+    for engine in engines:
+        engine.dispose()
 
 
 class SQLDatabaseManager:
 
     def __init__(self):
         self._engine = None
+        self._dsn = None
         self._database = None
         self._host = None
         self._uname = None
         self._pwd = None
         self._port = None
+        self._known_tables = set()
+        self._high_water = {}   # (table, column) -> last value pulled
+        self._high_water_keys = {}  # (table, column) -> tiebreak at the mark
+        self._schemas = {}      # table name -> (TableSchema, Table)
+        self._load_data_allowed = True
         pass
 
-    def connect(self, host, database, username, password, port):
+    def connect(self, host, database, username, password, port, **pool_args):
         """
         Creates a connection with the database
         :param host: Host IP address
@@ -32,21 +265,37 @@ class SQLDatabaseManager:
         :param username: username for authentication
         :param password: password for username
         :param port: port number of the database connection.
+        :param pool_args: Optional pool_size, max_overflow, pool_pre_ping and
+                          pool_recycle passed on to get_engine
+        :return: 1 if success. <0 if failure
+        """
+        self._database = database
+        self._uname = username
+        self._pwd = password
+        self._host = host
+        self._port = port
+        return self.connect_url("mysql+pymysql://" +
+                                self._uname + ":" +
+                                self._pwd + "@" +
+                                self._host + ":" +
+                                self._port + "/" +
+                                self._database, **pool_args)
+
+    def connect_url(self, dsn, **pool_args):
+        """
+        Creates a connection with the database given as a SQLAlchemy URL.
+        Managers connecting to the same URL share one engine and pool.
+        :param dsn: SQLAlchemy database URL
+        :param pool_args: Optional pool_size, max_overflow, pool_pre_ping and
+                          pool_recycle passed on to get_engine
         :return: 1 if success. <0 if failure
         """
         try:
-            self._database = database
-            self._uname = username
-            self._pwd = password
-            self._host = host
-            self._port = port
-            self._engine = create_engine("mysql+pymysql://" +
-                                         self._uname + ":" +
-                                         self._pwd + "@" +
-                                         self._host + ":" +
-                                         self._port + "/" +
-                                         self._database)
-            self._engine.connect()      # Is this line needed?
+            self._dsn = dsn
+            self._engine = get_engine(dsn, **pool_args)
+            # Check the database is reachable, handing the connection back
+            with self._connection():
+                pass
         except exc.SQLAlchemyError as err:
             print(" SQL Alchemy threw an error :")
             print(err)
@@ -57,6 +306,41 @@ class SQLDatabaseManager:
             return -2
         return 1
 
+    @contextmanager
+    def _connection(self):
+        """
+        Checks a connection out of the shared pool and times the wait
+        :return: SQLAlchemy connection
+        """
+        start = time.perf_counter()
+        conn = self._engine.connect()
+        stats = _engine_stats.get(self._dsn)
+        if stats is not None:
+            stats.record(time.perf_counter() - start)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def get_pool_stats(self):
+        """
+        Reports the state of the connection pool behind this manager
+        :return: dict with pool size, checked out/in connections, overflow
+                 and checkout wait times (seconds)
+        """
+        pool = self._engine.pool
+        stats = _engine_stats.get(self._dsn) or _PoolWaitStats()
+        report = {"pool": pool.status(),
+                  "checkouts": stats.checkouts,
+                  "total_wait": stats.total_wait,
+                  "max_wait": stats.max_wait,
+                  "avg_wait": (stats.total_wait / stats.checkouts
+                               if stats.checkouts else 0.0)}
+        for name in ("size", "checkedout", "checkedin", "overflow"):
+            if hasattr(pool, name):
+                report[name] = getattr(pool, name)()
+        return report
+
     def get_tables(self):
         try:
             return self._engine.table_names()
@@ -69,15 +353,194 @@ class SQLDatabaseManager:
         :param query: String of SQL query
         :return: A dataframe if success. -1 if fail.
         """
+        import pandas as pd
+        start = time.perf_counter()
         try:
-            df = pd.read_sql(query, con=self._engine)
+            with self._connection() as conn:
+                df = pd.read_sql(query, con=conn)
         except Exception as e:
             print(" An exception was thrown : ")
             print(e)
             return -1
+        _query_seconds.labels("query").observe(time.perf_counter() - start)
         return df
 
-    def insert(self, dframe, table_name, if_table_exists="append"):
+    def stream_query(self, query, chunk_size=CHUNK_SIZE, params=None):
+        """
+        Executes a query on a server side (unbuffered) cursor and yields the
+        result a chunk at a time, so that large results never sit in memory
+        at once and the first rows arrive without waiting for the rest.
+        The connection stays checked out until the generator is exhausted or
+        closed.
+        :param query: String of SQL query, or a SQLAlchemy selectable
+        :param chunk_size: Rows per DataFrame
+        :param params: Optional bind parameters of the query
+        :return: Generator of dataframes. Stops early (after printing the
+                 error) if the query fails
+        """
+        import pandas as pd
+        if isinstance(query, str):
+            query = text(query)
+        start = time.perf_counter()
+        try:
+            with self._connection() as conn:
+                conn = conn.execution_options(stream_results=True)
+                chunks = pd.read_sql(query, con=conn, params=params,
+                                     chunksize=chunk_size)
+                for i, chunk in enumerate(chunks):
+                    if i == 0:
+                        _query_seconds.labels("stream_first_chunk").observe(
+                            time.perf_counter() - start)
+                    yield chunk
+        except Exception as e:
+            print(" An exception was thrown while streaming a query : ")
+            print(e)
+            return
+        _query_seconds.labels("stream").observe(time.perf_counter() - start)
+
+    def stream_new_rows(self, table_name, hwm_column="scraped_at_epoch",
+                        chunk_size=CHUNK_SIZE, key_columns=None):
+        """
+        Streams the rows of a table added since the previous call, in
+        hwm_column order. The high-water mark moves forward as each chunk is
+        yielded, so stopping halfway resumes from the last chunk seen. The
+        column must grow with insert order : rows committed late with a
+        smaller value are not picked up.
+        Many rows can share a hwm_column value (e.g. whole seconds), so the
+        mark is a cursor on (hwm_column, key columns) : rows tying with the
+        mark that were not pulled yet still are. Without key columns, rows
+        at the mark are pulled again and the ones already yielded dropped :
+        the rows at the mark are remembered (NULL/NaN values compare
+        equal), so memory grows with the rows sharing one hwm_column value,
+        and identical rows at the mark are yielded once. Declare a key for
+        tables with many ties or duplicate rows.
+        :param table_name: Table name
+        :param hwm_column: Column tracked as the high-water mark
+        :param chunk_size: Rows per DataFrame
+        :param key_columns: Unique columns breaking ties on hwm_column.
+                            Defaults to the primary key of the schema
+                            declared with create_table, if any
+        :return: Generator of dataframes
+        """
+        key = (table_name, hwm_column)
+        if key_columns is None:
+            key_columns = self._tiebreak_columns(table_name, hwm_column)
+        key_columns = list(key_columns)
+        tbl = table(table_name, column(hwm_column),
+                    *[column(name) for name in key_columns])
+        hwm = tbl.c[hwm_column]
+        keys = [tbl.c[name] for name in key_columns]
+        statement = select([literal_column("*")]).select_from(tbl)
+        high_water = self._high_water.get(key)
+        last_key = self._high_water_keys.get(key)
+        if not isinstance(last_key, tuple if key_columns else set):
+            # Saved by a pull with other key columns
+            last_key = None
+        if high_water is not None:
+            if key_columns and last_key is not None:
+                statement = statement.where(or_(
+                    hwm > high_water,
+                    and_(hwm == high_water,
+                         tuple_(*keys) > tuple_(*last_key))))
+            else:
+                statement = statement.where(hwm >= high_water)
+        statement = statement.order_by(hwm, *keys)
+
+        for chunk in self.stream_query(statement, chunk_size=chunk_size):
+            if not key_columns and high_water is not None and \
+                    last_key is not None:
+                # Drop the rows at the mark that were yielded already
+                at_mark = chunk[hwm_column] == high_water
+                if at_mark.any():
+                    rows = self._row_tuples(chunk)
+                    chunk = chunk[[not (tie and row in last_key)
+                                   for tie, row in zip(at_mark, rows)]]
+            if len(chunk):
+                high_water, last_key = self._advance_mark(
+                    chunk, hwm_column, key_columns, high_water, last_key)
+                self._high_water[key] = high_water
+                self._high_water_keys[key] = last_key
+            yield chunk
+
+    def _tiebreak_columns(self, table_name, hwm_column):
+        if table_name not in self._schemas:
+            return []
+        schema, _ = self._schemas[table_name]
+        return [name for name in schema.primary_key if name != hwm_column]
+
+    @staticmethod
+    def _row_tuples(chunk):
+        """
+        :return: The rows of a dataframe as tuples of Python values, with
+                 None for NULL/NaN so that missing values compare equal
+        """
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        return list(chunk.itertuples(index=False, name=None))
+
+    @classmethod
+    def _advance_mark(cls, chunk, hwm_column, key_columns, high_water,
+                      last_key):
+        """
+        :return: (high-water value, tiebreak) after the rows of a chunk :
+                 the key of its last row, or without key columns the set
+                 of the rows yielded at the new mark
+        """
+        def plain(value):
+            return getattr(value, "item", lambda: value)()
+
+        last = plain(chunk[hwm_column].iloc[-1])
+        if key_columns:
+            # Column by column : a row of mixed dtypes upcasts int keys
+            return last, tuple(plain(chunk[name].iloc[-1])
+                               for name in key_columns)
+        rows = set(cls._row_tuples(chunk[chunk[hwm_column] == last]))
+        if last == high_water and last_key is not None:
+            rows |= last_key
+        return last, rows
+
+    def get_new_rows(self, table_name, hwm_column="scraped_at_epoch",
+                     chunk_size=CHUNK_SIZE):
+        """
+        Same as stream_new_rows, but returns the new rows as one dataframe
+        :return: A dataframe (empty if nothing is new)
+        """
+        import pandas as pd
+        chunks = list(self.stream_new_rows(table_name, hwm_column,
+                                           chunk_size))
+        if not chunks:
+            return pd.DataFrame()
+        return pd.concat(chunks, ignore_index=True)
+
+    def get_high_water_mark(self, table_name, hwm_column="scraped_at_epoch"):
+        """
+        :return: Last hwm_column value pulled from the table, or None
+        """
+        return self._high_water.get((table_name, hwm_column))
+
+    def get_high_water_key(self, table_name, hwm_column="scraped_at_epoch"):
+        """
+        :return: Key columns of the last row pulled from the table (see
+                 stream_new_rows), or None
+        """
+        last_key = self._high_water_keys.get((table_name, hwm_column))
+        return last_key if isinstance(last_key, tuple) else None
+
+    def set_high_water_mark(self, table_name, value,
+                            hwm_column="scraped_at_epoch", last_key=None):
+        """
+        Sets where the next incremental pull starts, e.g. to resume from a
+        value saved by a previous run. None pulls the whole table again.
+        :param last_key: Key columns of the last row pulled, saved with
+                         get_high_water_key. Without it, the rows at the
+                         mark are pulled again
+        :return: None
+        """
+        self._high_water[(table_name, hwm_column)] = value
+        self._high_water_keys[(table_name, hwm_column)] = \
+            None if last_key is None else tuple(last_key)
+
+    def insert(self, dframe, table_name, if_table_exists="append",
+               bulk=False):
         """
         Inserts the new data frame into the specified table.
         :param dframe: Dataframe containing the data
@@ -87,22 +550,270 @@ class SQLDatabaseManager:
             - fail: If table exists, do nothing.
             - replace: If table exists, drop it, recreate it, and insert data.
             - append: If table exists, insert data. Create if does not exist.
+        :param bulk: If True, appends of BULK_THRESHOLD rows or more go
+            through bulk_insert(). Default - False
+        :return: 1 if Success. -1 if fail.
+        """
+        if bulk and if_table_exists == "append" and \
+                len(dframe) >= BULK_THRESHOLD:
+            return self.bulk_insert(dframe, table_name)
+        start = time.perf_counter()
+        try:
+            with self._connection() as conn, conn.begin():
+                dframe.to_sql(name=table_name,
+                              if_exists=if_table_exists,
+                              con=conn,
+                              schema=self._database,
+                              index=False)
+        except Exception as e:
+            print(" An exception occured during Insert query")
+            print(e)
+            return -1
+        _query_seconds.labels("insert").observe(time.perf_counter() - start)
+        _rows_written_total.labels(table_name).inc(len(dframe))
+        return 1
+
+    def bulk_insert(self, dframe, table_name, method=BULK_AUTO,
+                    chunk_size=BULK_CHUNK):
+        """
+        Appends a large dataframe. With method=BULK_AUTO, MySQL tables get
+        LOAD DATA LOCAL INFILE from a temporary TSV file for frames of
+        LOAD_DATA_THRESHOLD rows or more; smaller frames, other databases,
+        and servers that refuse local files get chunked multi-row
+        executemany. The table is created from the frame if it does not
+        exist. Like insert(), the table is looked up in the database given
+        to connect(). The load rate is printed and exported as a metric.
+        :param dframe: Dataframe containing the data
+        :param table_name: Table name
+        :param method: BULK_AUTO, BULK_LOAD_DATA or BULK_EXECUTEMANY
+        :param chunk_size: Rows per executemany batch
         :return: 1 if Success. -1 if fail.
         """
+        if not len(dframe):
+            return 1
+        if table_name not in self._known_tables:
+            with self._connection() as conn:
+                table_exists = self._engine.dialect.has_table(
+                    conn, table_name, schema=self._database)
+            if not table_exists and self.insert(
+                    dframe=dframe.head(0), table_name=table_name) != 1:
+                return -1
+            self._known_tables.add(table_name)
+
+        if method == BULK_AUTO:
+            method = BULK_EXECUTEMANY
+            if self._engine.dialect.name == "mysql" and \
+                    self._load_data_allowed and \
+                    len(dframe) >= LOAD_DATA_THRESHOLD:
+                method = BULK_LOAD_DATA
+
+        start = time.perf_counter()
+        ret = -1
+        if method == BULK_LOAD_DATA:
+            ret = self._load_data(dframe, table_name)
+            if ret == 0:
+                print(" LOAD DATA LOCAL INFILE is not allowed. Falling "
+                      "back to executemany")
+                self._load_data_allowed = False
+                method = BULK_EXECUTEMANY
+        if method == BULK_EXECUTEMANY:
+            ret = self._executemany(dframe, table_name, chunk_size)
+        if ret != 1:
+            return ret
+
+        elapsed = time.perf_counter() - start
+        rate = len(dframe) / elapsed if elapsed > 0 else float(len(dframe))
+        _query_seconds.labels("bulk_" + method).observe(elapsed)
+        _rows_written_total.labels(table_name).inc(len(dframe))
+        _bulk_rows_per_second.labels(table_name, method).set(rate)
+        print(" Loaded", len(dframe), "rows into", table_name, "with",
+              method, "in", round(elapsed, 3), "s :", int(rate), "rows/s")
+        return 1
+
+    def _load_data(self, dframe, table_name):
+        """
+        Loads the frame with LOAD DATA LOCAL INFILE.
+        :return: 1 if Success. 0 if local files are refused. -1 if fail.
+        """
+        fd, path = tempfile.mkstemp(prefix="rtis_load_", suffix=".tsv")
+        os.close(fd)
+        try:
+            write_tsv(dframe, path)
+            columns = ", ".join("`" + name + "`" for name in dframe.columns)
+            target = "`" + table_name + "`"
+            if self._database:
+                target = "`" + self._database + "`." + target
+            statement = text(
+                "LOAD DATA LOCAL INFILE :path INTO TABLE " + target +
+                " CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' "
+                "ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' (" + columns +
+                ")")
+            with self._connection() as conn, conn.begin():
+                conn.execute(statement, {"path": path})
+        except Exception as e:
+            print(" An exception occured during LOAD DATA")
+            print(e)
+            args = getattr(getattr(e, "orig", None), "args", None) or (None,)
+            return 0 if args[0] in LOCAL_INFILE_REFUSED else -1
+        finally:
+            os.remove(path)
+        return 1
+
+    def _executemany(self, dframe, table_name, chunk_size):
+        statement = table(table_name,
+                          *[column(name) for name in dframe.columns],
+                          schema=self._database).insert()
         try:
-            dframe.to_sql(name=table_name,
-                          if_exists=if_table_exists,
-                          con=self._engine,
-                          schema=self._database,
-                          index=False)
+            with self._connection() as conn, conn.begin():
+                for i in range(0, len(dframe), chunk_size):
+                    chunk = dframe.iloc[i:i + chunk_size]
+                    chunk = chunk.astype(object).where(chunk.notna(), None)
+                    conn.execute(statement, chunk.to_dict("records"))
         except Exception as e:
             print(" An exception occured during Insert query")
             print(e)
             return -1
         return 1
 
+    def insert_rows(self, rows, table_name):
+        """
+        Inserts a batch of rows with one multi-row INSERT statement inside a
+        single transaction. Creates the table from the rows the first time
+        if it does not exist yet.
+        :param rows: List of dicts. Every dict must have the same keys
+        :param table_name: Table name
+        :return: 1 if Success. -1 if fail.
+        """
+        if not rows:
+            return 1
+        try:
+            if table_name not in self._known_tables:
+                with self._connection() as conn:
+                    table_exists = self._engine.dialect.has_table(conn,
+                                                                  table_name)
+                if not table_exists:
+                    import pandas as pd
+                    ret = self.insert(dframe=pd.DataFrame(rows),
+                                      table_name=table_name)
+                    if ret == 1:
+                        self._known_tables.add(table_name)
+                    return ret
+                self._known_tables.add(table_name)
+
+            start = time.perf_counter()
+            columns = [column(name) for name in rows[0]]
+            statement = table(table_name, *columns).insert().values(rows)
+            with self._connection() as conn, conn.begin():
+                conn.execute(statement)
+        except Exception as e:
+            print(" An exception occured during Insert query")
+            print(e)
+            return -1
+        _query_seconds.labels("insert_rows").observe(
+            time.perf_counter() - start)
+        _rows_written_total.labels(table_name).inc(len(rows))
+        return 1
+
+    def create_table(self, schema):
+        """
+        Creates a table from its declared schema if it does not exist yet,
+        with its indexes and (on MySQL) its partitions. The schema is
+        remembered for upserts even if the database cannot be reached; the
+        table is then created by the first upsert that gets through.
+        :param schema: TableSchema object
+        :return: 1 if Success. -1 if fail.
+        """
+        tbl = schema.table()
+        self._schemas[schema.name] = (schema, tbl)
+        try:
+            with self._connection() as conn, conn.begin():
+                exists = self._engine.dialect.has_table(conn, schema.name)
+                if not exists:
+                    tbl.create(conn)
+                    ddl = schema.partition_ddl()
+                    if ddl is not None and \
+                            self._engine.dialect.name == "mysql":
+                        conn.execute(text(ddl))
+        except Exception as e:
+            print(" An exception occured while creating table " +
+                  schema.name)
+            print(e)
+            return -1
+        self._known_tables.add(schema.name)
+        return 1
+
+    def _upsert_statement(self, tbl, schema, rows, update_columns):
+        dialect = self._engine.dialect.name
+        if dialect == "mysql":
+            from sqlalchemy.dialects.mysql import insert
+            statement = insert(tbl).values(rows)
+            if not update_columns:
+                return statement.prefix_with("IGNORE")
+            return statement.on_duplicate_key_update(
+                {name: statement.inserted[name] for name in update_columns})
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            statement = insert(tbl).values(rows)
+            if not update_columns:
+                return statement.on_conflict_do_nothing(
+                    index_elements=schema.primary_key)
+            return statement.on_conflict_do_update(
+                index_elements=schema.primary_key,
+                set_={name: statement.excluded[name]
+                      for name in update_columns})
+        raise NotImplementedError("upsert is not supported on " + dialect)
+
+    def upsert(self, rows, table_name, update_columns=None):
+        """
+        Inserts a batch of rows, updating the rows whose primary key already
+        exists (INSERT ... ON DUPLICATE KEY UPDATE on MySQL, ON CONFLICT DO
+        UPDATE on SQLite/PostgreSQL). The table must have been declared
+        with create_table. Rows sharing a primary key are collapsed to the
+        last one first, as one statement may not update a row twice on
+        PostgreSQL.
+        :param rows: List of dicts. Every dict must have the same keys
+        :param table_name: Table name
+        :param update_columns: Columns overwritten on a duplicate key.
+                               Defaults to every non-key column in the rows
+        :return: 1 if Success. -1 if fail.
+        """
+        if not rows:
+            return 1
+        if table_name not in self._schemas:
+            print(" No schema declared for table " + table_name +
+                  ". Call create_table first")
+            return -1
+        schema, tbl = self._schemas[table_name]
+        if table_name not in self._known_tables and \
+                self.create_table(schema) != 1:
+            return -1
+        if update_columns is None:
+            update_columns = [name for name in rows[0]
+                              if name not in schema.primary_key]
+        rows = list({tuple(row.get(name) for name in schema.primary_key): row
+                     for row in rows}.values())
+        start = time.perf_counter()
+        try:
+            with self._connection() as conn, conn.begin():
+                for i in range(0, len(rows), UPSERT_CHUNK):
+                    conn.execute(self._upsert_statement(
+                        tbl, schema, rows[i:i + UPSERT_CHUNK],
+                        update_columns))
+        except Exception as e:
+            print(" An exception occured during Upsert query")
+            print(e)
+            return -1
+        _query_seconds.labels("upsert").observe(time.perf_counter() - start)
+        _rows_written_total.labels(table_name).inc(len(rows))
+        return 1
+
     def disconnect(self):
-        self._engine.dispose()
+        # The engine is shared with other managers, so only let go of it
+        # here. Use dispose_engines() to close the pools.
+        self._engine = None
 
 
 def main():
@@ -0,0 +1,339 @@
+"""
+@file_name : ScrapeScheduler.py
+@author : Srihari Seshadri
+@description : This file schedules many search queries against one API rate
+                limit :
+                1. A token bucket models the rate limit (requests per
+                   window). Every page request takes a token, and a rate
+                   limit error empties the bucket until the window resets
+                2. Worker threads spend each token on the due query with
+                   the best recent hit rate (tweets per request)
+                3. Each query polls more often while it keeps finding
+                   tweets and less often when it does not, and backs off
+                   on its own after errors
+                4. Every query publishes through one shared Messenger and
+                   keeps its own since_id checkpoint
+@date : 12-03-2018
+"""
+
+import random
+import threading
+import time
+import Metrics
+
+RATE_LIMIT = 450            # requests per window (app auth search limit)
+RATE_WINDOW = 60*15         # seconds
+WORKERS = 4                 # queries fetched concurrently
+
+MIN_INTERVAL = 60           # seconds between two runs of a busy query
+MAX_INTERVAL = 60*30        # seconds between two runs of a quiet query
+HIT_RATE_DECAY = 0.3        # weight of the latest run in the hit rate
+BACKOFF_BASE = 30           # seconds, doubled for every failure in a row
+BACKOFF_MAX = 60*30         # seconds
+
+_requests_total = Metrics.counter(
+    "rtis_scrape_requests_total", "Search requests made", ("query",))
+_tweets_total = Metrics.counter(
+    "rtis_scrape_tweets_total", "Tweets scraped", ("query",))
+_errors_total = Metrics.counter(
+    "rtis_scrape_errors_total", "Failed query runs", ("query",))
+_rate_limited_total = Metrics.counter(
+    "rtis_scrape_rate_limited_total", "Rate limit errors from the API")
+_tokens_gauge = Metrics.gauge(
+    "rtis_scrape_rate_tokens", "Requests left in the rate budget")
+_token_wait_seconds = Metrics.histogram(
+    "rtis_scrape_token_wait_seconds",
+    "Time a worker waited for the rate budget")
+
+
+class TokenBucket:
+
+    def __init__(self, rate=RATE_LIMIT, window=RATE_WINDOW, capacity=None):
+        """
+        :param rate: Requests allowed per window
+        :param window: Length of the window in seconds
+        :param capacity: Largest burst. Defaults to a whole window's worth
+        """
+        self.window = window
+        self.fill_rate = rate / float(window)
+        self.capacity = float(rate if capacity is None else capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        pass
+
+    def _refill(self, now):
+        if now < self._paused_until:
+            self._updated = now
+            return
+        start = max(self._updated, self._paused_until)
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - start) * self.fill_rate)
+        self._updated = now
+
+    def tokens(self):
+        """
+        :return: Requests that can be made right now
+        """
+        with self._cond:
+            self._refill(time.monotonic())
+            return self._tokens
+
+    def acquire(self, timeout=None):
+        """
+        Takes one token, waiting for it if the budget is spent
+        :param timeout: Seconds to wait at most. None waits as long as needed
+        :return: True if a token was taken, False on timeout
+        """
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    _tokens_gauge.labels().set(self._tokens)
+                    _token_wait_seconds.labels().observe(now - start)
+                    return True
+                wait = max(self._paused_until - now,
+                           (1 - self._tokens) / self.fill_rate)
+                if timeout is not None:
+                    left = start + timeout - now
+                    if left <= 0:
+                        return False
+                    wait = min(wait, left)
+                self._cond.wait(wait)
+
+    def pause(self, until=None):
+        """
+        Empties the bucket, e.g. after the API reported the limit as reached
+        :param until: Epoch seconds the API's window resets at. Defaults to
+                      one window from now
+        :return: None
+        """
+        with self._cond:
+            now = time.monotonic()
+            seconds = self.window if until is None else until - time.time()
+            self._tokens = 0
+            self._paused_until = now + max(0.0, seconds)
+            self._updated = now
+            _tokens_gauge.labels().set(0)
+
+
+class QueryState:
+
+    def __init__(self, query, since_id=None):
+        self.query = query
+        self.since_id = since_id
+        self.hit_rate = 1.0         # tweets per request, optimistic at first
+        self.interval = MIN_INTERVAL
+        self.failures = 0
+        self.next_run = 0.0         # monotonic time the query is due
+        self.running = False
+        pass
+
+    def record_run(self, tweets, requests):
+        """
+        Updates the hit rate and the polling interval after a successful run
+        """
+        self.failures = 0
+        rate = tweets / float(max(requests, 1))
+        self.hit_rate += HIT_RATE_DECAY * (rate - self.hit_rate)
+        if tweets:
+            self.interval = max(MIN_INTERVAL, self.interval / 2)
+        else:
+            self.interval = min(MAX_INTERVAL, self.interval * 2)
+        self.next_run = time.monotonic() + self.interval
+
+    def record_failure(self):
+        self.failures += 1
+        backoff = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.failures - 1))
+        # Jitter keeps queries that failed together from retrying together
+        self.next_run = time.monotonic() + backoff * random.uniform(0.5, 1)
+        return backoff
+
+
+class ScrapeScheduler:
+
+    def __init__(self, queries, fetch, publish, messenger, checkpoint=None,
+                 save_checkpoint=None, bucket=None, workers=WORKERS,
+                 rate_limit_errors=()):
+        """
+        :param queries: List of search queries
+        :param fetch: Function (query, since_id) returning an iterator over
+                      pages (lists of tweet dicts). Each page is one request
+        :param publish: Function (messenger, tweets) returning the number of
+                        tweets acked
+        :param messenger: Connected Messenger shared by every query
+        :param checkpoint: dict of query -> since_id to resume from
+        :param save_checkpoint: Function storing the checkpoint dict
+        :param bucket: TokenBucket. Defaults to RATE_LIMIT per RATE_WINDOW
+        :param workers: Number of queries fetched at the same time
+        :param rate_limit_errors: Exception classes meaning the rate limit
+                                  was hit
+        """
+        self._fetch = fetch
+        self._publish = publish
+        self._messenger = messenger
+        self._checkpoint = dict(checkpoint or {})
+        self._save_checkpoint = save_checkpoint
+        self.bucket = bucket if bucket is not None else TokenBucket()
+        self._workers = workers
+        self._rate_limit_errors = tuple(rate_limit_errors)
+        self.states = {query: QueryState(query, self._checkpoint.get(query))
+                       for query in queries}
+        self._cond = threading.Condition()
+        self._publish_lock = threading.Lock()
+        self._checkpoint_lock = threading.Lock()
+        self._threads = []
+        self._stopping = False
+        pass
+
+    def _next_query(self):
+        """
+        Waits for a due query and claims the one with the best hit rate
+        :return: QueryState, or None when stopping
+        """
+        with self._cond:
+            while not self._stopping:
+                now = time.monotonic()
+                due = [state for state in self.states.values()
+                       if not state.running and state.next_run <= now]
+                if due:
+                    state = max(due, key=lambda s: s.hit_rate)
+                    state.running = True
+                    return state
+                waiting = [state.next_run for state in self.states.values()
+                           if not state.running]
+                self._cond.wait(min(waiting) - now if waiting else None)
+            return None
+
+    def _release(self, state):
+        with self._cond:
+            state.running = False
+            self._cond.notify_all()
+
+    def _acquire(self):
+        """
+        Waits for a token, giving up if the scheduler is stopped meanwhile
+        """
+        while not self.bucket.acquire(timeout=1):
+            if self._stopping:
+                return False
+        return True
+
+    def run_query(self, state):
+        """
+        Fetches and publishes the new tweets of one query, spending a token
+        per page
+        :param state: QueryState
+        :return: 1 if success, -1 if failure
+        """
+        since_id = state.since_id
+        high_water = since_id
+        all_acked = True
+        tweets = requests = 0
+        try:
+            pages = iter(self._fetch(state.query, since_id))
+            while True:
+                if not self._acquire():
+                    break
+                requests += 1
+                _requests_total.labels(state.query).inc()
+                tweet_list = next(pages, None)
+                if tweet_list is None:
+                    break
+                if not tweet_list:
+                    continue
+                tweets += len(tweet_list)
+                with self._publish_lock:
+                    if self._messenger.ensure_connected() != 1:
+                        raise ConnectionError("Data hub unreachable")
+                    acked = self._publish(self._messenger, tweet_list)
+                if acked != len(tweet_list):
+                    all_acked = False
+                page_max = max(int(tweet['id_str']) for tweet in tweet_list)
+                high_water = max(high_water or 0, page_max)
+        except self._rate_limit_errors as e:
+            _rate_limited_total.labels().inc()
+            reset = _rate_limit_reset(e)
+            print("Rate limit reached. Pausing every query until",
+                  time.ctime(reset) if reset else "the window resets")
+            self.bucket.pause(until=reset)
+            # Not the query's fault : it runs again as soon as possible
+            state.next_run = time.monotonic()
+            return -1
+        except Exception as e:
+            _errors_total.labels(state.query).inc()
+            backoff = state.record_failure()
+            print("Error while scraping", state.query, ":", e)
+            print("Retrying this query in about", int(backoff), "seconds")
+            return -1
+        finally:
+            _tweets_total.labels(state.query).inc(tweets)
+
+        # Search results go from newest to oldest, so the high-water mark is
+        # only safe to store once the whole run has been shipped
+        if all_acked and high_water != since_id:
+            state.since_id = high_water
+            with self._checkpoint_lock:
+                self._checkpoint[state.query] = high_water
+                if self._save_checkpoint is not None:
+                    self._save_checkpoint(dict(self._checkpoint))
+        state.record_run(tweets, requests)
+        return 1
+
+    def _work(self):
+        while True:
+            state = self._next_query()
+            if state is None:
+                return
+            try:
+                self.run_query(state)
+            finally:
+                self._release(state)
+
+    def start(self):
+        """
+        Starts the worker threads
+        :return: None
+        """
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._work,
+                                      name="scraper-" + str(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        Lets the running queries finish and stops the workers
+        :return: None
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def run_forever(self):
+        self.start()
+        try:
+            while any(thread.is_alive() for thread in self._threads):
+                time.sleep(1)
+        finally:
+            self.stop()
+
+
+def _rate_limit_reset(error):
+    """
+    :return: Epoch seconds the rate limit resets at, from the response
+             headers of the error if it has them, else None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return int(headers["x-rate-limit-reset"])
+    except (KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,74 @@
+"""
+@file_name : ShardRouter.py
+@author : Srihari Seshadri
+@description : This file defines the consistent hash ring used to spread
+                tweets over a fleet of cleaner processes :
+                1. Maps a key (e.g. a tweet's id_str) onto one of K shards
+                2. Builds the routing keys and queue names of each shard
+@date : 12-03-2018
+"""
+
+import bisect
+import hashlib
+
+VIRTUAL_NODES = 64      # points on the ring per shard
+
+
+def shard_topic(base_topic, shard):
+    """
+    Routing key of a shard, e.g. "tweet.shard.3"
+    """
+    return base_topic + ".shard." + str(shard)
+
+
+def shard_queue(base_name, shard):
+    """
+    Name of the durable queue shared by the workers of a shard
+    """
+    return base_name + "_shard_" + str(shard)
+
+
+def _hash(key):
+    digest = hashlib.md5(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+class ConsistentHashRing:
+
+    def __init__(self, num_shards, virtual_nodes=VIRTUAL_NODES):
+        """
+        :param num_shards: Number of shards (K)
+        :param virtual_nodes: Points on the ring per shard. More points give
+                              a more even spread of keys
+        """
+        self._num_shards = num_shards
+        points = []
+        for shard in range(num_shards):
+            for vnode in range(virtual_nodes):
+                points.append((_hash(str(shard) + "#" + str(vnode)), shard))
+        points.sort()
+        self._hashes = [h for h, _ in points]
+        self._shards = [s for _, s in points]
+        pass
+
+    @property
+    def num_shards(self):
+        return self._num_shards
+
+    def get_shard(self, key):
+        """
+        Finds the shard that owns a key. The same key always maps to the
+        same shard, and changing K only moves about 1/K of the keys.
+        :param key: String key, e.g. a tweet's id_str
+        :return: shard number in [0, K)
+        """
+        index = bisect.bisect(self._hashes, _hash(key))
+        if index == len(self._hashes):
+            index = 0
+        return self._shards[index]
+
+    def get_topic(self, key, base_topic):
+        """
+        Routing key for the shard that owns a key
+        """
+        return shard_topic(base_topic, self.get_shard(key))
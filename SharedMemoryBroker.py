@@ -0,0 +1,801 @@
+"""
+@file_name : SharedMemoryBroker.py
+@author : Srihari Seshadri
+@description : This file defines a brokerless transport for pipeline stages
+                running on the same machine. Every exchange is a ring buffer
+                in shared memory that all processes append to, and each
+                process routes what it reads into its own in-process queues
+                (see FakeBroker) :
+                1. One multiprocessing.shared_memory ring per exchange,
+                   guarded by flock so any process may publish
+                2. Topic/direct/fanout routing on the consumer side
+                3. A private read cursor per exclusive queue, and a cursor
+                   in shared memory for named queues so that consumers in
+                   several processes share the work
+                Every read cursor registers its position in the ring, and a
+                publisher never overwrites a record a registered reader has
+                not taken : it waits for the slowest one (counted in
+                rtis_shm_blocked_appends_total), and raises TimeoutError
+                after APPEND_TIMEOUT. Readers of dead processes are dropped
+                from the ring. A process whose consumers lag far behind
+                moves the records it would block on into its local queues.
+                Messages a process has taken but not acked are still lost
+                if it dies : this transport does not offer the broker's
+                redelivery.
+                Every process attached to a segment holds a shared flock on
+                <tmp>/<segment>.users. The last process to close its broker
+                (at exit at the latest) unlinks the segment. Segments left
+                behind by processes that crashed are unlinked by the next
+                broker created in the namespace, or when their name is
+                attached again.
+                Select it with RTIS_TRANSPORT=shm (see Transport.py)
+@date : 11-14-2018
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import pika
+
+import Metrics
+from FakeBroker import FakeBroker, topic_matches
+
+NAMESPACE_ENV = "RTIS_SHM_NAMESPACE"
+NAMESPACE = os.environ.get(NAMESPACE_ENV, "rtis")
+RING_CAPACITY = 64 * 1024 * 1024    # bytes of messages kept per exchange
+PUMP_BATCH = 256            # records read from a ring per queue and pass
+LOCAL_QUEUE_LIMIT = 1024    # stop reading for a queue this far behind
+IDLE_SLEEP_MIN = 0.00005    # seconds
+IDLE_SLEEP_MAX = 0.002      # seconds
+MAX_READERS = 64            # read cursors registered per ring
+APPEND_TIMEOUT = 30.0       # seconds a publisher waits for slow readers
+REAP_INTERVAL = 1.0         # seconds between checks for dead readers
+# A consumer this far behind (fraction of the ring) reads past
+# LOCAL_QUEUE_LIMIT, so a process that publishes to a ring it also
+# consumes cannot block itself
+PRESSURE = 0.5
+
+_MAGIC = 0x52544953         # "RTIS"
+_RING_HEADER = struct.Struct("<IIQQ")    # magic, version, capacity, head
+_RING_VERSION = 2
+# Reader table : in use, pid (0 for a named queue's shared cursor),
+# position, cursor segment name (named queues)
+_READER = struct.Struct("<IIQ240s")
+_READER_POSITION = 8        # offset of the position in a reader entry
+_RING_HEADER_SIZE = 64 + MAX_READERS * _READER.size
+_RECORD_HEADER = struct.Struct("<IHI")   # length, key length, props length
+_CURSOR = struct.Struct("<QQ")           # initialised flag, position
+_WRAP = 0                   # record length marking the end of a lap
+
+_overruns_total = Metrics.counter(
+    "rtis_shm_overruns_total",
+    "Times a shared memory consumer fell a whole ring behind and skipped "
+    "ahead", ("exchange",))
+_blocked_total = Metrics.counter(
+    "rtis_shm_blocked_appends_total",
+    "Times a shared memory publisher waited for the slowest reader",
+    ("exchange",))
+_reclaimed_total = Metrics.counter(
+    "rtis_shm_reclaimed_segments_total",
+    "Shared memory segments left behind by dead processes and unlinked")
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def _segment_name(namespace, *parts):
+    name = "_".join((namespace,) + tuple(p or "default" for p in parts))
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def _users_path(name):
+    return os.path.join(tempfile.gettempdir(), name + ".users")
+
+
+def _unlink_name(name):
+    """
+    Removes a segment by name, whoever created it
+    :return: True if there was one
+    """
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+    segment.close()
+    _unlink(segment)
+    return True
+
+
+def _attach(name, size):
+    """
+    Opens a shared memory segment, creating it if needed, and registers this
+    process as one of its users. A segment without users was left behind by
+    processes that died : it is unlinked and created afresh. The segment
+    outlives this process : the resource tracker would otherwise unlink it
+    as soon as the process that created it exits. Must be called under the
+    segment's _FileLock.
+    :return: (SharedMemory, True if it was created, users file descriptor)
+    """
+    users = os.open(_users_path(name), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if _unlink_name(name):
+            _reclaimed_total.labels().inc()
+            print("Reclaimed stale shared memory segment", name)
+    except BlockingIOError:
+        pass
+    try:
+        segment = shared_memory.SharedMemory(name=name, create=True,
+                                             size=size)
+        created = True
+    except FileExistsError:
+        segment = shared_memory.SharedMemory(name=name)
+        created = False
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    except Exception:
+        pass
+    # Held until _detach, and dropped by the kernel if this process dies
+    fcntl.flock(users, fcntl.LOCK_SH)
+    return segment, created, users
+
+
+def _detach(segment, users, unlink=False):
+    """
+    Closes this process's mapping and users lock, and unlinks the segment
+    if no other process uses it. Must be called under the segment's
+    _FileLock.
+    :param unlink: Unlink the segment even if other processes use it
+    :return: True if no other process uses the segment any more
+    """
+    segment.close()
+    fcntl.flock(users, fcntl.LOCK_UN)
+    last = True
+    try:
+        if not unlink:
+            fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        _unlink(segment)
+    except BlockingIOError:
+        last = False
+    except FileNotFoundError:
+        pass
+    os.close(users)
+    return last
+
+
+def _has_users(name):
+    """
+    :return: True if a live process is attached to the segment
+    """
+    try:
+        users = os.open(_users_path(name), os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(users)
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _close_lock(lock, remove):
+    lock.close()
+    if remove:
+        for path in (lock.path, _users_path(os.path.basename(lock.path)[
+                :-len(".lock")])):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def reclaim_stale(namespace=NAMESPACE):
+    """
+    Unlinks the segments of a namespace that no live process uses
+    :param namespace: Prefix of the shared memory segments
+    :return: Number of segments unlinked
+    """
+    if not os.path.isdir("/dev/shm"):
+        return 0
+    reclaimed = 0
+    for name in os.listdir("/dev/shm"):
+        if not name.startswith(namespace + "_"):
+            continue
+        lock = _FileLock(name)
+        users = os.open(_users_path(name), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            with lock:
+                try:
+                    fcntl.flock(users, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                if _unlink_name(name):
+                    reclaimed += 1
+                    _reclaimed_total.labels().inc()
+        finally:
+            os.close(users)
+            lock.close()
+    if reclaimed:
+        print("Reclaimed", reclaimed, "stale shared memory segments of",
+              namespace)
+    return reclaimed
+
+
+def _unlink(segment):
+    # SharedMemory.unlink() unregisters from the resource tracker, which
+    # _attach() already did
+    resource_tracker.register(segment._name, "shared_memory")
+    segment.unlink()
+
+
+class _FileLock:
+    """
+    flock based lock shared by every process, and by every thread of this
+    process (flock alone does not exclude threads sharing a descriptor)
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(tempfile.gettempdir(), name + ".lock")
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        self._lock = threading.Lock()
+        pass
+
+    def acquire(self, shared=False):
+        self._lock.acquire()
+        fcntl.flock(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def close(self):
+        os.close(self._fd)
+
+
+class SharedRing:
+    """
+    Append-only log of (routing key, properties, body) records in a shared
+    memory segment. Positions are logical byte offsets that only grow. The
+    readers registered in the ring's header hold back the writers, so a
+    record stays readable until every one of them has read past it.
+    """
+
+    def __init__(self, name, capacity=RING_CAPACITY):
+        self.name = name
+        self._lock = _FileLock(name)
+        with self._lock:
+            self._segment, created, self._users = _attach(
+                name, _RING_HEADER_SIZE + _align(capacity))
+            self._buf = self._segment.buf
+            if created:
+                _RING_HEADER.pack_into(self._buf, 0, _MAGIC, _RING_VERSION,
+                                       _align(capacity), 0)
+            magic, version, self.capacity, _ = _RING_HEADER.unpack_from(
+                self._buf, 0)
+        if magic != _MAGIC or version != _RING_VERSION:
+            raise ValueError("Shared memory segment " + name +
+                             " is not a version " + str(_RING_VERSION) +
+                             " RTIS ring")
+        self._last_reap = 0.0
+        # Readers only move forward, so the slowest position seen is a
+        # lower bound that spares a scan of the reader table per append
+        self._slowest = 0
+        pass
+
+    def _head(self):
+        return _RING_HEADER.unpack_from(self._buf, 0)[3]
+
+    def head(self):
+        """
+        :return: Position the next record will be written at
+        """
+        self._lock.acquire(shared=True)
+        try:
+            return self._head()
+        finally:
+            self._lock.release()
+
+    def _reader_offset(self, slot):
+        return _RING_HEADER.size + slot * _READER.size
+
+    def _readers(self):
+        """
+        :return: List of (slot, pid, position, name) of registered readers
+        """
+        readers = []
+        for slot in range(MAX_READERS):
+            in_use, pid, position, name = _READER.unpack_from(
+                self._buf, self._reader_offset(slot))
+            if in_use:
+                readers.append((slot, pid, position,
+                                name.rstrip(b"\0").decode("utf-8")))
+        return readers
+
+    def register(self, name=None, position=None):
+        """
+        Registers a read cursor, so writers wait for it. Named queues share
+        one entry between the processes reading them.
+        :param name: Segment name of a shared cursor, None for a cursor of
+                     this process only
+        :param position: Position of the cursor. Defaults to the head
+        :return: Reader slot
+        """
+        with self._lock:
+            position = self._head() if position is None else position
+            free = None
+            for slot in range(MAX_READERS):
+                in_use, _, _, slot_name = _READER.unpack_from(
+                    self._buf, self._reader_offset(slot))
+                if not in_use:
+                    free = slot if free is None else free
+                elif name is not None and \
+                        slot_name.rstrip(b"\0").decode("utf-8") == name:
+                    struct.pack_into("<Q", self._buf,
+                                     self._reader_offset(slot) +
+                                     _READER_POSITION, position)
+                    return slot
+            if free is None:
+                raise ValueError("Too many readers of shared memory ring " +
+                                 self.name)
+            _READER.pack_into(self._buf, self._reader_offset(free), 1,
+                              0 if name is not None else os.getpid(),
+                              position, (name or "").encode("utf-8"))
+            return free
+
+    def unregister(self, slot):
+        """
+        Lets the writers go past a reader that went away
+        """
+        with self._lock:
+            if self._buf is not None:
+                _READER.pack_into(self._buf, self._reader_offset(slot), 0,
+                                  0, 0, b"")
+
+    def _reap(self):
+        """
+        Unregisters the readers of processes that died. Must be called
+        under the lock
+        """
+        self._last_reap = time.monotonic()
+        for slot, pid, _, name in self._readers():
+            alive = _process_alive(pid) if pid else _has_users(name)
+            if not alive:
+                _READER.pack_into(self._buf, self._reader_offset(slot), 0,
+                                  0, 0, b"")
+                print("Dropped the shared memory reader of a dead process "
+                      "from", self.name)
+
+    def _room(self, head, size):
+        """
+        :return: Position after the record once written, or None if that
+                 would overwrite a record a reader still has to take
+        """
+        offset = head % self.capacity
+        end = head + size
+        if self.capacity - offset < size:
+            end += self.capacity - offset
+        if end - self._slowest > self.capacity:
+            self._slowest = min([position for _, _, position, _ in
+                                 self._readers()], default=head)
+            if end - self._slowest > self.capacity:
+                return None
+        return end
+
+    def append(self, routing_key, properties, body, timeout=None):
+        """
+        Writes one record, waiting for the slowest reader if the ring is
+        full
+        :param routing_key: String
+        :param properties: Serialised properties (bytes)
+        :param body: Bytes
+        :param timeout: Seconds to wait for room. Defaults to APPEND_TIMEOUT
+        :return: Position of the record
+        :raises TimeoutError: if the readers did not make room in time
+        """
+        key = routing_key.encode("utf-8")
+        length = _RECORD_HEADER.size + len(key) + len(properties) + len(body)
+        size = _align(length)
+        if size > self.capacity // 2:
+            raise ValueError("Message of " + str(length) + " bytes is too "
+                             "large for the shared memory ring")
+        timeout = APPEND_TIMEOUT if timeout is None else timeout
+        deadline = None
+        idle = IDLE_SLEEP_MIN
+        while True:
+            self._lock.acquire()
+            if self._room(self._head(), size) is not None:
+                break
+            if time.monotonic() - self._last_reap > REAP_INTERVAL:
+                self._reap()
+                if self._room(self._head(), size) is not None:
+                    break
+            self._lock.release()
+            if deadline is None:
+                _blocked_total.labels(self.name).inc()
+                deadline = time.monotonic() + timeout
+            elif time.monotonic() > deadline:
+                raise TimeoutError("Readers of shared memory ring " +
+                                   self.name + " made no room for " +
+                                   str(timeout) + " s")
+            time.sleep(idle)
+            idle = min(idle * 2, IDLE_SLEEP_MAX)
+        try:
+            head = self._head()
+            offset = head % self.capacity
+            if self.capacity - offset < size:
+                # Records never straddle the end of the ring
+                struct.pack_into("<I", self._buf, _RING_HEADER_SIZE + offset,
+                                 _WRAP)
+                head += self.capacity - offset
+                offset = 0
+            start = _RING_HEADER_SIZE + offset
+            _RECORD_HEADER.pack_into(self._buf, start, length, len(key),
+                                     len(properties))
+            start += _RECORD_HEADER.size
+            for chunk in (key, properties, body):
+                self._buf[start:start + len(chunk)] = chunk
+                start += len(chunk)
+            _RING_HEADER.pack_into(self._buf, 0, _MAGIC, _RING_VERSION,
+                                   self.capacity, head + size)
+        finally:
+            self._lock.release()
+        return head
+
+    def read(self, position, limit=PUMP_BATCH, slot=None):
+        """
+        Reads the records written since a position
+        :param position: Position to read from
+        :param limit: Maximum number of records
+        :param slot: Reader slot to move to the next position
+        :return: (list of (routing key, properties, body), next position,
+                 True if the position had been overwritten)
+        """
+        records = []
+        self._lock.acquire(shared=True)
+        try:
+            head = self._head()
+            if head - position > self.capacity:
+                # Only readers that are not registered can fall behind
+                return records, head, True
+            while position < head and len(records) < limit:
+                offset = position % self.capacity
+                start = _RING_HEADER_SIZE + offset
+                length = struct.unpack_from("<I", self._buf, start)[0]
+                if length == _WRAP:
+                    position += self.capacity - offset
+                    continue
+                _, key_len, props_len = _RECORD_HEADER.unpack_from(self._buf,
+                                                                   start)
+                start += _RECORD_HEADER.size
+                key = bytes(self._buf[start:start + key_len])
+                start += key_len
+                properties = bytes(self._buf[start:start + props_len])
+                start += props_len
+                body = bytes(self._buf[start:_RING_HEADER_SIZE + offset +
+                                       length])
+                records.append((key.decode("utf-8"), properties, body))
+                position += _align(length)
+            if slot is not None:
+                # Only this cursor writes its entry
+                struct.pack_into("<Q", self._buf, self._reader_offset(slot) +
+                                 _READER_POSITION, position)
+        finally:
+            self._lock.release()
+        return records, position, False
+
+    def close(self, unlink=False):
+        """
+        Detaches from the ring. The last process to detach unlinks it
+        :param unlink: Unlink it even if other processes still use it
+        """
+        with self._lock:
+            self._buf = None
+            _detach(self._segment, self._users, unlink)
+        _close_lock(self._lock, unlink)
+
+
+class _LocalCursor:
+    """
+    Read position of a queue only this process reads
+    """
+
+    def __init__(self, ring):
+        self._ring = ring
+        self._position = ring.head()
+        self._slot = ring.register(position=self._position)
+        pass
+
+    def pull(self, limit):
+        records, self._position, overrun = self._ring.read(
+            self._position, limit, self._slot)
+        return records, overrun
+
+    def holds_back_writers(self):
+        """
+        :return: True once the cursor is more than half a ring behind
+        """
+        return self._ring.head() - self._position > \
+            self._ring.capacity * PRESSURE
+
+    def close(self, unlink=False):
+        self._ring.unregister(self._slot)
+
+
+class _SharedCursor:
+    """
+    Read position of a named queue, kept in shared memory so that the
+    consumers of every process take turns on it
+    """
+
+    def __init__(self, ring, name):
+        self._ring = ring
+        self._lock = _FileLock(name)
+        with self._lock:
+            self._segment, _, self._users = _attach(name, _CURSOR.size)
+            initialised, position = _CURSOR.unpack_from(self._segment.buf,
+                                                        0)
+            if not initialised:
+                position = ring.head()
+                _CURSOR.pack_into(self._segment.buf, 0, 1, position)
+            self._slot = ring.register(name=name, position=position)
+        pass
+
+    def pull(self, limit):
+        with self._lock:
+            _, position = _CURSOR.unpack_from(self._segment.buf, 0)
+            records, position, overrun = self._ring.read(position, limit,
+                                                         self._slot)
+            _CURSOR.pack_into(self._segment.buf, 0, 1, position)
+        return records, overrun
+
+    def holds_back_writers(self):
+        """
+        :return: True once the cursor is more than half a ring behind
+        """
+        with self._lock:
+            _, position = _CURSOR.unpack_from(self._segment.buf, 0)
+        return self._ring.head() - position > \
+            self._ring.capacity * PRESSURE
+
+    def close(self, unlink=False):
+        """
+        Detaches from the cursor. The last process to detach unlinks it
+        :param unlink: Unlink it even if other processes still use it
+        """
+        with self._lock:
+            if _detach(self._segment, self._users, unlink):
+                self._ring.unregister(self._slot)
+        _close_lock(self._lock, unlink)
+
+
+def _pack_properties(properties):
+    return json.dumps([properties.content_type,
+                       properties.content_encoding,
+                       properties.headers]).encode("utf-8")
+
+
+def _unpack_properties(data):
+    content_type, content_encoding, headers = json.loads(data)
+    return pika.BasicProperties(content_type=content_type,
+                                content_encoding=content_encoding,
+                                headers=headers)
+
+
+class SharedMemoryBroker(FakeBroker):
+
+    def __init__(self, namespace=NAMESPACE, capacity=RING_CAPACITY):
+        """
+        :param namespace: Prefix of the shared memory segments. Processes
+                          only see each other within a namespace
+        :param capacity: Ring size in bytes of exchanges created by this
+                         process
+        """
+        super().__init__()
+        self._namespace = namespace
+        self._capacity = capacity
+        self._rings = {}
+        self._cursors = {}      # (queue, exchange) -> cursor
+        self._pump = None
+        self._running = False
+        reclaim_stale(namespace)
+        # Detach at exit, so that the last process out unlinks the segments
+        atexit.register(self.close)
+        pass
+
+    def _ring(self, exchange):
+        with self._cond:
+            ring = self._rings.get(exchange)
+            if ring is None:
+                ring = SharedRing(_segment_name(self._namespace, "ex",
+                                                exchange),
+                                  self._capacity)
+                self._rings[exchange] = ring
+            return ring
+
+    def declare_exchange(self, name, ex_type):
+        super().declare_exchange(name, ex_type)
+        self._ring(name)
+
+    def bind(self, exchange, queue, routing_key):
+        super().bind(exchange, queue, routing_key)
+        with self._cond:
+            if (queue, exchange) in self._cursors:
+                return
+            ring = self._ring(exchange)
+            local = self._queues[queue]
+            if local.exclusive_owner is not None or \
+                    queue.startswith("amq.gen-"):
+                cursor = _LocalCursor(ring)
+            else:
+                cursor = _SharedCursor(ring, _segment_name(
+                    self._namespace, "q", exchange, queue))
+            self._cursors[(queue, exchange)] = cursor
+            self._start_pump()
+
+    def route(self, exchange, routing_key, body, properties):
+        """
+        Appends the message to the exchange's ring. Every process with a
+        matching binding picks it up from there, this one included.
+        :return: 1
+        """
+        self._ring(exchange).append(routing_key,
+                                    _pack_properties(properties), body)
+        with self._cond:
+            self.published += 1
+        return 1
+
+    def drop_owned_queues(self, owner):
+        with self._cond:
+            names = [name for name, queue in self._queues.items()
+                     if queue.exclusive_owner is owner]
+            super().drop_owned_queues(owner)
+            for key in [k for k in self._cursors if k[0] in names]:
+                self._cursors.pop(key).close()
+
+    def _matches(self, exchange, queue_name, routing_key):
+        ex_type = self._exchanges.get(exchange, "topic")
+        if exchange == "":
+            return routing_key == queue_name
+        keys = [key for ex, key, name in self._bindings
+                if ex == exchange and name == queue_name]
+        if ex_type == "fanout":
+            return bool(keys)
+        if ex_type == "direct":
+            return routing_key in keys
+        return any(topic_matches(key, routing_key) for key in keys)
+
+    def _start_pump(self):
+        if self._pump is None:
+            self._running = True
+            self._pump = threading.Thread(target=self._run_pump,
+                                          name="shm-pump", daemon=True)
+            self._pump.start()
+
+    def _pump_once(self):
+        """
+        Moves new records from the rings into the local queues
+        :return: Number of records read
+        """
+        with self._cond:
+            cursors = list(self._cursors.items())
+        read = 0
+        for (queue_name, exchange), cursor in cursors:
+            with self._cond:
+                queue = self._queues.get(queue_name)
+                if queue is None:
+                    continue
+                room = LOCAL_QUEUE_LIMIT - len(queue.messages)
+                # Named queues are shared : only take work we can start on
+                idle = isinstance(cursor, _SharedCursor) and \
+                    not queue.consumers
+                if idle:
+                    room = 0
+            if room <= 0 and not idle and cursor.holds_back_writers():
+                # Take records past the limit rather than hold the
+                # publishers back : one of them may be this process
+                room = PUMP_BATCH
+            if room <= 0:
+                continue
+            records, overrun = cursor.pull(min(room, PUMP_BATCH))
+            if overrun:
+                _overruns_total.labels(exchange).inc()
+                print("Shared memory consumer of", queue_name,
+                      "fell behind the ring. Skipping ahead ....")
+            if not records:
+                continue
+            read += len(records)
+            with self._cond:
+                for routing_key, properties, body in records:
+                    if self._matches(exchange, queue_name, routing_key):
+                        queue.messages.append((exchange, routing_key, body,
+                                               _unpack_properties(
+                                                   properties), False))
+                self._cond.notify_all()
+        return read
+
+    def _run_pump(self):
+        idle = IDLE_SLEEP_MIN
+        while self._running:
+            try:
+                read = self._pump_once()
+            except Exception as e:
+                print("Exception caught while reading shared memory :")
+                print(e)
+                read = 0
+            if read:
+                idle = IDLE_SLEEP_MIN
+            else:
+                time.sleep(idle)
+                idle = min(idle * 2, IDLE_SLEEP_MAX)
+
+    def close(self, unlink=False):
+        """
+        Stops reading and detaches from the shared memory. Segments no
+        other process is attached to are unlinked. Runs at exit
+        :param unlink: Also remove the segments other processes still use,
+                       e.g. at the end of a benchmark. They keep working on
+                       their mapping.
+        :return: None
+        """
+        self._running = False
+        if self._pump is not None:
+            self._pump.join()
+            self._pump = None
+        with self._cond:
+            for cursor in self._cursors.values():
+                cursor.close(unlink)
+            for ring in self._rings.values():
+                ring.close(unlink)
+            self._cursors = {}
+            self._rings = {}
+
+
+def get_broker(namespace=NAMESPACE):
+    """
+    Returns this process's broker for a namespace, creating it on first use.
+    A forked child gets its own.
+    :param namespace: Prefix of the shared memory segments
+    :return: SharedMemoryBroker object
+    """
+    key = (os.getpid(), namespace)
+    with _brokers_lock:
+        broker = _brokers.get(key)
+        if broker is None:
+            broker = SharedMemoryBroker(namespace=namespace)
+            _brokers[key] = broker
+    return broker
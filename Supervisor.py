@@ -0,0 +1,350 @@
+"""
+@file_name : Supervisor.py
+@author : Srihari Seshadri
+@description : This file runs a pool of worker processes per pipeline stage
+                (e.g. the cleaner and the store) and sizes each pool from
+                the depth of the stage's shared queue on the data hub :
+                1. Polls the queue depth and consumer count
+                2. Adds a worker when the backlog stays above the stage's
+                   threshold, and retires one when it stays below, with
+                   hysteresis and a cooldown so pools do not flap
+                3. Retires workers with SIGTERM, so they finish and ack what
+                   they started and commit their batch before exiting.
+                   Unacked prefetched messages go back to the queue.
+                4. Restarts workers that crash
+                5. Records how long new workers take to start consuming
+@date : 12-03-2018
+"""
+
+import importlib
+import multiprocessing
+import signal
+import time
+import pika
+import Metrics
+import Transport
+
+DATA_HUB_HOST = ''
+DATA_HUB_UNAME = 'admin'
+DATA_HUB_PWD = 'password'
+
+POLL_INTERVAL = 1       # seconds between queue depth polls
+UP_POLLS = 3            # polls above the threshold before adding a worker
+DOWN_POLLS = 30         # polls below the threshold before retiring one
+COOLDOWN = 10           # seconds between two scaling actions of a stage
+DRAIN_TIMEOUT = 30      # seconds a retired worker gets before it is killed
+START_METHOD = "spawn"  # fresh interpreters, nothing inherited from here
+
+# Metrics are served at http://host:METRICS_PORT/
+METRICS_PORT = 9140
+
+_workers_gauge = Metrics.gauge(
+    "rtis_workers", "Worker processes running per stage", ("stage",))
+_depth_gauge = Metrics.gauge(
+    "rtis_queue_depth", "Messages waiting in the stage's queue", ("stage",))
+_startup_seconds = Metrics.histogram(
+    "rtis_worker_startup_seconds",
+    "Time from spawning a worker to it consuming from its queue",
+    ("stage",))
+_import_seconds = Metrics.histogram(
+    "rtis_worker_import_seconds",
+    "Time a new worker spends importing its stage module", ("stage",))
+_restarts = Metrics.counter(
+    "rtis_worker_restarts_total", "Workers that exited unexpectedly",
+    ("stage",))
+
+
+class Stage:
+
+    def __init__(self, name, module, queue, kwargs=None, min_workers=1,
+                 max_workers=4, up_depth=1000, down_depth=100):
+        """
+        :param name: Name of the stage, used in logs and metrics
+        :param module: Module whose main() runs one worker. main() is called
+                       with queue_name, slot and kwargs, and must return
+                       once the worker drained after SIGTERM
+        :param queue: Shared durable queue the workers consume from
+        :param kwargs: Extra arguments for main()
+        :param min_workers: Workers kept running at all times
+        :param max_workers: Upper bound of the pool
+        :param up_depth: Queued messages per worker above which a worker is
+                         added
+        :param down_depth: Queued messages per remaining worker below which
+                           a worker is retired
+        """
+        self.name = name
+        self.module = module
+        self.queue = queue
+        self.kwargs = dict(kwargs or {})
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.up_depth = up_depth
+        self.down_depth = down_depth
+        pass
+
+
+class _Worker:
+
+    def __init__(self, process, slot, import_seconds):
+        self.process = process
+        self.slot = slot
+        self.started = time.monotonic()
+        self.import_seconds = import_seconds
+        self.ready = False
+        self.deadline = None        # set once retired
+        pass
+
+
+def _run_worker(module, kwargs, import_seconds):
+    """
+    Entry point of a worker process
+    """
+    start = time.perf_counter()
+    stage = importlib.import_module(module)
+    import_seconds.value = time.perf_counter() - start
+    stage.main(**kwargs)
+
+
+class Supervisor:
+
+    def __init__(self, stages):
+        """
+        :param stages: List of Stage
+        """
+        self.stages = list(stages)
+        self._context = multiprocessing.get_context(START_METHOD)
+        self._connection = None
+        self._channel = None
+        self._workers = {stage.name: [] for stage in self.stages}
+        self._draining = {stage.name: [] for stage in self.stages}
+        self._up = {stage.name: 0 for stage in self.stages}
+        self._down = {stage.name: 0 for stage in self.stages}
+        self._last_action = {stage.name: 0.0 for stage in self.stages}
+        self._stopping = False
+        pass
+
+    def connect(self, host='localhost', port=5672,
+                uname="guest", pwd="guest"):
+        """
+        Connects to the data hub whose queues are watched
+        :return: 1 if success, -1 if failure
+        """
+        try:
+            credentials = pika.PlainCredentials(uname, pwd)
+            self._connection = Transport.open_connection(
+                pika.ConnectionParameters(
+                    host=host,
+                    port=port,
+                    credentials=credentials
+                ))
+            self._channel = self._connection.channel()
+        except Exception as e:
+            print("Exception caught while trying to establish connection :")
+            print(e)
+            return -1
+        return 1
+
+    def queue_depth(self, stage):
+        """
+        :param stage: Stage
+        :return: (messages ready, consumers). (0, 0) if the queue does not
+                 exist yet, i.e. no worker has declared it
+        """
+        try:
+            result = self._channel.queue_declare(queue=stage.queue,
+                                                 passive=True)
+        except pika.exceptions.ChannelClosed:
+            # A failed passive declare closes the channel
+            self._channel = self._connection.channel()
+            return 0, 0
+        return result.method.message_count, result.method.consumer_count
+
+    def _free_slot(self, stage):
+        used = set(worker.slot for worker in
+                   self._workers[stage.name] + self._draining[stage.name])
+        slot = 0
+        while slot in used:
+            slot += 1
+        return slot
+
+    def _spawn(self, stage):
+        slot = self._free_slot(stage)
+        kwargs = dict(stage.kwargs, queue_name=stage.queue, slot=slot)
+        import_seconds = self._context.Value("d", -1.0)
+        process = self._context.Process(
+            target=_run_worker,
+            args=(stage.module, kwargs, import_seconds),
+            name=stage.name + "-" + str(slot))
+        process.start()
+        self._workers[stage.name].append(_Worker(process, slot,
+                                                 import_seconds))
+        print("Started", process.name, "pid", process.pid)
+
+    def _retire(self, stage):
+        # The newest worker goes first. Older ones have warmer caches
+        worker = self._workers[stage.name].pop()
+        worker.deadline = time.monotonic() + DRAIN_TIMEOUT
+        self._draining[stage.name].append(worker)
+        worker.process.terminate()
+        print("Retiring", worker.process.name)
+
+    def _reap(self, stage):
+        """
+        Forgets workers that exited, killing retired ones that overstayed
+        """
+        for worker in list(self._draining[stage.name]):
+            if not worker.process.is_alive():
+                worker.process.join()
+                self._draining[stage.name].remove(worker)
+                print("Retired", worker.process.name)
+            elif time.monotonic() > worker.deadline:
+                print(worker.process.name, "did not drain in time. Killing")
+                worker.process.kill()
+        for worker in list(self._workers[stage.name]):
+            if not worker.process.is_alive():
+                worker.process.join()
+                self._workers[stage.name].remove(worker)
+                _restarts.labels(stage.name).inc()
+                print(worker.process.name, "exited with code",
+                      worker.process.exitcode)
+
+    def _mark_ready(self, stage, consumers):
+        """
+        A worker is counted as started once the queue has one more
+        consumer than the workers already started
+        """
+        workers = self._workers[stage.name]
+        ready = sum(1 for worker in workers if worker.ready)
+        draining = len(self._draining[stage.name])
+        for worker in workers:
+            if ready + draining >= consumers:
+                break
+            if not worker.ready:
+                worker.ready = True
+                ready += 1
+                _startup_seconds.labels(stage.name).observe(
+                    time.monotonic() - worker.started)
+                if worker.import_seconds.value >= 0:
+                    _import_seconds.labels(stage.name).observe(
+                        worker.import_seconds.value)
+
+    def _scale(self, stage, depth):
+        workers = len(self._workers[stage.name])
+        now = time.monotonic()
+        if workers < stage.min_workers:
+            self._spawn(stage)
+            return
+        if workers < stage.max_workers and \
+                depth > stage.up_depth * workers:
+            self._up[stage.name] += 1
+        else:
+            self._up[stage.name] = 0
+        if workers > stage.min_workers and \
+                depth < stage.down_depth * (workers - 1):
+            self._down[stage.name] += 1
+        else:
+            self._down[stage.name] = 0
+        if now - self._last_action[stage.name] < COOLDOWN:
+            return
+        # Wait for the previous worker to start before judging its effect
+        if any(not worker.ready for worker in self._workers[stage.name]):
+            return
+        if self._up[stage.name] >= UP_POLLS:
+            self._spawn(stage)
+        elif self._down[stage.name] >= DOWN_POLLS:
+            self._retire(stage)
+        else:
+            return
+        self._up[stage.name] = self._down[stage.name] = 0
+        self._last_action[stage.name] = now
+
+    def poll_once(self):
+        """
+        Checks every stage once and adds or retires workers as needed
+        :return: None
+        """
+        for stage in self.stages:
+            self._reap(stage)
+            depth, consumers = self.queue_depth(stage)
+            _depth_gauge.labels(stage.name).set(depth)
+            self._mark_ready(stage, consumers)
+            if not self._stopping:
+                self._scale(stage, depth)
+            _workers_gauge.labels(stage.name).set(
+                len(self._workers[stage.name]))
+
+    def run(self):
+        """
+        Supervises the stages until stop() is called or the process gets
+        SIGTERM/SIGINT, then drains every worker
+        :return: 1 if success, -1 if failure
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        try:
+            while not self._stopping:
+                self.poll_once()
+                # Sleeping on the connection keeps its heartbeats going
+                self._connection.sleep(POLL_INTERVAL)
+        except Exception as e:
+            print("Exception caught while supervising workers :")
+            print(e)
+            return -1
+        finally:
+            self.shutdown()
+        return 1
+
+    def stop(self):
+        self._stopping = True
+
+    def shutdown(self):
+        """
+        Retires every worker and waits for them to drain
+        :return: None
+        """
+        self._stopping = True
+        for stage in self.stages:
+            while self._workers[stage.name]:
+                self._retire(stage)
+        while any(self._draining.values()):
+            for stage in self.stages:
+                self._reap(stage)
+            time.sleep(0.1)
+        for stage in self.stages:
+            _workers_gauge.labels(stage.name).set(0)
+
+    def disconnect(self):
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+
+def main():
+    # Imported here for the queue names only. Workers import their own
+    # modules after they are spawned
+    import TweetCleaner
+    import TweetStore
+
+    stages = [Stage("cleaner", "TweetCleaner", TweetCleaner.POOL_QUEUE,
+                    min_workers=1, max_workers=8,
+                    up_depth=2000, down_depth=200),
+              Stage("store", "TweetStore", TweetStore.POOL_QUEUE,
+                    min_workers=1, max_workers=4,
+                    up_depth=10000, down_depth=1000)]
+
+    Metrics.start_http_server(METRICS_PORT)
+
+    supervisor = Supervisor(stages)
+    if supervisor.connect(host=DATA_HUB_HOST,
+                          uname=DATA_HUB_UNAME,
+                          pwd=DATA_HUB_PWD) != 1:
+        print(" Closing program ")
+        return
+    supervisor.run()
+    supervisor.disconnect()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(" Exiting Supervisor. Bye! ")
@@ -0,0 +1,460 @@
+"""
+@file_name : TrafficLog.py
+@author : Srihari Seshadri
+@description : This file records the traffic of an exchange and replays it,
+                to load test the pipeline without the Twitter API :
+                1. TrafficRecorder appends raw bodies, properties, routing
+                   keys and arrival times to a log file, with a sparse time
+                   index next to it (<log>.idx)
+                2. record() subscribes through Receiver to a topic pattern
+                   and records what arrives
+                3. TrafficLogReader iterates over a time range and a set of
+                   topic patterns, seeking with the index
+                4. replay() republishes through Messenger at the original
+                   timing, N times faster or flat out, optionally looping
+                   with unique tweet ids on every lap
+                Usage :
+                    python TrafficLog.py record traffic.log --topic "#"
+                    python TrafficLog.py replay traffic.log --speed 10
+                    python TrafficLog.py info traffic.log
+@date : 12-03-2018
+"""
+
+import argparse
+import bisect
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+import pika
+import MessageCodec
+import Transport
+from FakeBroker import topic_matches
+from Messenger import Messenger
+from Receiver import Receiver
+
+EXCHANGE = "twitter_feed"
+DATA_HUB_HOST = ''
+DATA_HUB_UNAME = 'admin'
+DATA_HUB_PWD = 'password'
+
+LOG_FILE = "traffic.log"
+INDEX_EVERY = 1000          # records between two index entries
+FLUSH_EVERY = 1000          # records buffered before the log is flushed
+REPORT_EVERY = 5            # seconds between two replay progress lines
+ID_FIELD = 'id_str'         # made unique on every lap of a looping replay
+
+_MAGIC = b"RTTL"
+_FILE_HEADER = struct.Struct("<4sI")        # magic, version
+# arrival time, crc32 of the rest, routing key, properties and body lengths
+_RECORD = struct.Struct("<dIHHI")
+_INDEX = struct.Struct("<dQQ")              # arrival time, offset, record no.
+_INDEX_SUFFIX = ".idx"
+
+
+def _pack_properties(properties):
+    if properties is None:
+        return b""
+    return json.dumps([properties.content_type,
+                       properties.content_encoding,
+                       properties.headers]).encode("utf-8")
+
+
+def _unpack_properties(data):
+    if not data:
+        return pika.BasicProperties()
+    content_type, content_encoding, headers = json.loads(data)
+    return pika.BasicProperties(content_type=content_type,
+                                content_encoding=content_encoding,
+                                headers=headers)
+
+
+def _read_index(path):
+    """
+    :return: List of (arrival time, offset, record number)
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as f:
+        data = f.read()
+    count = len(data) // _INDEX.size
+    return [_INDEX.unpack_from(data, i * _INDEX.size) for i in range(count)]
+
+
+def _scan(f, offset, end=None):
+    """
+    Yields (offset, offset after, arrival time, key, properties, body) of the
+    intact records from an offset, stopping at a torn or damaged record
+    """
+    f.seek(offset)
+    while end is None or offset < end:
+        header = f.read(_RECORD.size)
+        if len(header) < _RECORD.size:
+            return
+        timestamp, crc, key_len, props_len, body_len = \
+            _RECORD.unpack(header)
+        size = key_len + props_len + body_len
+        data = f.read(size)
+        if len(data) < size or zlib.crc32(data) != crc:
+            return
+        next_offset = offset + _RECORD.size + size
+        yield (offset, next_offset, timestamp, data[:key_len],
+               data[key_len:key_len + props_len], data[key_len + props_len:])
+        offset = next_offset
+
+
+class TrafficRecorder:
+
+    def __init__(self, path=LOG_FILE):
+        """
+        Opens a log for appending, recovering what a previous run left
+        :param path: Log file. The index is written to path + ".idx"
+        """
+        self.path = path
+        self._index_path = path + _INDEX_SUFFIX
+        self._lock = threading.Lock()
+        self.records = 0
+        index = _read_index(self._index_path)
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.write(_FILE_HEADER.pack(_MAGIC, 1))
+            index = []
+        # Find the end of the last intact record, from the last index entry
+        size = os.path.getsize(path)
+        index = [entry for entry in index if entry[1] < size]
+        offset, self.records = _FILE_HEADER.size, 0
+        if index:
+            offset, self.records = index[-1][1], index[-1][2]
+        with open(path, "rb") as f:
+            magic, _ = _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+            if magic != _MAGIC:
+                raise ValueError(path + " is not a traffic log")
+            for _, offset, _, _, _, _ in _scan(f, offset):
+                self.records += 1
+        self._file = open(path, "r+b")
+        self._file.truncate(offset)
+        self._file.seek(offset)
+        self._offset = offset
+        with open(self._index_path, "wb") as f:
+            for entry in index:
+                f.write(_INDEX.pack(*entry))
+        self._index = open(self._index_path, "ab")
+        pass
+
+    def write(self, routing_key, properties, body, timestamp=None):
+        """
+        Appends one message
+        :param routing_key: Routing key it was published with
+        :param properties: pika BasicProperties
+        :param body: Raw body (bytes)
+        :param timestamp: Arrival time. Defaults to now
+        :return: 1 if success, -1 if failure
+        """
+        try:
+            timestamp = time.time() if timestamp is None else timestamp
+            key = routing_key.encode("utf-8")
+            props = _pack_properties(properties)
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            data = key + props + body
+            header = _RECORD.pack(timestamp, zlib.crc32(data), len(key),
+                                  len(props), len(body))
+            with self._lock:
+                if self.records % INDEX_EVERY == 0:
+                    self._index.write(_INDEX.pack(timestamp, self._offset,
+                                                  self.records))
+                self._file.write(header)
+                self._file.write(data)
+                self._offset += len(header) + len(data)
+                self.records += 1
+                if self.records % FLUSH_EVERY == 0:
+                    self._flush()
+        except Exception as e:
+            print("Exception caught while recording a message :")
+            print(e)
+            return -1
+        return 1
+
+    def _flush(self):
+        # The log goes first so that the index never points past it
+        self._file.flush()
+        self._index.flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._file.close()
+            self._index.close()
+
+
+class TrafficLogReader:
+
+    def __init__(self, path=LOG_FILE):
+        """
+        :param path: Log file written by TrafficRecorder
+        """
+        self.path = path
+        self._index = _read_index(path + _INDEX_SUFFIX)
+        with open(path, "rb") as f:
+            magic, _ = _FILE_HEADER.unpack(f.read(_FILE_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError(path + " is not a traffic log")
+        pass
+
+    def _start_offset(self, start):
+        if start is None or not self._index:
+            return _FILE_HEADER.size
+        times = [entry[0] for entry in self._index]
+        position = bisect.bisect_right(times, start) - 1
+        if position < 0:
+            return _FILE_HEADER.size
+        return self._index[position][1]
+
+    def records(self, start=None, end=None, topics=None):
+        """
+        Iterates over the recorded messages in arrival order
+        :param start: Only messages that arrived at or after this epoch time
+        :param end: Only messages that arrived before this epoch time
+        :param topics: Topic patterns ('*' and '#' wildcards) the routing key
+                       must match one of. None for every message
+        :return: yields (arrival time, routing key, properties, body)
+        """
+        with open(self.path, "rb") as f:
+            for _, _, timestamp, key, props, body in _scan(
+                    f, self._start_offset(start)):
+                if start is not None and timestamp < start:
+                    continue
+                if end is not None and timestamp >= end:
+                    return
+                routing_key = key.decode("utf-8")
+                if topics and not any(topic_matches(pattern, routing_key)
+                                      for pattern in topics):
+                    continue
+                yield timestamp, routing_key, _unpack_properties(props), body
+
+    def summary(self):
+        """
+        :return: dict with the number of messages, bytes, first and last
+                 arrival times and messages per routing key
+        """
+        count, size, first, last, per_topic = 0, 0, None, None, {}
+        with open(self.path, "rb") as f:
+            for _, _, timestamp, key, props, body in _scan(
+                    f, _FILE_HEADER.size):
+                count += 1
+                size += len(body)
+                first = timestamp if first is None else first
+                last = timestamp
+                routing_key = key.decode("utf-8")
+                per_topic[routing_key] = per_topic.get(routing_key, 0) + 1
+        return {"messages": count, "body_bytes": size, "first": first,
+                "last": last,
+                "seconds": (last - first) if count else 0,
+                "topics": per_topic}
+
+
+def record(path=LOG_FILE, ex_name=EXCHANGE, topic="#", duration=None,
+           limit=None, host=DATA_HUB_HOST, uname=DATA_HUB_UNAME,
+           pwd=DATA_HUB_PWD):
+    """
+    Records the messages published on an exchange until stopped (SIGTERM or
+    Ctrl-C), for a duration or for a number of messages
+    :param path: Log file to append to
+    :param ex_name: Exchange to listen to
+    :param topic: Topic pattern to subscribe to
+    :param duration: Seconds to record for
+    :param limit: Number of messages to record
+    :return: Number of messages recorded
+    """
+    recorder = TrafficRecorder(path)
+    receiver = Receiver()
+    if receiver.connect(host=host, uname=uname, pwd=pwd) != 1:
+        recorder.close()
+        return 0
+    if threading.current_thread() is threading.main_thread():
+        receiver.stop_on_signal()
+    recorded = [0]
+
+    def callback(ch, method, properties, body):
+        if recorder.write(method.routing_key, properties, body) == 1:
+            recorded[0] += 1
+        if limit is not None and recorded[0] >= limit:
+            receiver.stop()
+        return 1
+
+    timer = None
+    if duration is not None:
+        timer = threading.Timer(duration, receiver.stop)
+        timer.daemon = True
+        timer.start()
+    print("Recording", topic, "on", ex_name, "to", path)
+    try:
+        receiver.get_data_from_exchange(ex_name=ex_name, topic=topic,
+                                        callback=callback)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        recorder.close()
+        receiver.disconnect()
+    print("Recorded", recorded[0], "messages")
+    return recorded[0]
+
+
+def unique_ids(routing_key, properties, body, lap, field=ID_FIELD):
+    """
+    Replay transform making the ids of every lap distinct, so that looped
+    traffic is not dropped by the deduplicators. Bodies that are not a JSON
+    or msgpack object with the field are left as they are.
+    :return: (routing key, properties, body)
+    """
+    if lap == 0 or "__df" in routing_key:
+        return routing_key, properties, body
+    try:
+        message = MessageCodec.loads(body, properties)
+    except Exception:
+        return routing_key, properties, body
+    if not isinstance(message, dict) or message.get(field) is None:
+        return routing_key, properties, body
+    message[field] = str(message[field]) + "%04d" % lap
+    encoding = MessageCodec.ENCODING_JSON
+    for name, content_type in MessageCodec.CONTENT_TYPES.items():
+        if content_type == properties.content_type:
+            encoding = name
+    body, content_type, content_encoding = MessageCodec.encode(
+        message, encoding=encoding, compression=properties.content_encoding)
+    return routing_key, pika.BasicProperties(
+        content_type=content_type, content_encoding=content_encoding,
+        headers=properties.headers), body
+
+
+def replay(path=LOG_FILE, ex_name=EXCHANGE, speed=1.0, topics=None,
+           start=None, end=None, loops=1, transform=None, messenger=None,
+           host=DATA_HUB_HOST, uname=DATA_HUB_UNAME, pwd=DATA_HUB_PWD):
+    """
+    Republishes recorded traffic
+    :param path: Log file
+    :param ex_name: Exchange to publish to
+    :param speed: 1 for the original timing, N for N times faster, None or
+                  0 to publish as fast as possible
+    :param topics: Topic patterns to replay. None for every message
+    :param start: Only replay messages recorded at or after this epoch time
+    :param end: Only replay messages recorded before this epoch time
+    :param loops: Number of laps over the log. 0 loops until stopped
+    :param transform: Function (routing key, properties, body, lap) returning
+                      (routing key, properties, body), e.g. unique_ids
+    :param messenger: Connected Messenger. One is created if None
+    :return: dict with the messages sent and failed, the seconds taken and
+             the rate achieved
+    """
+    reader = TrafficLogReader(path)
+    own_messenger = messenger is None
+    if own_messenger:
+        messenger = Messenger()
+        if messenger.connect(host=host, uname=uname, pwd=pwd) != 1:
+            return {"sent": 0, "failed": 0, "seconds": 0.0, "rate": 0.0}
+    messenger.connect_to_exchange(ex_name=ex_name)
+
+    sent = failed = 0
+    began = time.time()
+    last_report = began
+    offset = 0.0        # replay time already covered by earlier laps
+    lap = 0
+    try:
+        while loops == 0 or lap < loops:
+            first = last = None
+            for timestamp, routing_key, properties, body in reader.records(
+                    start, end, topics):
+                if first is None:
+                    first = timestamp
+                last = timestamp
+                if speed:
+                    delay = began + offset + (timestamp - first) / speed - \
+                        time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                if transform is not None:
+                    routing_key, properties, body = transform(
+                        routing_key, properties, body, lap)
+                if messenger.publish_raw(ex_name, body, routing_key,
+                                         properties) == 1:
+                    sent += 1
+                else:
+                    failed += 1
+                    messenger.ensure_connected()
+                    messenger.connect_to_exchange(ex_name=ex_name)
+                now = time.time()
+                if now - last_report >= REPORT_EVERY:
+                    last_report = now
+                    print("Replayed", sent, "messages,",
+                          int(sent / (now - began)), "msgs/s")
+            if first is None:
+                print("Nothing to replay in", path)
+                break
+            if speed:
+                # The next lap starts where this one's timeline ended
+                offset += (last - first) / speed
+            lap += 1
+    except KeyboardInterrupt:
+        print("Replay interrupted")
+    finally:
+        if own_messenger:
+            messenger.disconnect()
+    seconds = time.time() - began
+    stats = {"sent": sent, "failed": failed, "seconds": seconds,
+             "rate": sent / seconds if seconds > 0 else 0.0}
+    print("Replayed", sent, "messages in", round(seconds, 2), "seconds (",
+          int(stats["rate"]), "msgs/s,", failed, "failed )")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Traffic recorder and "
+                                                 "replayer")
+    parser.add_argument("command", choices=["record", "replay", "info"])
+    parser.add_argument("path", nargs="?", default=LOG_FILE)
+    parser.add_argument("--exchange", default=EXCHANGE)
+    parser.add_argument("--topic", action="append",
+                        help="Topic pattern, may be repeated. Recording "
+                             "subscribes to the first one only")
+    parser.add_argument("--duration", type=float,
+                        help="Seconds to record for")
+    parser.add_argument("--limit", type=int,
+                        help="Messages to record")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed factor, 0 for flat out")
+    parser.add_argument("--start", type=float,
+                        help="Replay from this epoch time")
+    parser.add_argument("--end", type=float,
+                        help="Replay until this epoch time")
+    parser.add_argument("--loops", type=int, default=1,
+                        help="Laps over the log, 0 to loop until stopped")
+    parser.add_argument("--unique-ids", action="store_true",
+                        help="Make " + ID_FIELD + " unique on every lap")
+    parser.add_argument("--transport",
+                        choices=[Transport.TRANSPORT_AMQP,
+                                 Transport.TRANSPORT_SHM,
+                                 Transport.TRANSPORT_FAKE])
+    args = parser.parse_args()
+
+    if args.transport:
+        Transport.set_transport(args.transport)
+    if args.command == "info":
+        print(json.dumps(TrafficLogReader(args.path).summary(), indent=2))
+    elif args.command == "record":
+        record(args.path, args.exchange, (args.topic or ["#"])[0],
+               duration=args.duration, limit=args.limit)
+    else:
+        replay(args.path, args.exchange, speed=args.speed,
+               topics=args.topic, start=args.start, end=args.end,
+               loops=args.loops,
+               transform=unique_ids if args.unique_ids else None)
+
+
+if __name__ == "__main__":
+    main()
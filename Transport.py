@@ -0,0 +1,121 @@
+"""
+@file_name : Transport.py
+@author : Srihari Seshadri
+@description : This file decides which connection class Messenger and
+                Receiver use to reach the data hub. The transport is picked
+                by name, from the RTIS_TRANSPORT environment variable unless
+                set_transport() is called :
+                - amqp : pika's BlockingConnection to the broker (default)
+                - shm : SharedMemoryBroker, for stages on the same machine
+                - fake : FakeBroker, within a single process
+                Any other stand-in can be installed with
+                set_connection_factory() for benchmarks and tests.
+                open_async_connection() does the same for the asyncio
+                clients, bridging the in-process transports to the event
+                loop (see AsyncioBridge.py).
+@date : 11-14-2018
+"""
+
+import os
+import pika
+
+TRANSPORT_ENV = "RTIS_TRANSPORT"
+TRANSPORT_AMQP = "amqp"
+TRANSPORT_SHM = "shm"
+TRANSPORT_FAKE = "fake"
+DEFAULT_TRANSPORT = TRANSPORT_AMQP
+
+_connection_factory = None
+
+
+def _shm_connection(parameters):
+    # Imported here so that the AMQP transport does not need shared memory
+    import SharedMemoryBroker
+    return SharedMemoryBroker.get_broker().connection(parameters)
+
+
+def _fake_connection(parameters):
+    import FakeBroker
+    return FakeBroker.get_broker().connection(parameters)
+
+
+_TRANSPORTS = {TRANSPORT_AMQP: pika.BlockingConnection,
+               TRANSPORT_SHM: _shm_connection,
+               TRANSPORT_FAKE: _fake_connection}
+
+
+def set_transport(name):
+    """
+    Selects one of the named transports
+    :param name: TRANSPORT_AMQP, TRANSPORT_SHM or TRANSPORT_FAKE
+    :return: None
+    """
+    if name not in _TRANSPORTS:
+        raise ValueError("Unknown transport : " + str(name) +
+                         ". Use one of " + ", ".join(sorted(_TRANSPORTS)))
+    set_connection_factory(_TRANSPORTS[name])
+
+
+def set_connection_factory(factory):
+    """
+    Installs the callable used to open connections
+    :param factory: Callable taking pika.ConnectionParameters and returning
+                    an object with the BlockingConnection interface. None
+                    goes back to the transport named in RTIS_TRANSPORT
+    :return: None
+    """
+    global _connection_factory
+    _connection_factory = factory
+
+
+def get_connection_factory():
+    """
+    :return: The callable used to open connections
+    """
+    if _connection_factory is not None:
+        return _connection_factory
+    name = os.environ.get(TRANSPORT_ENV, DEFAULT_TRANSPORT).lower()
+    if name not in _TRANSPORTS:
+        raise ValueError("Unknown transport in " + TRANSPORT_ENV + " : " +
+                         name)
+    return _TRANSPORTS[name]
+
+
+def open_connection(parameters):
+    """
+    Opens a connection with the installed connection factory
+    :param parameters: pika.ConnectionParameters
+    :return: Connection object
+    """
+    return get_connection_factory()(parameters)
+
+
+def open_async_connection(parameters, on_open_callback=None,
+                          on_open_error_callback=None,
+                          on_close_callback=None, loop=None):
+    """
+    Opens a connection for the asyncio clients : pika's AsyncioConnection
+    for AMQP, otherwise the installed connection factory run on the event
+    loop through AsyncioBridge
+    :param parameters: pika.ConnectionParameters
+    :param on_open_callback: Function (connection)
+    :param on_open_error_callback: Function (connection, error)
+    :param on_close_callback: Function (connection, reply code, reply text)
+    :param loop: asyncio event loop
+    :return: Connection object with the AsyncioConnection interface
+    """
+    factory = get_connection_factory()
+    if factory is pika.BlockingConnection:
+        from pika.adapters.asyncio_connection import AsyncioConnection
+        return AsyncioConnection(parameters,
+                                 on_open_callback=on_open_callback,
+                                 on_open_error_callback=on_open_error_callback,
+                                 on_close_callback=on_close_callback,
+                                 custom_ioloop=loop)
+    import AsyncioBridge
+    return AsyncioBridge.BridgedConnection(
+        factory, parameters,
+        on_open_callback=on_open_callback,
+        on_open_error_callback=on_open_error_callback,
+        on_close_callback=on_close_callback,
+        custom_ioloop=loop)
@@ -0,0 +1,153 @@
+"""
+@file_name : TweetAggregator.py
+@author : Srihari Seshadri
+@description : This file receives the cleaned tweets from the datahub and
+                keeps windowed aggregates (tweet volume, retweet and favorite
+                totals per keyword and age bucket t) up to date. Snapshots
+                are published back to the datahub as a dataframe and/or
+                written to a summary table, so dashboards read them instead
+                of scanning the tweets table.
+@date : 12-03-2018
+"""
+
+import time
+import MessageCodec
+import Metrics
+from Receiver import Receiver
+from MessengerPool import get_pool
+from SQLDatabaseManager import SQLDatabaseManager
+from WindowAggregator import WindowAggregator, SLIDING, TUMBLING
+
+EXCHANGE = "twitter_feed"
+SUB_TOPIC = "cleaned"
+PUB_TOPIC = "aggregates__df"
+DATA_HUB_HOST = ''
+DATA_HUB_UNAME = 'admin'
+DATA_HUB_PWD = 'password'
+
+# Snapshots go to the data hub, the summary table, or both
+PUBLISH_SNAPSHOTS = True
+STORE_SNAPSHOTS = False
+SNAPSHOT_INTERVAL = 10  # seconds
+
+DB_IP = ''
+DATABASE = 'tweets'
+DB_UNAME = 'rtis'
+DB_PWD = 'rtis'
+DB_PORT = '3306'
+SUMMARY_TABLE = "UCHICAGO_SUMMARY"
+
+GROUP_BY = ['keywords', 't']
+WINDOWS = {"5m": (SLIDING, 300),
+           "1h": (SLIDING, 3600),
+           "15m": (TUMBLING, 900)}
+
+# Metrics are served at http://host:METRICS_PORT/
+METRICS_PORT = 9103
+
+# Created in main()
+aggregator = None
+sqldbm = None
+_timer = None
+
+_snapshot_seconds = Metrics.histogram(
+    "rtis_aggregate_snapshot_seconds",
+    "Time taken to build and ship a snapshot of the aggregates")
+
+
+def callback(ch, method, properties, body):
+    """
+    Adds a cleaned tweet to the aggregates. Also keeps the snapshot timer
+    running on the consumer's connection.
+    :return: 1 if success, -1 if fail
+    """
+    global _timer
+    if _timer is None:
+        _timer = ch.connection.add_timeout(SNAPSHOT_INTERVAL,
+                                           lambda: on_timer(ch))
+    try:
+        aggregator.add(MessageCodec.loads(body, properties))
+    except Exception as e:
+        print("Exception caught in callback ")
+        print(e)
+        return -1
+    return 1
+
+
+def on_timer(ch):
+    global _timer
+    _timer = ch.connection.add_timeout(SNAPSHOT_INTERVAL,
+                                       lambda: on_timer(ch))
+    send_snapshot()
+
+
+def send_snapshot():
+    """
+    Publishes and/or stores a snapshot of every window
+    :return: 1 if success, -1 if fail
+    """
+    start = time.perf_counter()
+    aggregator.advance_to()
+    dframe = aggregator.snapshot()
+    ret = 1
+    if PUBLISH_SNAPSHOTS:
+        pool = get_pool(host=DATA_HUB_HOST,
+                        uname=DATA_HUB_UNAME,
+                        pwd=DATA_HUB_PWD)
+        if pool.publish(ex_name=EXCHANGE, message=dframe,
+                        topic=PUB_TOPIC) != 1:
+            print("Snapshot could not be published")
+            ret = -1
+    if STORE_SNAPSHOTS and sqldbm is not None:
+        if sqldbm.insert(dframe=dframe, table_name=SUMMARY_TABLE,
+                         if_table_exists="replace") != 1:
+            print("Snapshot could not be stored")
+            ret = -1
+    _snapshot_seconds.labels().observe(time.perf_counter() - start)
+    return ret
+
+
+def main():
+    global aggregator, sqldbm
+
+    aggregator = WindowAggregator(group_fields=GROUP_BY, windows=WINDOWS)
+    if STORE_SNAPSHOTS:
+        sqldbm = SQLDatabaseManager()
+        ret = sqldbm.connect(host=DB_IP,
+                             database=DATABASE,
+                             username=DB_UNAME,
+                             password=DB_PWD,
+                             port=DB_PORT)
+        if ret != 1:
+            print(" Closing program ")
+            return
+
+    Metrics.start_http_server(METRICS_PORT)
+
+    # Receive all the cleaned tweets and aggregate them
+    print("Waiting for tweets")
+
+    receiver = Receiver()
+
+    # Connect to the data hub
+    receiver.connect(host=DATA_HUB_HOST,
+                     uname=DATA_HUB_UNAME,
+                     pwd=DATA_HUB_PWD)
+
+    # Connect to the exchange
+    try:
+        ret = receiver.get_data_from_exchange(ex_name=EXCHANGE,
+                                              topic=SUB_TOPIC,
+                                              callback=callback)
+    except Exception as e:
+        print(" An exception was caught while getting data from the exchange :")
+        print(e)
+
+        print("\n Exiting .... \n")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as e:
+        print(" Exiting Aggregator. Bye! ")
@@ -8,67 +8,301 @@
 @date : 12-03-2018
 """
 
-import json
+import asyncio
+import calendar
+import multiprocessing
 import time
 from email.utils import parsedate_tz, mktime_tz
+from functools import lru_cache
+import numpy as np
+import MessageCodec
+import Metrics
+import Middleware
 from Receiver import Receiver
-from Messenger import Messenger
+from MessengerPool import get_pool
+from ShardRouter import shard_topic, shard_queue
+from Deduplicator import Deduplicator, tweet_key
+from BatchingConsumer import BatchingConsumer
 
 EXCHANGE = "twitter_feed"
 SUB_TOPIC = "tweet"
 PUB_TOPIC = "cleaned"
-DELAY_PUB = 1   # seconds
+# Tweets are cleaned and forwarded in batches of up to BATCH_MESSAGES, or
+# whatever arrived within BATCH_DELAY_MS
+BATCH_MESSAGES = 100
+BATCH_DELAY_MS = 50
+PREFETCH = 2 * BATCH_MESSAGES   # unacked tweets held by a cleaner
+WORKERS = 4     # concurrent workers of the one tweet at a time callback
+ASYNC_MODE = False  # run consume and republish on one asyncio event loop
+
+# Number of cleaner shards, one worker process per shard. Must match
+# NUM_SHARDS in TweetScraper.py. 0 runs a single unsharded cleaner
+NUM_SHARDS = 0
+SHARD_QUEUE = "tweet_cleaner"
+
+# Shared durable queue of the cleaner workers started by Supervisor.py
+POOL_QUEUE = "tweet_cleaner_pool"
+
+# Tweets already forwarded are dropped. The index is snapshotted here so it
+# survives restarts (one file per shard)
+DEDUP_SNAPSHOT = "cleaner_dedup.snapshot"
+dedup = None
+
+# Only these fields of a cleaned tweet are forwarded (what the store keeps)
+PROJECTIONS = {PUB_TOPIC: ['id_str',
+                           'created_at_epoch', 'scraped_at_epoch',
+                           't', 'retweet_count', 'favorite_count',
+                           'keywords']}
+ENCODING = MessageCodec.ENCODING_JSON
+COMPRESSION = MessageCodec.COMPRESSION_ZLIB
 
 DATA_HUB_HOST = ''
 DATA_HUB_UNAME = 'admin'
 DATA_HUB_PWD = 'password'
 
+# Metrics are served at http://host:METRICS_PORT/. Shard k serves them at
+# SHARD_METRICS_PORT + k
+METRICS_PORT = 9101
+SHARD_METRICS_PORT = 9110
+POOL_METRICS_PORT = 9120    # plus the worker slot
+
+# 1 in PROFILE_EVERY messages is profiled once `kill -USR2 <pid>` switches
+# the profiler on. `kill -USR1 <pid>` writes the profile to
+# profile_<pid>.prof
+PROFILE_EVERY = 100
+
+T_BUCKET = 1800     # seconds per bucket of tweet age ('t')
+TWITTER_TIME_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+EPOCH_CACHE_SIZE = 4096     # distinct timestamp strings remembered
+
+_forwarded_total = Metrics.counter(
+    "rtis_cleaner_forwarded_total", "Tweets cleaned and forwarded")
+_duplicates_total = Metrics.counter(
+    "rtis_cleaner_duplicates_total", "Tweets dropped as already forwarded")
+
+_MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+           'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
 
+def _parse_twitter_time(tweet_time_string):
+    """
+    Parses Twitter's fixed timestamp format, e.g.
+    "Wed Oct 10 20:19:24 +0000 2018"
+    """
+    _, month, day, clock, offset, year = tweet_time_string.split()
+    hour, minute, second = clock.split(':')
+    offset_secs = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+    if offset[0] == '-':
+        offset_secs = -offset_secs
+    return calendar.timegm((int(year), _MONTHS[month], int(day),
+                            int(hour), int(minute), int(second))) - offset_secs
+
+
+@lru_cache(maxsize=EPOCH_CACHE_SIZE)
 def to_epoch(tweet_time_string):
     """
-    Convert rfc 5322 -like time string into epoch
+    Convert rfc 5322 -like time string into epoch. Tweets scraped together
+    share timestamps, so results are cached.
     """
-    return mktime_tz(parsedate_tz(tweet_time_string))
+    try:
+        return _parse_twitter_time(tweet_time_string)
+    except (KeyError, ValueError):
+        return mktime_tz(parsedate_tz(tweet_time_string))
 
 
 def clean_message(json_msg):
     json_msg['created_at_epoch'] = to_epoch(json_msg['created_at'])
     json_msg['scraped_at_epoch'] = int(time.time())
-    json_msg['t'] = int(json_msg['scraped_at_epoch'] -
-                        json_msg['created_at_epoch'] / 1800)
+    json_msg['t'] = ((json_msg['scraped_at_epoch'] -
+                      json_msg['created_at_epoch']) // T_BUCKET)
     return json_msg
 
 
+def clean_batch(json_msgs):
+    """
+    Cleans a list of tweets in one go. The timestamps are parsed as one
+    column by pandas, the whole batch shares one scrape time and the derived
+    fields are computed as array operations.
+    :param json_msgs: List of decoded tweets
+    :return: the same list, with every tweet cleaned
+    """
+    if not json_msgs:
+        return json_msgs
+    # Imported here : the cleaner starts faster without pandas
+    import pandas as pd
+    created_at = pd.to_datetime(
+        pd.Series([msg['created_at'] for msg in json_msgs]),
+        format=TWITTER_TIME_FORMAT, utc=True, errors='coerce')
+    unparsed = created_at.isna().to_numpy()
+    created = created_at.to_numpy(dtype='datetime64[s]').astype(np.int64)
+    # Anything not in Twitter's own format goes through the rfc 5322 parser
+    for i in np.flatnonzero(unparsed).tolist():
+        created[i] = to_epoch(json_msgs[i]['created_at'])
+    scraped = int(time.time())
+    ages = (scraped - created) // T_BUCKET
+
+    for json_msg, created_at_epoch, t in zip(json_msgs, created.tolist(),
+                                             ages.tolist()):
+        json_msg['created_at_epoch'] = created_at_epoch
+        json_msg['scraped_at_epoch'] = scraped
+        json_msg['t'] = t
+    return json_msgs
+
+
+def prepare_batch(messages):
+    """
+    Decodes a batch of consumed messages, drops the tweets already forwarded
+    with the same counts (also within the batch) and cleans the rest with
+    clean_batch
+    :param messages: List of (properties, body)
+    :return: (results, forwards). results has one entry per message : 1 for
+             duplicates, -1 for messages that could not be decoded or
+             cleaned and None for the tweets to forward. forwards lists (position, dedup key,
+             projected tweet, headers) for the tweets to forward
+    """
+    results = [None] * len(messages)
+    positions, tweets, keys, seen = [], [], [], set()
+    for i, (properties, body) in enumerate(messages):
+        try:
+            json_msg = MessageCodec.loads(body, properties)
+        except Exception as e:
+            print("Exception caught while decoding a tweet :")
+            print(e)
+            results[i] = -1
+            continue
+        key = tweet_key(json_msg)
+        if key and (key in seen or
+                    (dedup is not None and dedup.contains(key))):
+            _duplicates_total.labels().inc()
+            results[i] = 1
+            continue
+        seen.add(key)
+        positions.append(i)
+        tweets.append(json_msg)
+        keys.append(key)
+
+    try:
+        clean_batch(tweets)
+    except Exception as e:
+        # Clean the tweets one at a time, so only the bad ones are rejected
+        print("Exception caught while cleaning a batch, cleaning its tweets "
+              "one at a time :")
+        print(e)
+        cleaned = []
+        for i, tweet, key in zip(positions, tweets, keys):
+            try:
+                clean_message(tweet)
+            except Exception as e:
+                print("Exception caught while cleaning a tweet :")
+                print(e)
+                results[i] = -1
+                continue
+            cleaned.append((i, tweet, key))
+        positions = [i for i, _, _ in cleaned]
+        tweets = [tweet for _, tweet, _ in cleaned]
+        keys = [key for _, _, key in cleaned]
+
+    projection = PROJECTIONS.get(PUB_TOPIC)
+    forwards = [(i, key, MessageCodec.project(tweet, projection),
+                 origin_headers(messages[i][0]))
+                for i, tweet, key in zip(positions, tweets, keys)]
+    return results, forwards
+
+
+def record_forwarded(results, forwards, acked):
+    """
+    Fills in the results of the forwarded tweets and records the ones the
+    broker took in the dedup index
+    :param acked: One entry per forward, True if it was published
+    :return: results
+    """
+    failed = 0
+    for (i, key, _, _), ok in zip(forwards, acked):
+        if ok is True:
+            results[i] = 1
+            if dedup is not None and key:
+                dedup.add(key)
+        else:
+            results[i] = -1
+            failed += 1
+    _forwarded_total.labels().inc(len(forwards) - failed)
+    if failed:
+        print(failed, "messages could not be forwarded. Skipping ....")
+    return results
+
+
+def forward_batch(messages):
+    """
+    Handler of the cleaner's BatchingConsumer : cleans a batch of tweets and
+    forwards it with one pipelined publish over the shared connections
+    :param messages: List of (properties, body)
+    :return: List with one result per message, 1 to ack or -1 to reject
+    """
+    results, forwards = prepare_batch(messages)
+    if not forwards:
+        return results
+    pool = get_pool(host=DATA_HUB_HOST,
+                    uname=DATA_HUB_UNAME,
+                    pwd=DATA_HUB_PWD)
+    acked = pool.publish_batch(ex_name=EXCHANGE,
+                               messages=[f[2] for f in forwards],
+                               topic=PUB_TOPIC,
+                               encoding=ENCODING,
+                               compression=COMPRESSION,
+                               headers=[f[3] for f in forwards])
+    return record_forwarded(results, forwards, acked)
+
+
+def origin_headers(properties):
+    """
+    Carries the origin time of a consumed message over to the message
+    forwarded for it, so the store can measure end-to-end tweet age
+    """
+    headers = getattr(properties, "headers", None) or {}
+    origin_at = headers.get(Metrics.ORIGIN_AT_HEADER)
+    if origin_at is None:
+        return None
+    return {Metrics.ORIGIN_AT_HEADER: origin_at}
+
+
 def callback(ch, method, properties, body):
     """
-    Callback function for cleaning tweets
+    Callback function for cleaning tweets one at a time, e.g. on a
+    Receiver worker pool. main() consumes in batches with forward_batch
     :return: the cleaned json message
     """
     try:
-        content_str = body.decode("utf-8")
-
-        json_msg = json.loads(content_str)
+        json_msg = MessageCodec.loads(body, properties)
         # print("Received : ")
         # for k, v in json_msg.items():
         #     print(k, "-->", v)
 
-        clean_jmsg = clean_message(json_msg)
-
-        # Push the cleaned message to the broker again
-        messenger = Messenger()
-        messenger.connect(host=DATA_HUB_HOST,
-                          uname=DATA_HUB_UNAME,
-                          pwd=DATA_HUB_PWD)
+        # Skip tweets that were already cleaned and forwarded with the same
+        # counts
+        key = tweet_key(json_msg)
+        if dedup is not None and key and dedup.contains(key):
+            _duplicates_total.labels().inc()
+            return 1
 
-        # Connect to the exchange
-        message = json.dumps(clean_jmsg)
-        messenger.connect_to_exchange(ex_name=EXCHANGE)
-        messenger.send_message_to_exchange(ex_name=EXCHANGE,
-                                           message=message,
-                                           topic=PUB_TOPIC)
-        time.sleep(DELAY_PUB)
+        clean_jmsg = clean_message(json_msg)
 
-        print("Message received -> cleaned -> forwarded")
+        # Push the cleaned message to the broker again over the shared,
+        # long lived connection
+        message = MessageCodec.project(clean_jmsg, PROJECTIONS.get(PUB_TOPIC))
+        pool = get_pool(host=DATA_HUB_HOST,
+                        uname=DATA_HUB_UNAME,
+                        pwd=DATA_HUB_PWD)
+        if pool.publish(ex_name=EXCHANGE,
+                        message=message,
+                        topic=PUB_TOPIC,
+                        encoding=ENCODING,
+                        compression=COMPRESSION,
+                        headers=origin_headers(properties)) != 1:
+            print("Message could not be forwarded. Skipping ....")
+            return -1
+        if dedup is not None and key:
+            dedup.add(key)
+        _forwarded_total.labels().inc()
 
     except Exception as e:
         print("Exception caught in callback ")
@@ -78,7 +312,51 @@ def callback(ch, method, properties, body):
     return 1
 
 
-def main():
+def main(shard=None, queue_name=None, slot=None):
+    """
+    Runs one cleaner until it is stopped (SIGTERM/SIGINT), finishing the
+    tweets it already started on
+    :param shard: Shard number to serve, or None for the unsharded cleaner
+    :param queue_name: Consume from this shared durable queue instead, as
+                       one of several cleaner workers
+    :param slot: Number of the worker, used to keep its dedup snapshot and
+                 metrics port apart from the other workers
+    """
+    global dedup
+
+    profiler = Middleware.SampledProfiler(every=PROFILE_EVERY,
+                                          enabled=False)
+    if queue_name is not None:
+        Metrics.start_http_server(POOL_METRICS_PORT + (slot or 0))
+    elif shard is None:
+        Metrics.start_http_server(METRICS_PORT)
+    else:
+        Metrics.start_http_server(SHARD_METRICS_PORT + shard)
+    # Each shard is served from its own durable queue, so a restarted worker
+    # picks up where the previous one stopped and messages are never
+    # duplicated across workers. Tweets are consumed in order, cleaned and
+    # forwarded in batches, and acked once their batch has been forwarded
+    # so that the tweets a dead worker held go back to the queue.
+    if queue_name is not None:
+        dedup = Deduplicator(snapshot_path=DEDUP_SNAPSHOT + ".pool." +
+                             str(slot or 0))
+        queue_args = dict(queue_name=queue_name,
+                          topic=SUB_TOPIC,
+                          durable=True,
+                          exclusive=False)
+    elif shard is None:
+        queue_args = dict(topic=SUB_TOPIC)
+        dedup = Deduplicator(snapshot_path=DEDUP_SNAPSHOT)
+    else:
+        dedup = Deduplicator(snapshot_path=DEDUP_SNAPSHOT + "." + str(shard))
+        queue_args = dict(queue_name=shard_queue(SHARD_QUEUE, shard),
+                          topic=shard_topic(SUB_TOPIC, shard),
+                          durable=True,
+                          exclusive=False)
+    batcher = BatchingConsumer(forward_batch,
+                               max_messages=BATCH_MESSAGES,
+                               max_delay_ms=BATCH_DELAY_MS,
+                               name="cleaner")
 
     # Receive all messages, process them, and forward them to the broker
     print("Waiting for tweets")
@@ -88,22 +366,135 @@ def main():
     receiver.connect(host=DATA_HUB_HOST,
                      uname=DATA_HUB_UNAME,
                      pwd=DATA_HUB_PWD)
+    receiver.stop_on_signal()
 
     # Connect to the exchange
     try:
-        print(" Subscribing to topic", SUB_TOPIC)
+        print(" Subscribing to topic", queue_args["topic"])
         ret = receiver.get_data_from_exchange(ex_name=EXCHANGE,
-                                              topic=SUB_TOPIC,
-                                              callback=callback)
+                                              callback=batcher,
+                                              middleware=[profiler],
+                                              auto_ack=False,
+                                              prefetch_count=PREFETCH,
+                                              **queue_args)
     except Exception as e:
         print(" An exception was caught while getting data from the exchange :")
         print(e)
 
         print("\n Exiting .... \n")
 
+    # Stopped : forward and ack the batch in progress
+    batcher.flush()
+    dedup.save()
+    receiver.disconnect()
+
+
+def launch_shards(num_shards=NUM_SHARDS):
+    """
+    Starts one cleaner process per shard and waits on them
+    :param num_shards: Number of shards (K)
+    """
+    processes = [multiprocessing.Process(target=main,
+                                         kwargs={"shard": shard},
+                                         name="cleaner-shard-" + str(shard))
+                 for shard in range(num_shards)]
+    for process in processes:
+        process.start()
+    print(" Started", num_shards, "cleaner shards")
+    for process in processes:
+        process.join()
+
+
+async def async_main():
+    """
+    Consumes, cleans and republishes on a single event loop. Thousands of
+    tweets can be in flight without a thread per connection. Tweets are
+    cleaned in batches, like in main()
+    """
+    global dedup
+
+    # Imported here so the blocking cleaner does not need the asyncio adapter
+    from AsyncMessenger import AsyncMessenger
+    from AsyncReceiver import AsyncReceiver
+
+    dedup = Deduplicator(snapshot_path=DEDUP_SNAPSHOT)
+
+    messenger = AsyncMessenger()
+    receiver = AsyncReceiver()
+    if (await messenger.connect(host=DATA_HUB_HOST,
+                                uname=DATA_HUB_UNAME,
+                                pwd=DATA_HUB_PWD) != 1 or
+            await receiver.connect(host=DATA_HUB_HOST,
+                                   uname=DATA_HUB_UNAME,
+                                   pwd=DATA_HUB_PWD) != 1):
+        print("\n Exiting .... \n")
+        return
+    await messenger.connect_to_exchange(ex_name=EXCHANGE)
+
+    loop = asyncio.get_event_loop()
+    batch = []          # (properties, body, future) waiting for a flush
+    timer = [None]
+
+    async def forward(entries):
+        results = [-1] * len(entries)
+        try:
+            results, forwards = prepare_batch([(properties, body) for
+                                               properties, body, _ in entries])
+            acked = []
+            for _, _, message, headers in forwards:
+                acked.append(await messenger.send_message_to_exchange(
+                    ex_name=EXCHANGE,
+                    message=message,
+                    topic=PUB_TOPIC,
+                    encoding=ENCODING,
+                    compression=COMPRESSION,
+                    headers=headers) == 1)
+            record_forwarded(results, forwards, acked)
+        except Exception as e:
+            print("Exception caught while forwarding a batch :")
+            print(e)
+        for (_, _, future), result in zip(entries, results):
+            if not future.done():
+                future.set_result(result)
+
+    def flush_batch():
+        if timer[0] is not None:
+            timer[0].cancel()
+            timer[0] = None
+        if batch:
+            entries = batch[:]
+            del batch[:]
+            loop.create_task(forward(entries))
+
+    async def async_callback(ch, method, properties, body):
+        # Every message waits for its batch, and is acked by the receiver
+        # with the batch's result for it
+        future = loop.create_future()
+        batch.append((properties, body, future))
+        if len(batch) >= BATCH_MESSAGES:
+            flush_batch()
+        elif timer[0] is None:
+            timer[0] = loop.call_later(BATCH_DELAY_MS / 1000.0, flush_batch)
+        return await future
+
+    Metrics.start_http_server(METRICS_PORT)
+    print("Waiting for tweets")
+    print(" Subscribing to topic", SUB_TOPIC)
+    try:
+        await receiver.get_data_from_exchange(ex_name=EXCHANGE,
+                                              topic=SUB_TOPIC,
+                                              callback=async_callback)
+    finally:
+        dedup.save()
+
 
 if __name__ == "__main__":
     try:
-        main()
+        if ASYNC_MODE:
+            asyncio.get_event_loop().run_until_complete(async_main())
+        elif NUM_SHARDS > 0:
+            launch_shards()
+        else:
+            main()
     except Exception as e:
         print(" Exiting Cleaner. Bye! ")
@@ -1,16 +1,20 @@
 """
 @file_name : TweetScraper.py
 @author : Srihari Seshadri
-@description : This file periodically scrapes tweets and sends them to the
-data hub
+@description : This file periodically scrapes tweets for every query in
+QUERIES and sends them to the data hub. Queries share the API rate limit
+(see ScrapeScheduler.py)
 @date : 12-03-2018
 """
 
+import os
 import json
-import pandas as pd
 import tweepy
-import time
+import MessageCodec
+import Metrics
 from Messenger import Messenger
+from ScrapeScheduler import ScrapeScheduler
+from ShardRouter import ConsistentHashRing
 
 EXCHANGE = "twitter_feed"
 PUB_TOPIC = "tweet"
@@ -18,24 +22,116 @@ DATA_HUB_HOST = ''
 DATA_HUB_UNAME = 'admin'
 DATA_HUB_PWD = 'password'
 
-TIME_WINDOW = 60*30    # seconds
-RETRY_TIME = 60*15  # seconds
-DELAY_PUB = 0.5   # seconds
+# Number of cleaner shards. 0 publishes every tweet on PUB_TOPIC, otherwise
+# each tweet goes to PUB_TOPIC.shard.<k> by a consistent hash of its id_str.
+# Must match NUM_SHARDS in TweetCleaner.py
+NUM_SHARDS = 0
 
 QUERY_STR = '"test_tweet_because_why_not"'
 # QUERY_STR = '"university of chicago" -filter:retweets'
 
-
-def get_tweets(twitter_api, query):
-    output = []
-    for tweet in tweepy.Cursor(twitter_api.search, q=query, lang='en').items():
-        temp = tweet._json
-        temp['keywords'] = query.strip('"')
-        output.append(temp)
-    return output
-
-
-def scraper():
+# Every query is scraped on its own schedule, within the shared rate limit
+QUERIES = [QUERY_STR]
+
+# Errors tweepy raises when the rate limit is reached (the class was renamed
+# in tweepy 4)
+RATE_LIMIT_ERRORS = tuple(getattr(tweepy, name)
+                          for name in ("RateLimitError", "TooManyRequests")
+                          if hasattr(tweepy, name))
+
+# since_id high-water mark of every query, so each run only fetches new
+# tweets
+CHECKPOINT_FILE = "scraper_checkpoint.json"
+
+# Only these fields of a tweet travel on the bus (what the cleaner and the
+# store use). Set a topic to None to forward the full tweet
+PROJECTIONS = {PUB_TOPIC: ['id_str', 'created_at', 'retweet_count',
+                           'favorite_count', 'keywords']}
+ENCODING = MessageCodec.ENCODING_JSON
+COMPRESSION = MessageCodec.COMPRESSION_ZLIB
+
+# Metrics are served at http://host:METRICS_PORT/
+METRICS_PORT = 9100
+
+
+def load_checkpoint(path=CHECKPOINT_FILE):
+    """
+    Reads the per-query since_id high-water marks
+    :param path: Checkpoint file
+    :return: dict mapping query -> since_id
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print("Could not read checkpoint, starting from scratch : ", e)
+        return {}
+
+
+def save_checkpoint(checkpoint, path=CHECKPOINT_FILE):
+    """
+    Writes the per-query since_id high-water marks atomically
+    :param checkpoint: dict mapping query -> since_id
+    :param path: Checkpoint file
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+def get_tweets(twitter_api, query, since_id=None, cursor=tweepy.Cursor):
+    """
+    Generator over the search results, one page at a time, so tweets can be
+    published as soon as they arrive
+    :param twitter_api: tweepy API object (or a stub with a search method)
+    :param query: Search query
+    :param since_id: Only return tweets newer than this id
+    :param cursor: Cursor class used to paginate the search
+    :return: yields a list of tweet dicts per page
+    """
+    pages = cursor(twitter_api.search, q=query, lang='en',
+                   since_id=since_id).pages()
+    for page in pages:
+        output = []
+        for tweet in page:
+            temp = tweet._json
+            temp['keywords'] = query.strip('"')
+            output.append(temp)
+        yield output
+
+
+def publish_tweets(messenger, tweet_list):
+    """
+    Publishes a page of tweets, sharded if NUM_SHARDS is set
+    :param messenger: Connected Messenger
+    :param tweet_list: List of tweet dicts
+    :return: Number of tweets acked by the broker
+    """
+    # Declared again if the messenger reconnected since
+    messenger.connect_to_exchange(ex_name=EXCHANGE)
+    fields = PROJECTIONS.get(PUB_TOPIC)
+    messages = [MessageCodec.project(tweet, fields) for tweet in tweet_list]
+    if NUM_SHARDS > 0:
+        ring = ConsistentHashRing(NUM_SHARDS)
+        topics = [ring.get_topic(tweet['id_str'], PUB_TOPIC)
+                  for tweet in tweet_list]
+    else:
+        topics = PUB_TOPIC
+    results = messenger.publish_batch(ex_name=EXCHANGE,
+                                      messages=messages,
+                                      topic=topics,
+                                      encoding=ENCODING,
+                                      compression=COMPRESSION)
+    acked = sum(1 for r in results if r is True)
+    print("Sent", len(messages), "messages on topic :", PUB_TOPIC,
+          "(acked :", acked, ", failed :", len(messages) - acked, ")")
+    return acked
+
+
+def make_api():
     # Credentials
     consumer_key = '#######'
     consumer_secret = '#######'
@@ -45,10 +141,15 @@ def scraper():
     # Set authentication factors
     auth = tweepy.OAuthHandler(consumer_key, consumer_secret)
     auth.set_access_token(access_key, access_secret)
+    return tweepy.API(auth)
+
 
-    # Find the query topics
-    twitter_api = tweepy.API(auth)
-    tweet_list = get_tweets(twitter_api, QUERY_STR)
+def scraper(twitter_api=None, query=QUERY_STR):
+    """
+    Scrapes one query once
+    """
+    if twitter_api is None:
+        twitter_api = make_api()
 
     # Send the tweets as a message
     messenger = Messenger()
@@ -60,35 +161,53 @@ def scraper():
     # Connect to the exchange
     messenger.connect_to_exchange(ex_name=EXCHANGE)
 
-    # Send update
-    for tweet in tweet_list:
-        message = json.dumps(tweet)
-        messenger.send_message_to_exchange(ex_name=EXCHANGE,
-                                           message=message,
-                                           topic=PUB_TOPIC)
-        print("Sent message : ")
-        for k, v in tweet.items():
-            print(k, "-->", v)
+    # Only ask for tweets newer than the last successful run
+    checkpoint = load_checkpoint()
+    since_id = checkpoint.get(query)
+    high_water = since_id
+    all_acked = True
+
+    # Send update, page by page
+    for tweet_list in get_tweets(twitter_api, query, since_id=since_id):
+        if not tweet_list:
+            continue
+        if publish_tweets(messenger, tweet_list) != len(tweet_list):
+            all_acked = False
+        page_max = max(int(tweet['id_str']) for tweet in tweet_list)
+        high_water = max(high_water or 0, page_max)
 
-        print("on topic :", PUB_TOPIC)
-        time.sleep(DELAY_PUB)
+    # The search walks from newest to oldest, so the high-water mark is only
+    # safe to store once the whole window has been shipped
+    if all_acked and high_water != since_id:
+        checkpoint[query] = high_water
+        save_checkpoint(checkpoint)
+    messenger.disconnect()
 
 
 def main():
 
     print(" Beginning Scraper ")
+    Metrics.start_http_server(METRICS_PORT)
 
-    # Schedule the scraper to run every 30 minutes
-    while True:
-        try:
-            scraper()
-        except Exception as e:
-            print("An error occured while scraping tweets : ")
-            print(e)
-            print("\nRetrying in 15 minutes...")
-            time.sleep(RETRY_TIME)
-            continue
-        time.sleep(TIME_WINDOW)
+    twitter_api = make_api()
+
+    # One connection carries the tweets of every query
+    messenger = Messenger()
+    messenger.connect(host=DATA_HUB_HOST,
+                      uname=DATA_HUB_UNAME,
+                      pwd=DATA_HUB_PWD)
+    messenger.connect_to_exchange(ex_name=EXCHANGE)
+
+    scheduler = ScrapeScheduler(
+        QUERIES,
+        fetch=lambda query, since_id: get_tweets(twitter_api, query,
+                                                 since_id=since_id),
+        publish=publish_tweets,
+        messenger=messenger,
+        checkpoint=load_checkpoint(),
+        save_checkpoint=save_checkpoint,
+        rate_limit_errors=RATE_LIMIT_ERRORS)
+    scheduler.run_forever()
 
 
 if __name__ == "__main__":
@@ -7,12 +7,15 @@
 """
 
 
-import os
-import json
-import time
-import pandas as pd
+from sqlalchemy import BigInteger, Integer, String
+import MessageCodec
+import Metrics
+import Middleware
 from Receiver import Receiver
-from SQLDatabaseManager import SQLDatabaseManager
+from SQLDatabaseManager import SQLDatabaseManager, TableSchema
+from BatchingSink import BatchingSink
+from Deduplicator import Deduplicator, tweet_key
+from WriteAheadSpool import WriteAheadSpool
 
 EXCHANGE = "twitter_feed"
 SUB_TOPIC = "cleaned"
@@ -25,6 +28,56 @@ DB_IP = ''
 DATABASE = 'tweets'
 DB_UNAME = 'rtis'
 DB_PWD = 'rtis'
+DB_PORT = '3306'
+TABLE_NAME = "UCHICAGO"
+
+# One row per tweet, updated in place when the tweet is seen again. To range
+# partition by tweet time on MySQL, set PARTITIONS, e.g. to
+# SQLDatabaseManager.month_partitions(2018, 11, 12)
+PARTITIONS = []
+TWEET_SCHEMA = TableSchema(
+    TABLE_NAME,
+    columns=[('id_str', String(32)),
+             ('created_at_epoch', BigInteger()),
+             ('scraped_at_epoch', BigInteger()),
+             ('t', Integer()),
+             ('retweet_count', Integer()),
+             ('favorite_count', Integer()),
+             ('keywords', String(255))],
+    primary_key=['id_str'],
+    indexes=['created_at_epoch', 'keywords'],
+    partition_column='created_at_epoch' if PARTITIONS else None,
+    partitions=PARTITIONS)
+
+BATCH_ROWS = 500
+BATCH_DELAY_MS = 250
+
+# Rows the database cannot take right now wait here, and are replayed once
+# it is back
+SPOOL_DIR = "store_spool"
+
+# Shared durable queue of the store workers started by Supervisor.py
+POOL_QUEUE = "tweet_store_pool"
+
+# Tweets already stored are dropped before they reach the database
+DEDUP_SNAPSHOT = "store_dedup.snapshot"
+
+# Metrics are served at http://host:METRICS_PORT/
+METRICS_PORT = 9102
+POOL_METRICS_PORT = 9130    # plus the worker slot
+
+# 1 in PROFILE_EVERY messages is profiled once `kill -USR2 <pid>` switches
+# the profiler on. `kill -USR1 <pid>` writes the profile to
+# profile_<pid>.prof
+PROFILE_EVERY = 100
+
+# Created in main() once the database connection is up
+sink = None
+dedup = None
+
+
+_duplicates_total = Metrics.counter(
+    "rtis_store_duplicates_total", "Tweets dropped as already stored")
 
 
 def get_df(tweet):
@@ -39,44 +92,85 @@ def get_df(tweet):
 
 def callback(ch, method, properties, body):
     """
-    This callback takes the data and stored it into the database
+    This callback buffers the data for the database. The message is acked
+    by the sink once its batch has been committed.
     :return: 1 if success, -1 if fail
     """
     try:
-        content_str = body.decode("utf-8")
+        json_msg = MessageCodec.loads(body, properties)
 
-        json_msg = json.loads(content_str)
+        # Duplicates are only acked, along with the rest of the batch. A
+        # tweet seen again with new counts is not one, and is upserted
+        key = tweet_key(json_msg)
+        if key and dedup.contains(key):
+            _duplicates_total.labels().inc()
+            return sink.add(ch, method.delivery_tag, None)
 
-        # Push the message into the database
-        json_df = get_df(json_msg)
-        uc_df = pd.DataFrame(json_df, index=[0])
-
-        sqldbm = SQLDatabaseManager()
-
-        port = '3306'
-        ret = sqldbm.connect(host=DB_IP,
-                             database=DATABASE,
-                             username=DB_UNAME,
-                             password=DB_PWD,
-                             port=port)
-
-        if ret != 1:
-            print(" Closing program ")
-            return
-
-        sqldbm.insert(dframe=uc_df, table_name="UCHICAGO",
-                      if_table_exists="append")
-
-        print("Message received -> stored")
-        return 1
+        # Hand the row over to the batching sink
+        return sink.add(ch, method.delivery_tag, get_df(json_msg))
     except Exception as e:
         print("Exception caught in callback ")
         print(e)
         print("Message could not be saved to DB. Skipping ....")
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         return -1
 
 
-def main():
+def mark_stored(rows):
+    """
+    Records the tweets of a committed batch in the dedup index
+    """
+    for row in rows:
+        key = tweet_key(row)
+        if key:
+            dedup.add(key)
+
+
+def main(queue_name=None, slot=None):
+    """
+    Runs one store until it is stopped (SIGTERM/SIGINT), committing or
+    spooling the batch in progress before it exits
+    :param queue_name: Consume from this shared durable queue, as one of
+                       several store workers
+    :param slot: Number of the worker. Each slot has its own spool and dedup
+                 snapshot. The spool is drained before the worker exits;
+                 what the database did not take then is picked up by the
+                 next worker in the slot
+    """
+    global sink, dedup
+
+    spool_dir, dedup_snapshot = SPOOL_DIR, DEDUP_SNAPSHOT
+    metrics_port = METRICS_PORT
+    queue_args = {}
+    if queue_name is not None:
+        suffix = ".pool." + str(slot or 0)
+        spool_dir += suffix
+        dedup_snapshot += suffix
+        metrics_port = POOL_METRICS_PORT + (slot or 0)
+        queue_args = dict(queue_name=queue_name, durable=True,
+                          exclusive=False)
+
+    # One database connection for the lifetime of the store
+    sqldbm = SQLDatabaseManager()
+    ret = sqldbm.connect(host=DB_IP,
+                         database=DATABASE,
+                         username=DB_UNAME,
+                         password=DB_PWD,
+                         port=DB_PORT)
+    # Keep consuming into the spool if the database is down; the table is
+    # created by the first write that gets through
+    if ret != 1 or sqldbm.create_table(TWEET_SCHEMA) != 1:
+        print(" Database unreachable. Spooling tweets to", spool_dir)
+    dedup = Deduplicator(snapshot_path=dedup_snapshot)
+    sink = BatchingSink(sqldbm, TABLE_NAME,
+                        max_rows=BATCH_ROWS,
+                        max_delay_ms=BATCH_DELAY_MS,
+                        on_commit=mark_stored,
+                        upsert=True,
+                        spool=WriteAheadSpool(spool_dir),
+                        key='id_str')
+
+    Metrics.start_http_server(metrics_port)
 
     # Receive all the tweets and push them into the database
     print("Waiting for tweets")
@@ -87,18 +181,36 @@ def main():
     receiver.connect(host=DATA_HUB_HOST,
                      uname=DATA_HUB_UNAME,
                      pwd=DATA_HUB_PWD)
+    receiver.stop_on_signal()
+    profiler = Middleware.SampledProfiler(every=PROFILE_EVERY,
+                                          enabled=False)
 
     # Connect to the exchange
     try:
         ret = receiver.get_data_from_exchange(ex_name=EXCHANGE,
                                               topic=SUB_TOPIC,
-                                              callback=callback)
+                                              callback=callback,
+                                              middleware=[profiler],
+                                              auto_ack=False,
+                                              **queue_args)
     except Exception as e:
         print(" An exception was caught while getting data from the exchange :")
         print(e)
 
         print("\n Exiting .... \n")
 
+    # Stopped : commit (or spool) and ack the batch in progress. Anything
+    # prefetched but not buffered is requeued when the connection closes
+    sink.flush()
+    receiver.disconnect()
+    # A retired pool worker's spool is only read again if a worker comes
+    # back in its slot, so hand what it holds to the database now
+    left = sink.drain_spool()
+    if left:
+        print(" Database unreachable.", left, "rows stay spooled in",
+              spool_dir)
+    dedup.save()
+
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,260 @@
+"""
+@file_name : WindowAggregator.py
+@author : Srihari Seshadri
+@description : This file defines an incremental windowed aggregator for a
+                stream of messages (e.g. cleaned tweets) :
+                1. Counts and sums per group (e.g. keyword, t) in a ring of
+                   fixed-width time buckets held in numpy arrays
+                2. Running totals for sliding windows and the current and
+                   last closed tumbling windows, updated on every message
+                3. Expired buckets are evicted as time moves on, so reading
+                   any window costs O(groups), never a rescan
+                4. Snapshots of every window as a dataframe
+@date : 12-03-2018
+"""
+
+import threading
+import time
+
+import numpy as np
+
+BUCKET_SECONDS = 60
+NUM_BUCKETS = 60            # history kept, in buckets
+INITIAL_GROUPS = 64         # rows allocated up front, doubled when full
+
+SLIDING = "sliding"
+TUMBLING = "tumbling"
+
+# name -> (kind, length in seconds). Lengths must be whole buckets
+WINDOWS = {"5m": (SLIDING, 300),
+           "1h": (SLIDING, 3600),
+           "15m": (TUMBLING, 900)}
+
+
+class WindowAggregator:
+
+    def __init__(self, group_fields=('keywords',),
+                 value_fields=('retweet_count', 'favorite_count'),
+                 time_field='scraped_at_epoch',
+                 windows=None, bucket_seconds=BUCKET_SECONDS,
+                 num_buckets=NUM_BUCKETS):
+        """
+        :param group_fields: Message fields making up the group key
+        :param value_fields: Numeric message fields to sum
+        :param time_field: Field holding the event time (epoch seconds).
+                           Messages without it are counted at arrival time
+        :param windows: dict of name -> (SLIDING or TUMBLING, seconds)
+        :param bucket_seconds: Width of a bucket
+        :param num_buckets: Number of buckets kept
+        """
+        self.group_fields = tuple(group_fields)
+        self.value_fields = tuple(value_fields)
+        self.time_field = time_field
+        self.bucket_seconds = bucket_seconds
+        self.num_buckets = num_buckets
+        self.windows = {}
+        for name, (kind, seconds) in (windows or WINDOWS).items():
+            length = int(seconds // bucket_seconds)
+            if kind not in (SLIDING, TUMBLING) or length < 1 or \
+                    length * bucket_seconds != seconds:
+                raise ValueError("Window " + name + " must be a whole "
+                                 "number of " + str(bucket_seconds) +
+                                 "s buckets")
+            if kind == SLIDING and length > num_buckets:
+                raise ValueError("Window " + name + " is longer than the " +
+                                 str(num_buckets) + " buckets kept")
+            self.windows[name] = (kind, length)
+
+        # Metric 0 is the message count, the others the value fields
+        self._num_metrics = 1 + len(self.value_fields)
+        self._groups = {}           # group key -> row
+        self._keys = []             # row -> group key
+        self._buckets = np.zeros((INITIAL_GROUPS, num_buckets,
+                                  self._num_metrics))
+        self._bucket_ids = np.full(num_buckets, -1, dtype=np.int64)
+        self._totals = {name: np.zeros((INITIAL_GROUPS, self._num_metrics))
+                        for name in self.windows}
+        self._closed = {name: None for name, (kind, _) in
+                        self.windows.items() if kind == TUMBLING}
+        self._current = None        # id of the newest bucket
+        self.late = 0               # messages too old for any window
+        self._lock = threading.Lock()
+        pass
+
+    def _row(self, key):
+        row = self._groups.get(key)
+        if row is not None:
+            return row
+        row = len(self._keys)
+        if row == self._buckets.shape[0]:
+            grow = self._buckets.shape[0]
+            self._buckets = np.concatenate(
+                [self._buckets, np.zeros_like(self._buckets[:grow])])
+            for name, totals in self._totals.items():
+                self._totals[name] = np.concatenate(
+                    [totals, np.zeros_like(totals)])
+        self._groups[key] = row
+        self._keys.append(key)
+        return row
+
+    def _advance(self, bucket):
+        """
+        Moves the newest bucket forward, taking expired buckets out of the
+        sliding totals and closing tumbling windows on their boundaries
+        """
+        if self._current is None:
+            self._current = bucket
+            self._bucket_ids[bucket % self.num_buckets] = bucket
+            return
+        if bucket - self._current >= self.num_buckets:
+            # Everything kept has expired
+            self._buckets[:] = 0
+            self._bucket_ids[:] = -1
+            for name, (kind, length) in self.windows.items():
+                if kind == TUMBLING and \
+                        self._current // length != bucket // length:
+                    previous = bucket // length * length - length
+                    if self._current // length * length != previous:
+                        # The window before this one saw no messages
+                        self._totals[name][:] = 0
+                    self._close(name, previous)
+                self._totals[name][:] = 0
+            self._current = bucket
+            self._bucket_ids[bucket % self.num_buckets] = bucket
+            return
+
+        for b in range(self._current + 1, bucket + 1):
+            for name, (kind, length) in self.windows.items():
+                if kind == SLIDING:
+                    leaving = b - length
+                    slot = leaving % self.num_buckets
+                    if self._bucket_ids[slot] == leaving:
+                        self._totals[name] -= self._buckets[:, slot]
+                elif b % length == 0:
+                    self._close(name, b - length)
+            slot = b % self.num_buckets
+            self._buckets[:, slot] = 0
+            self._bucket_ids[slot] = b
+        self._current = bucket
+
+    def _close(self, name, start_bucket):
+        totals = self._totals[name]
+        self._closed[name] = (start_bucket, totals[:len(self._keys)].copy())
+        totals[:] = 0
+
+    def add(self, message):
+        """
+        Adds one message to every window
+        :param message: dict with the group, value and time fields
+        :return: 1 if counted, 0 if it was too late for every window
+        """
+        timestamp = message.get(self.time_field)
+        if timestamp is None:
+            timestamp = time.time()
+        bucket = int(timestamp // self.bucket_seconds)
+        key = tuple(message.get(field) for field in self.group_fields)
+        values = [1.0] + [float(message.get(field) or 0)
+                          for field in self.value_fields]
+
+        with self._lock:
+            if self._current is None or bucket > self._current:
+                self._advance(bucket)
+            elif bucket <= self._current - self.num_buckets:
+                self.late += 1
+                return 0
+            row = self._row(key)
+            slot = bucket % self.num_buckets
+            if self._bucket_ids[slot] != bucket:
+                # A late message into a bucket no message advanced into :
+                # claim the slot so the bucket is evicted when it expires
+                self._buckets[:, slot] = 0
+                self._bucket_ids[slot] = bucket
+            self._buckets[row, slot] += values
+            counted = 0
+            for name, (kind, length) in self.windows.items():
+                if kind == SLIDING:
+                    in_window = bucket > self._current - length
+                else:
+                    in_window = bucket // length == self._current // length
+                if in_window:
+                    self._totals[name][row] += values
+                    counted = 1
+            if not counted:
+                self.late += 1
+            return counted
+
+    def add_batch(self, messages):
+        """
+        Adds several messages
+        :return: Number of messages counted
+        """
+        return sum(self.add(message) for message in messages)
+
+    def advance_to(self, timestamp=None):
+        """
+        Expires buckets up to a time even if no message arrived since, e.g.
+        before taking a snapshot
+        :param timestamp: Epoch seconds. Defaults to now
+        :return: None
+        """
+        bucket = int((time.time() if timestamp is None else timestamp) //
+                     self.bucket_seconds)
+        with self._lock:
+            if self._current is not None and bucket > self._current:
+                self._advance(bucket)
+
+    def window(self, name, closed=False):
+        """
+        Current totals of one window
+        :param name: Window name
+        :param closed: For tumbling windows, return the last closed window
+                       instead of the one in progress
+        :return: (window start epoch, window end epoch, dict of group key ->
+                 numpy array [count, value sums...]). Start and end are
+                 None if there is no data yet
+        """
+        kind, length = self.windows[name]
+        with self._lock:
+            if self._current is None:
+                return None, None, {}
+            if closed:
+                if self._closed.get(name) is None:
+                    return None, None, {}
+                start, totals = self._closed[name]
+            else:
+                totals = self._totals[name][:len(self._keys)].copy()
+                if kind == SLIDING:
+                    start = self._current - length + 1
+                else:
+                    start = self._current // length * length
+            keys = list(self._keys[:len(totals)])
+        return (start * self.bucket_seconds,
+                (start + length) * self.bucket_seconds,
+                {key: totals[row] for row, key in enumerate(keys)
+                 if totals[row, 0] > 0})
+
+    def snapshot(self):
+        """
+        Every window as one dataframe. Tumbling windows appear twice : the
+        one in progress and the last closed one (closed=True)
+        :return: Dataframe with the group fields, window, window_start,
+                 window_end, closed, count and the value fields
+        """
+        import pandas as pd
+        records = []
+        for name, (kind, _) in self.windows.items():
+            views = [False, True] if kind == TUMBLING else [False]
+            for closed in views:
+                start, end, groups = self.window(name, closed=closed)
+                for key, totals in groups.items():
+                    record = dict(zip(self.group_fields, key))
+                    record.update(window=name, window_start=start,
+                                  window_end=end, closed=closed,
+                                  count=int(totals[0]))
+                    record.update(zip(self.value_fields,
+                                      totals[1:].tolist()))
+                    records.append(record)
+        columns = (list(self.group_fields) +
+                   ['window', 'window_start', 'window_end', 'closed',
+                    'count'] + list(self.value_fields))
+        return pd.DataFrame(records, columns=columns)
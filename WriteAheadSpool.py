@@ -0,0 +1,248 @@
+"""
+@file_name : WriteAheadSpool.py
+@author : Srihari Seshadri
+@description : This file defines a durable local spool of rows waiting for
+                the database, so a consumer can keep acking the data hub
+                while the database is slow or down :
+                1. Append-only log of row batches in memory-mapped segment
+                   files, each record checksummed and synced before append
+                   returns
+                2. Replays the oldest rows in large batches once the
+                   database is back, merging rows with the same key
+                3. Deletes or recycles segments that are fully replayed
+                4. Recovers its position (and drops a torn last record)
+                   after a crash
+@date : 12-03-2018
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+SEGMENT_SIZE = 64 * 1024 * 1024     # bytes per segment file
+REPLAY_ROWS = 10000                 # rows per replay batch
+SYNC = True     # msync every append. Without it a crash may lose the tail
+
+_MAGIC = b"RTWS"
+_HEADER = struct.Struct("<4sIQQ")       # magic, version, write pos, read pos
+_HEADER_SIZE = 64
+_RECORD = struct.Struct("<III")         # payload length, crc32, row count
+_SEGMENT_SUFFIX = ".seg"
+
+
+class _Segment:
+
+    def __init__(self, path, size=SEGMENT_SIZE, create=False):
+        self.path = path
+        self.number = int(os.path.basename(path)[:-len(_SEGMENT_SUFFIX)])
+        self._fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0))
+        if create:
+            os.ftruncate(self._fd, size)
+        self.size = os.fstat(self._fd).st_size
+        self._map = mmap.mmap(self._fd, self.size)
+        if create:
+            _HEADER.pack_into(self._map, 0, _MAGIC, 1, _HEADER_SIZE,
+                              _HEADER_SIZE)
+            self.sync(0, _HEADER_SIZE)
+        magic, _, self.write_pos, self.read_pos = _HEADER.unpack_from(
+            self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError(path + " is not a spool segment")
+        pass
+
+    def _store_header(self):
+        _HEADER.pack_into(self._map, 0, _MAGIC, 1, self.write_pos,
+                          self.read_pos)
+
+    def sync(self, start, length):
+        if not SYNC:
+            return
+        aligned = start - start % mmap.PAGESIZE
+        self._map.flush(aligned, min(self.size, start + length) - aligned)
+
+    def free(self):
+        return self.size - self.write_pos
+
+    def append(self, payload, rows):
+        start = self.write_pos
+        _RECORD.pack_into(self._map, start, len(payload),
+                          zlib.crc32(payload), rows)
+        body = start + _RECORD.size
+        self._map[body:body + len(payload)] = payload
+        self.sync(start, _RECORD.size + len(payload))
+        # The record is on disk before the header points past it
+        self.write_pos = body + len(payload)
+        self._store_header()
+        self.sync(0, _HEADER_SIZE)
+
+    def records(self, position=None):
+        """
+        Yields (position after the record, row count, payload) from a
+        position until the write position or the first damaged record
+        """
+        position = self.read_pos if position is None else position
+        while position + _RECORD.size <= self.write_pos:
+            length, crc, rows = _RECORD.unpack_from(self._map, position)
+            end = position + _RECORD.size + length
+            if end > self.write_pos:
+                return
+            payload = bytes(self._map[position + _RECORD.size:end])
+            if zlib.crc32(payload) != crc:
+                return
+            yield end, rows, payload
+            position = end
+
+    def recover(self):
+        """
+        Moves the write position back to the end of the last intact record
+        :return: Number of rows waiting to be replayed
+        """
+        end, pending = self.read_pos, 0
+        for end, rows, _ in self.records():
+            pending += rows
+        if end != self.write_pos:
+            self.write_pos = end
+            self._store_header()
+            self.sync(0, _HEADER_SIZE)
+        return pending
+
+    def advance(self, position):
+        self.read_pos = position
+        if self.read_pos == self.write_pos:
+            # Recycle the space of a fully replayed segment
+            self.read_pos = self.write_pos = _HEADER_SIZE
+        self._store_header()
+        self.sync(0, _HEADER_SIZE)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class WriteAheadSpool:
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        """
+        Opens the spool in a directory, recovering what a previous run left
+        :param path: Directory holding the segment files
+        :param segment_size: Size of new segment files in bytes
+        """
+        self.path = path
+        self._segment_size = segment_size
+        self._lock = threading.RLock()
+        self._replay_lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._segments = [
+            _Segment(os.path.join(path, name))
+            for name in sorted(os.listdir(path))
+            if name.endswith(_SEGMENT_SUFFIX)]
+        self._pending = sum(segment.recover() for segment in self._segments)
+        pass
+
+    def pending(self):
+        """
+        :return: Number of rows waiting to be replayed
+        """
+        return self._pending
+
+    def append(self, rows):
+        """
+        Durably appends a batch of rows
+        :param rows: List of JSON-able dicts
+        :return: 1 if success, -1 if failure
+        """
+        if not rows:
+            return 1
+        try:
+            payload = json.dumps(rows, separators=(",", ":")).encode("utf-8")
+            with self._lock:
+                needed = _RECORD.size + len(payload)
+                if not self._segments or \
+                        self._segments[-1].free() < needed:
+                    self._new_segment(needed)
+                self._segments[-1].append(payload, len(rows))
+                self._pending += len(rows)
+        except Exception as e:
+            print("Exception caught while spooling rows :")
+            print(e)
+            return -1
+        return 1
+
+    def _new_segment(self, needed):
+        number = self._segments[-1].number + 1 if self._segments else 0
+        path = os.path.join(self.path, "%012d%s" % (number, _SEGMENT_SUFFIX))
+        size = max(self._segment_size, _HEADER_SIZE + needed)
+        self._segments.append(_Segment(path, size, create=True))
+
+    def replay(self, write, max_rows=REPLAY_ROWS, key=None):
+        """
+        Hands the oldest spooled rows to `write` and forgets them once it
+        succeeds. Rows sharing a key are merged, the newest one winning.
+        The spool is only locked while the batch is read and forgotten, so
+        appends go on while `write` runs. One replay runs at a time.
+        :param write: Function taking a list of rows, returning 1 on success
+        :param max_rows: Rows per call (whole records are always taken)
+        :param key: Optional field identifying a row, e.g. 'id_str'
+        :return: Number of rows replayed, or -1 if the write failed
+        """
+        with self._replay_lock:
+            with self._lock:
+                batch = []
+                taken = []      # (segment, position after the last record)
+                for segment in self._segments:
+                    position = None
+                    for position, _, payload in segment.records():
+                        batch.extend(json.loads(payload))
+                        if len(batch) >= max_rows:
+                            break
+                    if position is not None:
+                        taken.append((segment, position))
+                    if len(batch) >= max_rows:
+                        break
+            if not batch:
+                return 0
+
+            rows = batch
+            if key is not None:
+                merged = {}
+                for row in batch:
+                    merged.pop(row.get(key), None)
+                    merged[row.get(key)] = row
+                rows = list(merged.values())
+            if write(rows) != 1:
+                return -1
+
+            with self._lock:
+                for segment, position in taken:
+                    # Skip segments let go of by close() during the write
+                    if segment in self._segments:
+                        segment.advance(position)
+                self._pending -= len(batch)
+                self.compact()
+            return len(batch)
+
+    def compact(self):
+        """
+        Deletes the segment files that have been fully replayed, keeping the
+        newest one to append to
+        :return: Number of segments deleted
+        """
+        with self._lock:
+            removed = 0
+            while len(self._segments) > 1 and \
+                    self._segments[0].read_pos == \
+                    self._segments[0].write_pos:
+                segment = self._segments.pop(0)
+                segment.close()
+                os.remove(segment.path)
+                removed += 1
+            return removed
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
@@ -0,0 +1,15 @@
+"""
+@file_name : conftest.py
+@author : Srihari Seshadri
+@description : Shared setup of the behaviour tests. The modules live at the
+                top of the repository, and every test talks to the in-process
+                FakeBroker instead of a data hub
+@date : 12-03-2018
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+os.environ["RTIS_TRANSPORT"] = "fake"
@@ -0,0 +1,109 @@
+"""
+@file_name : test_dataframe_codec.py
+@author : Srihari Seshadri
+@description : Round trip tests of the binary columnar dataframe format
+@date : 12-03-2018
+"""
+
+import numpy as np
+import pandas as pd
+import pandas.testing as pdt
+import pytest
+import DataFrameCodec
+
+
+def _round_trip(dframe):
+    body, headers = DataFrameCodec.dumps(dframe)
+    assert headers[DataFrameCodec.FORMAT_HEADER] == \
+        DataFrameCodec.FORMAT_COLUMNAR
+    return DataFrameCodec.decode_dataframe(body)
+
+
+def _check(dframe):
+    pdt.assert_frame_equal(_round_trip(dframe), dframe, check_exact=True,
+                           check_column_type=True, check_index_type=True)
+
+
+def test_column_dtypes():
+    _check(pd.DataFrame({
+        "int": np.arange(4, dtype=np.int32),
+        "float": [0.5, np.nan, 2.0, 3.5],
+        "bool": [True, False, True, True],
+        "text": ["a", None, "tab\there", "é"],
+        "when": pd.to_datetime(["2018-11-14"] * 4),
+        "when_tz": pd.to_datetime(["2018-11-14 10:00"] * 4).tz_localize(
+            "US/Central"),
+        "nullable": pd.array([1, None, 3, 4], dtype="Int64"),
+        "flag": pd.array([True, None, False, True], dtype="boolean"),
+        "string": pd.array(["x", None, "y", "z"], dtype="string"),
+        "category": pd.Categorical(["b", "a", None, "b"], ordered=True)}))
+
+
+def test_duplicate_and_non_string_labels():
+    _check(pd.DataFrame([[1, 2, 3]], columns=["a", "a", "b"]))
+    _check(pd.DataFrame([[1, 2.5]], columns=[10, 20]))
+    _check(pd.DataFrame([[1, 2, 3]], columns=[1, "1", None]))
+    _check(pd.DataFrame(np.zeros((2, 3))))
+
+
+def test_column_named_like_the_index():
+    dframe = pd.DataFrame({"__index__": [1, 2]},
+                          index=pd.Index(["x", "y"], name="key"))
+    _check(dframe)
+
+
+def test_multi_index_rows_and_columns():
+    index = pd.MultiIndex.from_tuples([("a", 1), ("b", 2)],
+                                      names=["k", "n"])
+    columns = pd.MultiIndex.from_tuples([("v", 1), ("v", 2)])
+    _check(pd.DataFrame([[1.0, 2.0], [3.0, 4.0]], index=index,
+                        columns=columns))
+
+
+def test_indexes():
+    _check(pd.DataFrame({"v": [1, 2]}, index=pd.RangeIndex(5, 9, 2,
+                                                            name="r")))
+    _check(pd.DataFrame({"v": [1, 2]},
+                        index=pd.to_datetime(["2018-01-01", "2018-01-02"])))
+    _check(pd.DataFrame({"v": []}, dtype=np.int64))
+
+
+def test_frames_that_cannot_round_trip_are_refused():
+    with pytest.raises(ValueError):
+        DataFrameCodec.dumps(pd.DataFrame({"mixed": [1, "a"]}))
+    with pytest.raises(ValueError):
+        DataFrameCodec.dumps(pd.DataFrame(
+            [[1]], columns=[pd.Timestamp("2018-01-01")]))
+    with pytest.raises(ValueError):
+        DataFrameCodec.dumps(pd.DataFrame(
+            {"p": pd.period_range("2018-01", periods=2, freq="M")}))
+
+
+def test_version_1_bodies_still_decode():
+    dframe = pd.DataFrame({"a": [1, 2], "b": ["x", "y"]},
+                          index=pd.Index([7, 8], name="i"))
+    place_buffers = []
+
+    def place(buf):
+        # Same layout as encode_dataframe, built by hand in version 1 form
+        offset = sum(len(b) for b in place_buffers)
+        data = bytes(memoryview(buf).cast("B"))
+        data += b"\0" * DataFrameCodec._padding(len(data))
+        place_buffers.append(data)
+        return [offset, len(data)]
+
+    columns = []
+    for name, series in [("a", dframe["a"]), ("b", dframe["b"]),
+                         ("__index__", dframe.index.to_series())]:
+        entry = DataFrameCodec._column_entry(series, place)
+        entry["name"] = name
+        columns.append(entry)
+    schema = DataFrameCodec.json.dumps({
+        "nrows": 2, "index": True, "index_schema": {"name": "i"},
+        "columns": columns}).encode("utf-8")
+    schema += b" " * DataFrameCodec._padding(
+        DataFrameCodec._PREAMBLE.size + len(schema))
+    body = DataFrameCodec._PREAMBLE.pack(DataFrameCodec.MAGIC, 1,
+                                         len(schema)) + schema + \
+        b"".join(place_buffers)
+    pdt.assert_frame_equal(DataFrameCodec.decode_dataframe(body), dframe)
@@ -0,0 +1,98 @@
+"""
+@file_name : test_dataframe_stream.py
+@author : Srihari Seshadri
+@description : Tests of dataframe stream reassembly : chunks handed out in
+                order, redelivered chunks handed out once, and redelivered
+                chunks acked by the receiver over the fake broker
+@date : 12-03-2018
+"""
+
+import pandas as pd
+import pika
+
+import DataFrameCodec
+import DataFrameStream
+import FakeBroker
+import Messenger
+import Receiver
+
+
+def chunk_message(stream_id, seq, final, dframe):
+    body, headers = DataFrameCodec.dumps(dframe)
+    headers.update(DataFrameCodec.stream_headers(stream_id, seq, final))
+    return pika.BasicProperties(headers=headers), body
+
+
+def frames(n):
+    return [pd.DataFrame({"id": [i * 2, i * 2 + 1]}) for i in range(n)]
+
+
+def test_chunks_come_out_in_order_once():
+    assembler = DataFrameStream.StreamAssembler()
+    messages = [chunk_message("s", seq, seq == 2, dframe)
+                for seq, dframe in enumerate(frames(3))]
+    # Chunk 1 arrives before chunk 0, which is then redelivered
+    assert assembler.add(*messages[1]) == []
+    ready = assembler.add(*messages[0])
+    assert [chunk.seq for chunk in ready] == [0, 1]
+    assert assembler.add(*messages[0]) == []
+    assert assembler.add(*messages[1]) == []
+    last = assembler.add(*messages[2])
+    assert [(chunk.seq, chunk.final) for chunk in last] == [(2, True)]
+    assert assembler.incomplete() == 0
+    # The stream is complete : later copies are redeliveries
+    for message in messages:
+        assert assembler.add(*message) == []
+
+
+def test_reassembled_frame_is_handed_out_once():
+    assembler = DataFrameStream.StreamAssembler(reassemble=True)
+    messages = [chunk_message("s", seq, seq == 2, dframe)
+                for seq, dframe in enumerate(frames(3))]
+    assert assembler.add(*messages[0]) == []
+    assert assembler.add(*messages[0]) == []
+    assert assembler.add(*messages[2]) == []
+    whole = assembler.add(*messages[1])
+    assert len(whole) == 1
+    assert whole[0].dataframe["id"].tolist() == list(range(6))
+    assert assembler.add(*messages[2]) == []
+
+
+def test_receiver_acks_redelivered_chunks():
+    broker = FakeBroker.get_broker()
+    channel = broker.connection().channel()
+    channel.exchange_declare(exchange="stream_test", exchange_type="topic")
+    channel.queue_declare(queue="stream_test_q")
+    channel.queue_bind(queue="stream_test_q", exchange="stream_test",
+                       routing_key="rows.__df")
+
+    messenger = Messenger.Messenger()
+    assert messenger.connect() == 1
+    assert messenger.connect_to_exchange("stream_test") == 1
+    dframe = pd.DataFrame({"id": range(6)})
+    for _ in range(2):
+        # The second copy stands in for a producer retrying the stream
+        assert messenger.send_dataframe_stream(
+            "stream_test", dframe, "rows.__df", chunk_rows=2,
+            stream_id="s") == 1
+    # A one chunk stream marks the end of the copies
+    assert messenger.send_dataframe_stream(
+        "stream_test", dframe.head(1), "rows.__df", stream_id="end") == 1
+
+    receiver = Receiver.Receiver()
+    assert receiver.connect() == 1
+    received = []
+    stream = receiver.get_dataframe_stream(
+        queue_name="stream_test_q", ex_name="stream_test", topic="rows.__df",
+        exclusive=False, poll_interval=0.1)
+    for chunk in stream:
+        received.append((chunk.stream_id, chunk.seq))
+        if chunk.stream_id == "end":
+            break
+    stream.close()
+    assert received == [("s", 0), ("s", 1), ("s", 2), ("end", 0)]
+    assert broker.queue_depth("stream_test_q") == 0
+    # Only the last chunk, not asked past, is still unacked
+    receiver.disconnect()
+    assert broker.queue_depth("stream_test_q") == 1
+    messenger.disconnect()
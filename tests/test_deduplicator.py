@@ -0,0 +1,47 @@
+"""
+@file_name : test_deduplicator.py
+@author : Srihari Seshadri
+@description : Tests of the duplicate index : only exact hits drop a
+                message, and the index survives a snapshot
+@date : 12-03-2018
+"""
+
+from Deduplicator import Deduplicator, tweet_key
+
+
+def test_only_exact_hits_are_duplicates():
+    dedup = Deduplicator(lru_size=2, bloom_capacity=1000)
+    for key in ("a", "b", "c"):
+        dedup.add(key)
+    # "a" left the LRU and is only in the Bloom filter now
+    assert dedup.contains("c")
+    assert not dedup.contains("a")
+    assert dedup.contains("a", probable=True)
+    assert not dedup.contains("never seen")
+    stats = dedup.stats()
+    assert stats["exact_hits"] == 1
+    assert stats["bloom_hits"] == 2
+    assert stats["hits"] == 1
+
+
+def test_check_and_add():
+    dedup = Deduplicator()
+    assert not dedup.check_and_add("a")
+    assert dedup.check_and_add("a")
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "dedup.snapshot")
+    dedup = Deduplicator(snapshot_path=path)
+    dedup.add("a")
+    assert dedup.save() == 1
+    restored = Deduplicator(snapshot_path=path)
+    assert restored.contains("a")
+    assert not restored.contains("b")
+
+
+def test_tweet_key_includes_the_counts():
+    tweet = {"id_str": "1", "retweet_count": 2, "favorite_count": 3}
+    assert tweet_key(tweet) == "1:2:3"
+    assert tweet_key(dict(tweet, retweet_count=4)) != tweet_key(tweet)
+    assert tweet_key({"retweet_count": 2}) is None
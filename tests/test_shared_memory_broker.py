@@ -0,0 +1,95 @@
+"""
+@file_name : test_shared_memory_broker.py
+@author : Srihari Seshadri
+@description : Tests of the shared memory transport's backpressure : rings
+                hold publishers back instead of overwriting what a reader
+                has not taken
+@date : 12-03-2018
+"""
+
+import multiprocessing
+import os
+import pytest
+
+shared_memory = pytest.importorskip("multiprocessing.shared_memory")
+import SharedMemoryBroker    # noqa: E402
+
+CAPACITY = 4096
+BODY = b"x" * 100
+
+
+@pytest.fixture
+def ring():
+    name = SharedMemoryBroker._segment_name("test%d" % os.getpid(), "ex",
+                                            "ring")
+    ring = SharedMemoryBroker.SharedRing(name, capacity=CAPACITY)
+    yield ring
+    ring.close(unlink=True)
+
+
+def _fill(ring, timeout=0.2):
+    appended = 0
+    with pytest.raises(TimeoutError):
+        while True:
+            ring.append("key", b"[]", BODY, timeout=timeout)
+            appended += 1
+    return appended
+
+
+def test_full_ring_blocks_instead_of_overwriting(ring):
+    slot = ring.register()
+    position = ring.head()
+    appended = _fill(ring)
+    assert appended * len(BODY) < CAPACITY
+
+    records, _, overrun = ring.read(position, limit=appended, slot=slot)
+    assert not overrun
+    assert len(records) == appended
+    ring.append("key", b"[]", BODY, timeout=0.2)
+
+
+def test_rings_without_readers_never_block(ring):
+    for _ in range(3 * CAPACITY // len(BODY)):
+        ring.append("key", b"[]", BODY, timeout=0.2)
+
+
+def _register_and_die(name):
+    SharedMemoryBroker.SharedRing(name, capacity=CAPACITY).register()
+    os._exit(0)
+
+
+def test_readers_of_dead_processes_are_dropped(ring):
+    child = multiprocessing.get_context("fork").Process(
+        target=_register_and_die, args=(ring.name,))
+    child.start()
+    child.join()
+    assert len(ring._readers()) == 1
+    for _ in range(3 * CAPACITY // len(BODY)):
+        ring.append("key", b"[]", BODY, timeout=5)
+    assert ring._readers() == []
+
+
+def test_consumer_behind_its_own_publisher_does_not_block(monkeypatch):
+    # One process publishing to a ring it also consumes from must not wait
+    # on itself, even with nobody taking messages off its local queue
+    monkeypatch.setattr(SharedMemoryBroker, "APPEND_TIMEOUT", 5)
+    broker = SharedMemoryBroker.SharedMemoryBroker(
+        namespace="test%d" % os.getpid(), capacity=16 * 1024)
+    try:
+        channel = broker.connection().channel()
+        channel.exchange_declare(exchange="feed", exchange_type="topic")
+        queue = channel.queue_declare(queue="", exclusive=True).method.queue
+        channel.queue_bind(queue=queue, exchange="feed", routing_key="tweet")
+        total = 2 * SharedMemoryBroker.LOCAL_QUEUE_LIMIT
+        for i in range(total):
+            channel.basic_publish(exchange="feed", routing_key="tweet",
+                                  body=b"%06d" % i + BODY)
+        received = []
+        for method, _, body in channel.consume(queue, inactivity_timeout=1):
+            if method is None:
+                break
+            received.append(int(body[:6]))
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+        assert received == list(range(total))
+    finally:
+        broker.close(unlink=True)
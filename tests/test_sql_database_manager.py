@@ -0,0 +1,107 @@
+"""
+@file_name : test_sql_database_manager.py
+@author : Srihari Seshadri
+@description : Tests of the database manager against SQLite : appends keep
+                the to_sql path unless asked for a bulk load, and LOAD DATA
+                is only given up when the server refuses local files
+@date : 12-03-2018
+"""
+
+import pandas as pd
+import pytest
+from sqlalchemy import BigInteger, Float, exc
+
+import SQLDatabaseManager as sdm
+
+
+@pytest.fixture
+def sqldbm(tmp_path):
+    manager = sdm.SQLDatabaseManager()
+    assert manager.connect_url("sqlite:///" + str(tmp_path / "t.db")) == 1
+    return manager
+
+
+def count(sqldbm, table_name):
+    return sqldbm.execute_query("SELECT COUNT(*) AS n FROM " +
+                                table_name)["n"][0]
+
+
+def test_large_appends_are_bulk_loaded_only_on_request(sqldbm, monkeypatch):
+    monkeypatch.setattr(sdm, "BULK_THRESHOLD", 10)
+    routed = []
+    bulk_insert = sqldbm.bulk_insert
+
+    def spy(dframe, table_name, **kwargs):
+        routed.append(len(dframe))
+        return bulk_insert(dframe, table_name, **kwargs)
+
+    monkeypatch.setattr(sqldbm, "bulk_insert", spy)
+    dframe = pd.DataFrame({"id": range(20), "text": ["x"] * 20})
+    assert sqldbm.insert(dframe=dframe, table_name="tweets") == 1
+    assert routed == []
+    assert sqldbm.insert(dframe=dframe, table_name="tweets", bulk=True) == 1
+    assert routed == [20]
+    assert count(sqldbm, "tweets") == 40
+
+
+class _Refused(Exception):
+    pass
+
+
+@pytest.mark.parametrize("code, allowed", [(1148, False), (1064, True)])
+def test_only_refused_local_files_disable_load_data(sqldbm, monkeypatch,
+                                                    code, allowed):
+    def fail(dframe, path):
+        raise exc.OperationalError("LOAD DATA", {}, _Refused(code, "error"))
+
+    monkeypatch.setattr(sdm, "write_tsv", fail)
+    dframe = pd.DataFrame({"id": range(5)})
+    ret = sqldbm.bulk_insert(dframe, "tweets", method=sdm.BULK_LOAD_DATA)
+    assert sqldbm._load_data_allowed is allowed
+    if allowed:
+        assert ret == -1
+        assert count(sqldbm, "tweets") == 0
+    else:
+        # refused servers fall back to executemany
+        assert ret == 1
+        assert count(sqldbm, "tweets") == 5
+
+
+def pull(sqldbm, table_name, **kwargs):
+    return [row for chunk in sqldbm.stream_new_rows(table_name, **kwargs)
+            for row in chunk.to_dict("records")]
+
+
+def test_high_water_ties_resume_on_the_key(sqldbm):
+    sqldbm.create_table(sdm.TableSchema(
+        "tweets", [("id", BigInteger), ("scraped_at_epoch", BigInteger),
+                   ("score", Float)], primary_key=["id"]))
+    rows = [{"id": i, "scraped_at_epoch": 100 + i // 4, "score": 0.5}
+            for i in range(6)]
+    assert sqldbm.upsert(rows, "tweets") == 1
+    # Chunks of 3 stop inside the tie at epoch 100
+    first = pull(sqldbm, "tweets", chunk_size=3)
+    assert [row["id"] for row in first] == list(range(6))
+    key = sqldbm.get_high_water_key("tweets")
+    assert key == (5,) and isinstance(key[0], int)
+
+    late = [{"id": i, "scraped_at_epoch": 101, "score": 0.5}
+            for i in (6, 7)]
+    assert sqldbm.upsert(late, "tweets") == 1
+    assert [row["id"] for row in pull(sqldbm, "tweets", chunk_size=3)] == \
+        [6, 7]
+    assert pull(sqldbm, "tweets") == []
+
+
+def test_high_water_ties_without_a_key_handle_nulls(sqldbm):
+    rows = pd.DataFrame({"scraped_at_epoch": [100, 100, 100],
+                         "text": ["a", "b", "c"],
+                         "score": [1.0, None, None]})
+    assert sqldbm.insert(dframe=rows, table_name="raw") == 1
+    assert len(pull(sqldbm, "raw", chunk_size=2)) == 3
+    # The rows with a NULL score are recognised as already pulled
+    assert pull(sqldbm, "raw") == []
+    more = pd.DataFrame({"scraped_at_epoch": [100], "text": ["d"],
+                         "score": [None]})
+    assert sqldbm.insert(dframe=more, table_name="raw") == 1
+    assert [row["text"] for row in pull(sqldbm, "raw")] == ["d"]
@@ -0,0 +1,71 @@
+"""
+@file_name : test_tweet_cleaner.py
+@author : Srihari Seshadri
+@description : Tests of the batch path of the cleaner : deduplication
+                within a batch, and bad tweets failing on their own
+@date : 12-03-2018
+"""
+
+import pika
+import pytest
+import MessageCodec
+import TweetCleaner
+from Deduplicator import Deduplicator
+
+
+def _message(tweet):
+    body, content_type, content_encoding = MessageCodec.encode(tweet)
+    return (pika.BasicProperties(content_type=content_type,
+                                 content_encoding=content_encoding), body)
+
+
+def _tweet(tweet_id, retweets=0):
+    return {"id_str": str(tweet_id), "retweet_count": retweets,
+            "favorite_count": 0, "keywords": "uchicago",
+            "created_at": "Wed Oct 10 20:19:24 +0000 2018"}
+
+
+@pytest.fixture(autouse=True)
+def dedup(monkeypatch):
+    index = Deduplicator()
+    monkeypatch.setattr(TweetCleaner, "dedup", index)
+    return index
+
+
+def test_batch_is_cleaned():
+    results, forwards = TweetCleaner.prepare_batch(
+        [_message(_tweet(i)) for i in range(3)])
+    assert results == [None, None, None]
+    assert [f[0] for f in forwards] == [0, 1, 2]
+    assert forwards[0][2]["created_at_epoch"] == 1539202764
+    assert "created_at" not in forwards[0][2]
+
+
+def test_bad_tweets_fail_alone():
+    unparseable = dict(_tweet(5), created_at="not a date")
+    missing = _tweet(6)
+    del missing["created_at"]
+    messages = [_message(_tweet(i)) for i in range(5)] + \
+        [_message(unparseable), _message(missing), (None, b"{not json")]
+    results, forwards = TweetCleaner.prepare_batch(messages)
+    assert results == [None] * 5 + [-1, -1, -1]
+    assert [f[0] for f in forwards] == [0, 1, 2, 3, 4]
+    assert all(f[2]["created_at_epoch"] == 1539202764 for f in forwards)
+
+
+def test_duplicates_are_dropped_unless_counts_changed(dedup):
+    dedup.add(_tweet(1)["id_str"] + ":0:0")
+    messages = [_message(_tweet(1)), _message(_tweet(2)),
+                _message(_tweet(2)), _message(_tweet(2, retweets=3))]
+    results, forwards = TweetCleaner.prepare_batch(messages)
+    assert results == [1, None, 1, None]
+    assert [f[1] for f in forwards] == ["2:0:0", "2:3:0"]
+
+
+def test_forwarded_tweets_are_remembered(dedup):
+    results, forwards = TweetCleaner.prepare_batch([_message(_tweet(1)),
+                                                    _message(_tweet(2))])
+    TweetCleaner.record_forwarded(results, forwards, [True, False])
+    assert results == [1, -1]
+    assert dedup.contains("1:0:0")
+    assert not dedup.contains("2:0:0")
@@ -0,0 +1,65 @@
+"""
+@file_name : test_window_aggregator.py
+@author : Srihari Seshadri
+@description : Tests of the sliding window totals of WindowAggregator,
+                including messages that arrive out of order
+@date : 12-03-2018
+"""
+
+from WindowAggregator import WindowAggregator, SLIDING
+
+BUCKET = 60
+
+
+def _aggregator():
+    return WindowAggregator(windows={"1h": (SLIDING, 3600)},
+                            bucket_seconds=BUCKET, num_buckets=60)
+
+
+def _tweet(bucket, keywords="uchicago"):
+    return {"keywords": keywords, "retweet_count": 1, "favorite_count": 2,
+            "scraped_at_epoch": bucket * BUCKET}
+
+
+def _count(aggregator, bucket):
+    aggregator.advance_to(bucket * BUCKET)
+    _, _, groups = aggregator.window("1h")
+    return int(sum(totals[0] for totals in groups.values()))
+
+
+def test_in_order_messages_expire():
+    aggregator = _aggregator()
+    assert aggregator.add(_tweet(100)) == 1
+    assert aggregator.add(_tweet(101)) == 1
+    assert _count(aggregator, 159) == 2
+    assert _count(aggregator, 160) == 1
+    assert _count(aggregator, 161) == 0
+
+
+def test_late_message_is_evicted():
+    aggregator = _aggregator()
+    aggregator.add(_tweet(100))
+    assert aggregator.add(_tweet(95)) == 1
+    # (97..157] : the late message has left the window
+    assert _count(aggregator, 157) == 1
+    # (100..160] : both have
+    assert _count(aggregator, 160) == 0
+
+
+def test_late_messages_sharing_a_bucket_are_summed():
+    aggregator = _aggregator()
+    aggregator.add(_tweet(100))
+    aggregator.add(_tweet(90))
+    aggregator.add(_tweet(90, keywords="other"))
+    _, _, groups = aggregator.window("1h")
+    assert groups[("uchicago",)].tolist() == [2.0, 2.0, 4.0]
+    assert groups[("other",)].tolist() == [1.0, 1.0, 2.0]
+    assert _count(aggregator, 150) == 1
+
+
+def test_too_late_messages_are_not_counted():
+    aggregator = _aggregator()
+    aggregator.add(_tweet(100))
+    assert aggregator.add(_tweet(40)) == 0
+    assert aggregator.late == 1
+    assert _count(aggregator, 100) == 1
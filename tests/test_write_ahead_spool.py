@@ -0,0 +1,99 @@
+"""
+@file_name : test_write_ahead_spool.py
+@author : Srihari Seshadri
+@description : Tests of the row spool : replay in order with keys merged,
+                rows kept when the write fails, replayed segments deleted,
+                and recovery after a restart or a torn record
+@date : 12-03-2018
+"""
+
+import os
+
+import WriteAheadSpool as was
+
+
+def segment_files(path):
+    return sorted(name for name in os.listdir(path)
+                  if name.endswith(".seg"))
+
+
+def test_replay_merges_keys_and_keeps_rows_on_failure(tmp_path):
+    spool = was.WriteAheadSpool(str(tmp_path))
+    assert spool.append([{"id": 1, "v": "a"}, {"id": 2, "v": "a"}]) == 1
+    assert spool.append([{"id": 1, "v": "b"}]) == 1
+    assert spool.pending() == 3
+
+    assert spool.replay(lambda rows: -1, key="id") == -1
+    assert spool.pending() == 3
+
+    written = []
+    assert spool.replay(lambda rows: written.extend(rows) or 1,
+                        key="id") == 3
+    assert written == [{"id": 2, "v": "a"}, {"id": 1, "v": "b"}]
+    assert spool.pending() == 0
+    assert spool.replay(lambda rows: 1) == 0
+    spool.close()
+
+
+def test_replay_takes_whole_records_up_to_max_rows(tmp_path):
+    spool = was.WriteAheadSpool(str(tmp_path))
+    for i in range(4):
+        spool.append([{"id": i * 2}, {"id": i * 2 + 1}])
+    batches = []
+    while spool.replay(lambda rows: batches.append(rows) or 1,
+                       max_rows=3) > 0:
+        pass
+    assert [len(batch) for batch in batches] == [4, 4]
+    assert [row["id"] for batch in batches for row in batch] == \
+        list(range(8))
+    spool.close()
+
+
+def test_compaction_deletes_replayed_segments(tmp_path):
+    # Each record is too big to share a segment
+    spool = was.WriteAheadSpool(str(tmp_path), segment_size=128)
+    for i in range(3):
+        spool.append([{"id": i, "text": "x" * 64}])
+    assert len(segment_files(str(tmp_path))) == 3
+
+    assert spool.replay(lambda rows: 1, max_rows=2) == 2
+    assert segment_files(str(tmp_path)) == ["000000000002.seg"]
+    assert spool.replay(lambda rows: 1) == 1
+    # The newest segment is kept and recycled for the next appends
+    assert segment_files(str(tmp_path)) == ["000000000002.seg"]
+    spool.append([{"id": 3}])
+    assert len(segment_files(str(tmp_path))) == 1
+    spool.close()
+
+
+def test_pending_rows_survive_a_restart(tmp_path):
+    spool = was.WriteAheadSpool(str(tmp_path))
+    spool.append([{"id": 1}, {"id": 2}])
+    spool.append([{"id": 3}])
+    spool.replay(lambda rows: 1, max_rows=1)
+    spool.close()
+
+    spool = was.WriteAheadSpool(str(tmp_path))
+    assert spool.pending() == 1
+    written = []
+    spool.replay(lambda rows: written.extend(rows) or 1)
+    assert written == [{"id": 3}]
+    spool.close()
+
+
+def test_recovery_drops_a_torn_last_record(tmp_path):
+    spool = was.WriteAheadSpool(str(tmp_path))
+    spool.append([{"id": 1}])
+    spool.append([{"id": 2}])
+    segment = spool._segments[-1]
+    # Damage the payload of the last record, as a crash mid-write would
+    segment._map[segment.write_pos - 2] ^= 0xFF
+    spool.close()
+
+    spool = was.WriteAheadSpool(str(tmp_path))
+    assert spool.pending() == 1
+    spool.append([{"id": 3}])
+    written = []
+    spool.replay(lambda rows: written.extend(rows) or 1)
+    assert written == [{"id": 1}, {"id": 3}]
+    spool.close()